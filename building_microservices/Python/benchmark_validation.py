@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark of endpoint schema validation for the hello_world and
+roundrobin example microservices.
+
+Reports validated calls per second, validating a typical request and
+response of every endpoint:
+
+* mdstudio:  the mdstudio endpoint validation, `validate_json_schema` with
+             the resolved schema, building a validator for every call
+* compiled:  cached compiled validators as used by `validated_endpoint`
+* trusted:   compiled request validation only (MDSTUDIO_TRUSTED_CALLER)
+
+Usage:
+
+    python benchmark_validation.py [--calls 20000]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+currdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(currdir, 'endpoint_tools'))
+
+from mdstudio.api.schema import validate_json_schema
+
+from endpoint_tools import validation
+
+ENDPOINTS = [
+    ('hello', os.path.join(currdir, 'hello_world', 'hello_world'), 'hello_request', 'hello_response',
+     {'greeting': 'Calling self', 'sendTime': '2018-06-01T12:00:00+00:00'},
+     {'greeting': 'Hello World!: Calling self', 'sendTime': '2018-06-01T12:00:00+00:00',
+      'returnTime': '2018-06-01T12:00:00.001000+00:00'}),
+    ('roundrobin', os.path.join(currdir, 'roundrobin_registration', 'roundrobin'), 'roundrobin_request',
+     'roundrobin_response', {'number': 12}, {'number': 144}),
+]
+
+
+def calls_per_second(func, calls):
+
+    start = time.time()
+    for _ in range(calls):
+        func()
+
+    return calls / (time.time() - start)
+
+
+def benchmark(calls):
+
+    results = []
+    for name, package, request_schema, response_schema, request, response in ENDPOINTS:
+        directory = os.path.join(package, 'schemas', 'endpoints')
+
+        # mdstudio resolves the schemas once, when the endpoint is registered
+        request_definition = validation.load_schema(request_schema, directory)
+        response_definition = validation.load_schema(response_schema, directory)
+
+        def mdstudio():
+            validate_json_schema(request_definition, request)
+            validate_json_schema(response_definition, response)
+
+        validate_request = validation.get_validator(request_schema, directory)
+        validate_response = validation.get_validator(response_schema, directory)
+
+        def compiled():
+            validate_request(request)
+            validate_response(response)
+
+        def trusted():
+            validate_request(request)
+
+        results.append((name, calls_per_second(mdstudio, calls), calls_per_second(compiled, calls),
+                        calls_per_second(trusted, calls)))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark endpoint schema validation')
+    parser.add_argument('--calls', type=int, default=20000, help='number of validated calls to time')
+    args = parser.parse_args()
+
+    backend = 'fastjsonschema' if validation.fastjsonschema is not None else 'jsonschema'
+    print('Validated calls per second ({0})'.format(backend))
+    print('{0:>12} {1:>12} {2:>12} {3:>12}'.format('endpoint', 'mdstudio', 'compiled', 'trusted'))
+    for name, mdstudio, compiled, trusted in benchmark(args.calls):
+        print('{0:>12} {1:>12.0f} {2:>12.0f} {3:>12.0f}'.format(name, mdstudio, compiled, trusted))
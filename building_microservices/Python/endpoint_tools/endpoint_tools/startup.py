@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+Startup profiling for MDStudio microservices
+
+Cold start latency of a microservice consists of Python module imports
+(mdstudio, Twisted, autobahn and the microservice itself), connecting and
+authenticating with the broker and registering the endpoints.
+Set the MDSTUDIO_STARTUP_PROFILE environment variable to report:
+
+* an import time breakdown per top-level package
+* the time from process start to registered with the broker, measured from
+  the import of this module as first import in the package __main__
+
+The registration time is logged as 'startup.registered' metric and, if
+MDSTUDIO_STARTUP_METRICS points to a file, appended to it as JSON line.
+"""
+
+import os
+import sys
+import json
+import time
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+STARTUP_PROFILE = bool(os.environ.get('MDSTUDIO_STARTUP_PROFILE'))
+STARTUP_METRICS = os.environ.get('MDSTUDIO_STARTUP_METRICS')
+
+
+class StartupProfile(object):
+    """
+    Record import times and time-to-registered of the current process
+    """
+
+    def __init__(self):
+
+        self.start = time.time()
+        self.imports = {}
+        self.registered = None
+        self._depth = 0
+        self._import = None
+
+    def enable(self):
+        """
+        Time all top-level imports by wrapping the built-in __import__
+
+        Only the outermost import of a chain is timed and attributed to its
+        top-level package so nested imports are not counted twice.
+        """
+
+        if self._import is not None:
+            return
+
+        self._import = builtins.__import__
+        original_import = self._import
+
+        def timed_import(name, *args, **kwargs):
+
+            if self._depth or not name or name in sys.modules:
+                self._depth += 1
+                try:
+                    return original_import(name, *args, **kwargs)
+                finally:
+                    self._depth -= 1
+
+            self._depth += 1
+            start = time.time()
+            try:
+                return original_import(name, *args, **kwargs)
+            finally:
+                self._depth -= 1
+                package = name.split('.')[0]
+                self.imports[package] = self.imports.get(package, 0.0) + time.time() - start
+
+        builtins.__import__ = timed_import
+
+    def disable(self):
+
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    def report(self, session):
+        """
+        Report import times and time-to-registered for a registered session
+
+        Call from the session `on_run` method, called once the microservice
+        registered with the broker.
+        """
+
+        self.disable()
+        self.registered = time.time() - self.start
+        component = type(session).__name__
+
+        for package, seconds in sorted(self.imports.items(), key=lambda item: item[1], reverse=True):
+            session.log.info('{package:>20} import: {ms:>8.2f} ms', package=package, ms=seconds * 1000)
+        session.log.info('startup.registered {component}: {ms:.2f} ms', component=component,
+                         ms=self.registered * 1000)
+
+        if STARTUP_METRICS:
+            metric = {'metric': 'startup.registered', 'component': component, 'pid': os.getpid(),
+                      'time': self.start, 'value': self.registered,
+                      'imports': dict((k, round(v, 6)) for k, v in self.imports.items())}
+            with open(STARTUP_METRICS, 'a') as metrics:
+                metrics.write(json.dumps(metric) + '\n')
+
+
+profile = StartupProfile()
+if STARTUP_PROFILE:
+    profile.enable()
+
+
+def report_startup(session):
+    """
+    Report startup metrics if startup profiling is enabled
+    """
+
+    if STARTUP_PROFILE:
+        profile.report(session)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compiled JSON schema validation for MDStudio endpoints
+
+The `endpoint` decorator of the mdstudio library validates every request
+and response against the endpoint JSON schemas, building a new validator
+for every call. For small payloads this costs more than the endpoint
+itself.
+
+`validated_endpoint` registers an endpoint the same way, with the same
+request and response schemas, but resolves the schemas from the
+<package>/schemas/endpoints directory of the decorated method once, when
+the endpoint is defined, and compiles them into validator functions cached
+by schema file. Valid requests and responses are accepted by these
+compiled validators. Invalid ones, and schemas that are not found locally
+or fill in default values, are left to the mdstudio validation so errors
+are reported as usual. fastjsonschema is used to generate the validator
+code when installed, jsonschema validators otherwise.
+
+Set the MDSTUDIO_TRUSTED_CALLER environment variable to skip response
+validation, for production deployments where the microservice code is
+trusted to return valid responses. Requests are always validated.
+"""
+
+import os
+import sys
+import json
+
+from jsonschema import FormatChecker
+from jsonschema.validators import validator_for
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+from mdstudio.api.endpoint import WampEndpoint
+
+TRUSTED_CALLER = bool(os.environ.get('MDSTUDIO_TRUSTED_CALLER'))
+
+# Compiled validator functions by schema file
+_VALIDATORS = {}
+
+
+def schema_dir(func):
+    """
+    Return the schemas/endpoints directory of the package defining `func`
+    """
+
+    module = sys.modules[func.__module__]
+    return os.path.join(os.path.dirname(os.path.abspath(module.__file__)), 'schemas', 'endpoints')
+
+
+def load_schema(name, directory, version=1):
+    """
+    Load an endpoint schema from a schemas/endpoints directory
+
+    :param name:      schema name, e.g. 'hello_request'
+    :type name:       :py:str
+    :param directory: schemas/endpoints directory
+    :type directory:  :py:str
+    :param version:   schema version
+    :type version:    :py:int
+
+    :return:          schema, None if not found
+    :rtype:           :py:dict
+    """
+
+    path = os.path.join(directory, '{0}.v{1}.json'.format(name, version))
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, 'r') as schema_file:
+        return json.load(schema_file)
+
+
+def has_defaults(schema):
+    """
+    Return True if a schema defines default values anywhere
+    """
+
+    if isinstance(schema, dict):
+        return 'default' in schema or any(has_defaults(value) for value in schema.values())
+    if isinstance(schema, list):
+        return any(has_defaults(value) for value in schema)
+
+    return False
+
+
+def compile_schema(schema):
+    """
+    Compile a JSON schema into a validator function
+
+    The function returns True for a valid document.
+
+    :param schema: JSON schema
+    :type schema:  :py:dict
+
+    :rtype:        :py:func
+    """
+
+    if fastjsonschema is not None:
+        validate = fastjsonschema.compile(schema)
+
+        def validator(document):
+            try:
+                validate(document)
+            except fastjsonschema.JsonSchemaException:
+                return False
+            return True
+
+        return validator
+
+    validator_class = validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema, format_checker=FormatChecker()).is_valid
+
+
+def get_validator(name, directory, version=1):
+    """
+    Return the compiled validator for an endpoint schema, compiling it on
+    first use
+
+    :param name:      schema name, e.g. 'hello_request'
+    :type name:       :py:str
+    :param directory: schemas/endpoints directory
+    :type directory:  :py:str
+    :param version:   schema version
+    :type version:    :py:int
+
+    :return:          validator, None when the schema is not available
+                      locally or fills in default values
+    :rtype:           :py:func
+    """
+
+    if not isinstance(name, str):
+        return None
+
+    key = os.path.join(directory, '{0}.v{1}.json'.format(name, version))
+    if key not in _VALIDATORS:
+        schema = load_schema(name, directory, version)
+        _VALIDATORS[key] = compile_schema(schema) if schema and not has_defaults(schema) else None
+
+    return _VALIDATORS[key]
+
+
+class CompiledValidationEndpoint(WampEndpoint):
+    """
+    mdstudio endpoint validating with compiled, cached schema validators
+
+    Accepts valid documents using the compiled validators and hands
+    documents they reject to the mdstudio validation for error reporting.
+    """
+
+    def __init__(self, wrapped_f, uri, input_schema, output_schema, *args, **kwargs):
+
+        super(CompiledValidationEndpoint, self).__init__(wrapped_f, uri, input_schema, output_schema,
+                                                         *args, **kwargs)
+
+        directory = schema_dir(wrapped_f)
+        self.compiled_request = get_validator(input_schema, directory)
+        self.compiled_response = get_validator(output_schema, directory)
+
+    def validate_request(self, request):
+
+        if self.compiled_request is not None and self.compiled_request(request):
+            return None
+
+        return super(CompiledValidationEndpoint, self).validate_request(request)
+
+    def validate_result(self, result):
+
+        if TRUSTED_CALLER or (self.compiled_response is not None and self.compiled_response(result)):
+            return None
+
+        return super(CompiledValidationEndpoint, self).validate_result(result)
+
+
+def validated_endpoint(uri, input_schema, output_schema=None, claim_schema=None, options=None, scope=None):
+    """
+    Register an endpoint validated by compiled, cached schema validators
+
+    Takes the same arguments as the mdstudio `endpoint` decorator and
+    registers the endpoint with the same request and response schemas.
+    """
+
+    def decorator(func):
+        return CompiledValidationEndpoint(func, uri, input_schema, output_schema, claim_schema, options, scope)
+
+    return decorator
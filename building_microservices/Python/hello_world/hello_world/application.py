@@ -2,13 +2,15 @@
 
 # mdstudio library imports
 from mdstudio.component.session import ComponentSession
-from mdstudio.api.endpoint import endpoint
 from mdstudio.deferred.call_later import call_later
 from mdstudio.deferred.chainable import chainable
 from mdstudio.utc import now, from_utc_string
 
 from pprint import pprint
 
+from endpoint_tools.startup import report_startup
+from endpoint_tools.validation import validated_endpoint
+
 
 # The microservice API is class based and needs to inherit methods from
 # the ComponentSession base class.
@@ -26,10 +28,12 @@ class HelloWorldComponent(ComponentSession):
         with the MDStudio broker. It can be used to run initiation routines
         """
 
+        report_startup(self)
+
         call_later(2, self.call_hello)
         print('Waiting a few seconds for things to start up')
 
-    @endpoint('hello', 'hello_request', 'hello_response')
+    @validated_endpoint('hello', 'hello_request', 'hello_response')
     def hello(self, request, claims):
         """
         hello endpoint
@@ -70,7 +74,7 @@ class HelloWorldComponent(ComponentSession):
             pprint(request)
 
         # Return the request dictionary. This will be validated against the
-        # hello-response.v1.json JSON schema
+        # hello-response.v1.json JSON schema unless MDSTUDIO_TRUSTED_CALLER is set
         return request
 
     @chainable
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tail latency benchmark of round-robin versus least-loaded dispatching
+
+Launch two or more roundrobin microservices and run this script. The same
+sequence of jobs with skewed durations, mostly short with a few long ones,
+is submitted at a fixed rate using the round-robin registered 'parallel'
+endpoint and using the LeastLoadedDispatcher. Call latency percentiles are
+reported for both.
+"""
+
+import time
+import random
+
+from autobahn.twisted.util import sleep
+from twisted.internet.defer import gatherResults
+
+from mdstudio.deferred.chainable import chainable
+from mdstudio.component.session import ComponentSession
+from mdstudio.runner import main
+
+from dispatcher import LeastLoadedDispatcher, ROUNDROBIN_URI
+from roundrobin.application import LOAD_INTERVAL
+
+JOBS = 60
+SUBMIT_INTERVAL = 0.2
+SHORT_DURATION = 0.2
+LONG_DURATION = 5.0
+LONG_FRACTION = 0.1
+
+
+def percentile(values, fraction):
+
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class BenchmarkSession(ComponentSession):
+
+    def authorize_request(self, uri, claims):
+        return True
+
+    @chainable
+    def run_jobs(self, call, durations):
+
+        latencies = []
+        calls = []
+        for number, duration in enumerate(durations):
+            start = time.time()
+            deferred = call({'number': number, 'duration': duration})
+            deferred.addCallback(lambda _, start=start: latencies.append(time.time() - start))
+            calls.append(deferred)
+            yield sleep(SUBMIT_INTERVAL)
+
+        yield gatherResults(calls)
+        return latencies
+
+    @chainable
+    def on_run(self):
+
+        dispatcher = LeastLoadedDispatcher(self)
+        yield dispatcher.start()
+
+        # Wait for a load report of every running instance
+        yield sleep(2 * LOAD_INTERVAL)
+        print('{0} roundrobin instances reporting load'.format(len(dispatcher.instances)))
+
+        rng = random.Random(1)
+        durations = [LONG_DURATION if rng.random() < LONG_FRACTION else SHORT_DURATION for _ in range(JOBS)]
+
+        modes = [('round robin', lambda request: self.call(ROUNDROBIN_URI, request)),
+                 ('least loaded', dispatcher.call)]
+
+        print('{0:>14} {1:>8} {2:>8} {3:>8} {4:>8}'.format('dispatch', 'p50 (s)', 'p95 (s)', 'p99 (s)', 'max (s)'))
+        for name, call in modes:
+            latencies = yield self.run_jobs(call, durations)
+            print('{0:>14} {1:>8.2f} {2:>8.2f} {3:>8.2f} {4:>8.2f}'.format(
+                name, percentile(latencies, 0.5), percentile(latencies, 0.95), percentile(latencies, 0.99),
+                max(latencies)))
+
+
+if __name__ == '__main__':
+    main(BenchmarkSession, daily_log=False)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""
+Client side least-loaded dispatching for the roundrobin microservice
+
+Round-robin registration hands out calls to the instances in turn, also to
+an instance still busy with a long job while others are idle. Every
+roundrobin instance registers the parallel endpoint under its own uri as
+well and publishes its load on the 'mdgroup.roundrobin.load' topic. The
+LeastLoadedDispatcher follows these reports and calls the instance with
+the fewest outstanding requests directly.
+"""
+
+import time
+import random
+
+from roundrobin.application import LOAD_TOPIC, LOAD_INTERVAL
+
+ROUNDROBIN_URI = 'mdgroup.roundrobin.endpoint.parallel'
+
+
+class LeastLoadedDispatcher(object):
+    """
+    Route calls to the least loaded roundrobin instance
+
+    The load of an instance is the larger of the in-flight count it last
+    reported and the number of calls this client made to it that did not
+    return yet. Instances that did not report for `stale_after` seconds
+    or report they are draining are not used. Without known instances calls go to the round-robin uri.
+
+    :param session:     MDStudio session to subscribe and call with
+    :param stale_after: seconds after which an instance without load report
+                        is considered gone
+    :type stale_after:  :py:float
+    """
+
+    def __init__(self, session, stale_after=3 * LOAD_INTERVAL):
+
+        self.session = session
+        self.stale_after = stale_after
+        self.instances = {}
+        self.outstanding = {}
+
+    def start(self):
+        """
+        Subscribe to the load reports of the roundrobin instances
+        """
+
+        return self.session.subscribe(self.on_load, LOAD_TOPIC)
+
+    def on_load(self, load):
+
+        self.instances[load['uri']] = dict(load, received=time.time())
+
+    def load(self, uri):
+
+        return max(self.instances[uri]['in_flight'], self.outstanding.get(uri, 0))
+
+    def choose(self):
+        """
+        Return the uri of the least loaded live instance
+        """
+
+        now = time.time()
+        live = [uri for uri, load in self.instances.items()
+                if now - load['received'] < self.stale_after and not load.get('draining')]
+        if not live:
+            return ROUNDROBIN_URI
+
+        lowest = min(self.load(uri) for uri in live)
+        return random.choice([uri for uri in live if self.load(uri) == lowest])
+
+    def call(self, request):
+        """
+        Call the parallel endpoint on the least loaded instance
+
+        :param request: roundrobin request
+        :type request:  :py:dict
+
+        :return:        Deferred firing with the response
+        """
+
+        uri = self.choose()
+        self.outstanding[uri] = self.outstanding.get(uri, 0) + 1
+
+        def release(outcome):
+            self.outstanding[uri] -= 1
+            return outcome
+
+        return self.session.call(uri, request).addBoth(release)
@@ -6,6 +6,12 @@ import sys
 modulepath = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
 sys.path.insert(0, modulepath)
 
+# Shared endpoint_tools package, used from the source tree when not installed
+sys.path.append(os.path.join(modulepath, '..', 'endpoint_tools'))
+
+# Imported first to profile all following imports if MDSTUDIO_STARTUP_PROFILE is set
+from endpoint_tools import startup
+
 from mdstudio.runner import main
 from roundrobin.application import RoundrobinComponent
 
@@ -2,54 +2,191 @@
 
 # mdstudio library imports
 from mdstudio.component.session import ComponentSession
-from mdstudio.api.endpoint import endpoint
 from mdstudio.deferred.chainable import chainable
 
+import os
+import time
+import signal
 from time import sleep
 from autobahn.wamp import RegisterOptions
+from autobahn.twisted.util import sleep as sleep_async
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+from endpoint_tools.startup import report_startup
+from endpoint_tools.validation import validated_endpoint
 
 DELAY = 5
 POWER = 2
 
+# Every instance registers the parallel endpoint under its own uri as well,
+# next to the shared round-robin uri, and publishes its load on LOAD_TOPIC
+# when it changes and every LOAD_INTERVAL seconds.
+INSTANCE_ID = os.environ.get('ROUNDROBIN_INSTANCE', 'i{0}'.format(os.getpid()))
+LOAD_TOPIC = 'mdgroup.roundrobin.load'
+LOAD_INTERVAL = 1.0
+LATENCY_SMOOTHING = 0.3
+
 
 # The microservice API is class based and needs to inherit methods from
 # the ComponentSession base class.
 class RoundrobinComponent(ComponentSession):
 
+    in_flight = 0
+    latency = 0.0
+    last_completed = None
+    draining = False
+    registrations = None
+
     def authorize_request(self, uri, claims):
         # Authorize calls to API endpoints
         return True
 
-    @endpoint('parallel', 'roundrobin_request', 'roundrobin_response',
-              options=RegisterOptions(invoke=u'roundrobin'))
+    def on_run(self):
+        """
+        Called when the microservice registered with the MDStudio broker.
+        Starts load reporting and reports cold start metrics when startup
+        profiling is enabled.
+        """
+
+        report_startup(self)
+        self.last_completed = time.time()
+
+        # Jobs run one at a time in a worker thread, the reactor stays free
+        # to accept calls and publish the load of this instance.
+        self.worker = ThreadPool(minthreads=1, maxthreads=1, name='roundrobin-worker')
+        self.worker.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self.worker.stop)
+
+        self.load_reporter = LoopingCall(self.publish_load)
+        self.load_reporter.start(LOAD_INTERVAL)
+
+        # SIGUSR1 drains the instance, used by the supervisor to retire it
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: reactor.callFromThread(self.drain))
+
+    def register(self, *args, **kwargs):
+        """
+        Register endpoints with the broker and keep the registrations so they
+        can be undone by `unregister_endpoints`
+        """
+
+        def keep(registrations):
+            if self.registrations is None:
+                self.registrations = []
+            self.registrations.extend(registrations if isinstance(registrations, list) else [registrations])
+            return registrations
+
+        return super(RoundrobinComponent, self).register(*args, **kwargs).addCallback(keep)
+
+    @chainable
+    def unregister_endpoints(self):
+        """
+        Unregister all endpoints of this instance, the broker stops routing
+        calls to it
+        """
+
+        registrations, self.registrations = self.registrations or [], []
+        for registration in registrations:
+            if registration.active:
+                yield registration.unregister()
+
+    def publish_load(self):
+        """
+        Publish the number of calls in flight and waiting for the worker, the
+        smoothed call latency in seconds and the time the last call completed
+        """
+
+        self.publish(LOAD_TOPIC, {'instance': INSTANCE_ID,
+                                  'pid': os.getpid(),
+                                  'uri': 'mdgroup.roundrobin.endpoint.parallel.{0}'.format(INSTANCE_ID),
+                                  'in_flight': self.in_flight,
+                                  'queued': max(self.in_flight - 1, 0),
+                                  'latency': self.latency,
+                                  'last_completed': self.last_completed,
+                                  'draining': self.draining,
+                                  'time': time.time()})
+
+    @chainable
+    def drain(self):
+        """
+        Stop accepting calls, finish the calls in flight and stop
+        """
+
+        if self.draining:
+            return
+
+        self.draining = True
+        self.log.info('Draining roundrobin instance {0}, {1} calls in flight'.format(INSTANCE_ID, self.in_flight))
+        yield self.unregister_endpoints()
+        self.publish_load()
+
+        while self.in_flight:
+            yield sleep_async(LOAD_INTERVAL)
+
+        self.load_reporter.stop()
+        self.leave()
+        reactor.stop()
+
+    @chainable
+    def run_job(self, request):
+        """
+        Run a job in the worker thread and keep track of the load
+        """
+
+        start = time.time()
+        self.in_flight += 1
+        self.publish_load()
+        try:
+            number = yield deferToThreadPool(reactor, self.worker, self.sleep, request['number'],
+                                             request.pop('duration', DELAY))
+        finally:
+            self.in_flight -= 1
+            self.last_completed = time.time()
+            self.latency += LATENCY_SMOOTHING * (self.last_completed - start - self.latency)
+            self.publish_load()
+
+        request['number'] = number**POWER
+        return request
+
+    @validated_endpoint('parallel', 'roundrobin_request', 'roundrobin_response',
+                        options=RegisterOptions(invoke=u'roundrobin'))
     def parallel_call(self, request, claims):
         """
         Parallel call
 
-        Simulate some CPU intensive task by sleeping for 5 seconds
-        then return number variable to the power of 2.
+        Simulate some CPU intensive task by sleeping for 5 seconds, or the
+        optional request 'duration', then return number variable to the
+        power of 2.
         """
 
-        self.sleep(request['number'])
-        request['number'] = request['number']**POWER
-        return request
+        return self.run_job(request)
 
-    @endpoint('sequential','roundrobin_request', 'roundrobin_response')
-    def sequential_call(self, request, claims):
+    @validated_endpoint('parallel.{0}'.format(INSTANCE_ID), 'roundrobin_request', 'roundrobin_response')
+    def instance_call(self, request, claims):
         """
-        Sequential call
+        Parallel call on this instance
 
-        Similar to parallel_call but without the roundrobin registration
+        Same as parallel_call for a load-aware client dispatching calls to
+        the least loaded instance itself.
         """
 
-        self.sleep(request['number'])
-        request['number'] = request['number']**POWER
-        return request
+        return self.run_job(request)
 
-    def sleep(self, number):
+    @validated_endpoint('sequential','roundrobin_request', 'roundrobin_response')
+    def sequential_call(self, request, claims):
+        """
+        Sequential call
 
-        self.log.info('Process number {0} after {1} seconds delay'.format(number, DELAY))
-        sleep(5)
+        Similar to parallel_call but without the roundrobin registration
+        """
 
+        return self.run_job(request)
 
+    def sleep(self, number, duration=DELAY):
 
+        self.log.info('Process number {0} after {1} seconds delay'.format(number, duration))
+        sleep(duration)
+        return number
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local autoscaling supervisor for roundrobin workers
+
+Starts `python -m roundrobin` worker processes and follows the load they
+publish on the 'mdgroup.roundrobin.load' topic. Every SCALE_INTERVAL
+seconds the worker count is adjusted between the minimum and maximum:
+
+* a worker is added when the backlog (calls waiting for a worker thread)
+  exceeds ROUNDROBIN_MAX_BACKLOG per worker or, while calls are running,
+  the mean call latency exceeds ROUNDROBIN_TARGET_LATENCY
+* a worker is retired when there is no backlog and either a worker is
+  idle, no calls in flight and none completed for ROUNDROBIN_IDLE_TIMEOUT
+  seconds, or the latency is below half the target. The latency estimate
+  is only updated when a call completes, an idle worker keeps reporting
+  the latency of its last calls. The idle worker, or else the least busy
+  worker, is sent SIGUSR1, stops accepting calls, finishes the calls in
+  flight and exits. It is terminated if it did not exit after
+  ROUNDROBIN_DRAIN_TIMEOUT seconds.
+
+Scaling decisions are at least SCALE_COOLDOWN seconds apart. Workers that
+exit unexpectedly are replaced to keep the minimum count. When the
+supervisor stops all workers are drained first. Scaling follows the load
+reports of the workers, without workers there is no load to scale up on,
+so ROUNDROBIN_MIN_WORKERS should be at least 1.
+
+Run from the roundrobin_registration directory:
+
+    ROUNDROBIN_MIN_WORKERS=1 ROUNDROBIN_MAX_WORKERS=4 python -m roundrobin.supervisor
+"""
+
+import os
+import sys
+import time
+import signal
+import subprocess
+
+modulepath = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.insert(0, modulepath)
+
+# Shared endpoint_tools package, used from the source tree when not installed
+sys.path.append(os.path.join(modulepath, '..', 'endpoint_tools'))
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+from mdstudio.component.session import ComponentSession
+from mdstudio.runner import main
+
+from roundrobin.application import LOAD_TOPIC, LOAD_INTERVAL
+
+MIN_WORKERS = int(os.environ.get('ROUNDROBIN_MIN_WORKERS', 1))
+MAX_WORKERS = int(os.environ.get('ROUNDROBIN_MAX_WORKERS', os.cpu_count() or 1))
+TARGET_LATENCY = float(os.environ.get('ROUNDROBIN_TARGET_LATENCY', 10.0))
+MAX_BACKLOG = int(os.environ.get('ROUNDROBIN_MAX_BACKLOG', 1))
+DRAIN_TIMEOUT = float(os.environ.get('ROUNDROBIN_DRAIN_TIMEOUT', 60.0))
+IDLE_TIMEOUT = float(os.environ.get('ROUNDROBIN_IDLE_TIMEOUT', 30.0))
+SCALE_INTERVAL = 2.0
+SCALE_COOLDOWN = 10.0
+
+
+def scaling_decision(workers, now):
+    """
+    Decide to add or retire a worker from the load reports of the active
+    workers
+
+    :param workers: active workers, all with a recent load report
+    :type workers:  :py:list
+    :param now:     current time in seconds since the epoch
+    :type now:      :py:float
+
+    :return:        1 and None to add a worker, -1 and the worker to retire
+                    or 0 and None
+    :rtype:         :py:tuple
+    """
+
+    if not workers:
+        return 0, None
+
+    loads = [worker.load for worker in workers]
+    backlog = sum(load['queued'] for load in loads)
+    busy = sum(load['in_flight'] for load in loads)
+    latency = sum(load['latency'] for load in loads) / len(loads)
+
+    overloaded = backlog > MAX_BACKLOG * len(workers) or (busy and latency > TARGET_LATENCY)
+    if overloaded:
+        return (1, None) if len(workers) < MAX_WORKERS else (0, None)
+
+    if backlog or len(workers) <= MIN_WORKERS:
+        return 0, None
+
+    idle = [worker for worker in workers if not worker.load['in_flight'] and
+            now - (worker.load.get('last_completed') or 0) > IDLE_TIMEOUT]
+    if idle:
+        return -1, min(idle, key=lambda w: w.load.get('last_completed') or 0)
+    if latency < TARGET_LATENCY / 2:
+        return -1, min(workers, key=lambda w: w.load['in_flight'])
+
+    return 0, None
+
+
+def check_limits():
+    """
+    Validate the worker count limits
+
+    :raises ValueError: minimum below 1 or above the maximum
+    """
+
+    if MIN_WORKERS < 1:
+        raise ValueError('ROUNDROBIN_MIN_WORKERS should be at least 1, got {0}'.format(MIN_WORKERS))
+    if MAX_WORKERS < MIN_WORKERS:
+        raise ValueError('ROUNDROBIN_MAX_WORKERS ({0}) should not be below ROUNDROBIN_MIN_WORKERS ({1})'.format(
+            MAX_WORKERS, MIN_WORKERS))
+
+
+class Worker(object):
+    """
+    A roundrobin worker process and its last reported load
+    """
+
+    def __init__(self, instance):
+
+        self.instance = instance
+        self.load = None
+        self.drain_started = None
+        # Own process group, a Ctrl-C of the supervisor should not stop the
+        # workers without draining them
+        self.process = subprocess.Popen([sys.executable, '-m', 'roundrobin'], cwd=modulepath,
+                                        env=dict(os.environ, ROUNDROBIN_INSTANCE=instance),
+                                        start_new_session=True)
+
+    @property
+    def running(self):
+        return self.process.poll() is None
+
+    def drain(self):
+        """
+        Ask the worker to finish the calls in flight and exit
+        """
+
+        if self.drain_started is None and self.running:
+            self.drain_started = time.time()
+            self.process.send_signal(signal.SIGUSR1)
+
+    def stop(self):
+
+        if self.running:
+            self.process.terminate()
+
+
+class SupervisorSession(ComponentSession):
+    """
+    Scale the number of roundrobin workers with their latency and backlog
+    """
+
+    def authorize_request(self, uri, claims):
+        return True
+
+    def on_run(self):
+
+        self.workers = {}
+        self.started = 0
+        self.last_scaled = 0.0
+
+        for _ in range(MIN_WORKERS):
+            self.start_worker()
+
+        self.subscribe(self.on_load, LOAD_TOPIC)
+        self.scaler = LoopingCall(self.scale)
+        self.scaler.start(SCALE_INTERVAL, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.drain_workers)
+
+    def on_load(self, load):
+
+        worker = self.workers.get(load['instance'])
+        if worker is not None:
+            worker.load = load
+
+    def start_worker(self):
+
+        self.started += 1
+        instance = 'w{0}p{1}'.format(self.started, os.getpid())
+        self.workers[instance] = Worker(instance)
+        self.log.info('Started roundrobin worker {0}'.format(instance))
+
+    def active_workers(self):
+        """
+        Workers that are running and not draining
+        """
+
+        return [worker for worker in self.workers.values() if worker.running and worker.drain_started is None]
+
+    def reap(self):
+        """
+        Remove exited workers and terminate workers that did not drain in time
+        """
+
+        for instance, worker in list(self.workers.items()):
+            if not worker.running:
+                if worker.drain_started is None:
+                    self.log.warn('Roundrobin worker {0} exited with code {1}'.format(
+                        instance, worker.process.returncode))
+                del self.workers[instance]
+            elif worker.drain_started is not None and time.time() - worker.drain_started > DRAIN_TIMEOUT:
+                self.log.warn('Roundrobin worker {0} did not drain in time, terminating'.format(instance))
+                worker.stop()
+
+    def scale(self):
+
+        self.reap()
+        workers = self.active_workers()
+        while len(workers) < MIN_WORKERS:
+            self.start_worker()
+            workers = self.active_workers()
+
+        # Only decide on recent load reports of all active workers
+        now = time.time()
+        loads = [worker.load for worker in workers
+                 if worker.load is not None and now - worker.load['time'] < 3 * LOAD_INTERVAL]
+        if not loads or len(loads) < len(workers) or now - self.last_scaled < SCALE_COOLDOWN:
+            return
+
+        change, worker = scaling_decision(workers, now)
+        backlog = sum(load['queued'] for load in loads)
+        latency = sum(load['latency'] for load in loads) / len(loads)
+        if change > 0:
+            self.log.info('Backlog {0}, latency {1:.1f} s: adding a worker'.format(backlog, latency))
+            self.start_worker()
+            self.last_scaled = now
+        elif change < 0:
+            self.log.info('Backlog {0}, latency {1:.1f} s: retiring worker {2}'.format(
+                backlog, latency, worker.instance))
+            worker.drain()
+            self.last_scaled = now
+
+    def drain_workers(self):
+        """
+        Drain all workers on shutdown, terminate those that do not exit in time
+
+        :return: Deferred firing when all workers stopped, delays the
+                 reactor shutdown until then
+        """
+
+        if self.scaler.running:
+            self.scaler.stop()
+        for worker in self.workers.values():
+            worker.drain()
+
+        deadline = time.time() + DRAIN_TIMEOUT
+
+        def check():
+            if time.time() > deadline or not any(worker.running for worker in self.workers.values()):
+                for worker in self.workers.values():
+                    worker.stop()
+                poller.stop()
+
+        poller = LoopingCall(check)
+        return poller.start(LOAD_INTERVAL)
+
+
+if __name__ == '__main__':
+    check_limits()
+    main(SupervisorSession, daily_log=False)
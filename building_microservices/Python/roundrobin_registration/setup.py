@@ -16,6 +16,7 @@ setup(
     packages=find_packages(),
     package_data={distribution_name: ['schemas/*', 'schemas/endpoints/*']},
     py_modules=[distribution_name],
+    install_requires=['endpoint_tools'],
     test_suite="tests",
     include_package_data=True,
     zip_safe=True,
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the least-loaded dispatching of roundrobin calls
+"""
+
+import time
+
+from dispatcher import LeastLoadedDispatcher, ROUNDROBIN_URI
+
+
+def load(instance, in_flight=0, draining=False):
+
+    return {'instance': instance, 'uri': '{0}.{1}'.format(ROUNDROBIN_URI, instance), 'in_flight': in_flight,
+            'draining': draining, 'time': time.time()}
+
+
+def test_choose_least_loaded():
+
+    dispatcher = LeastLoadedDispatcher(session=None)
+    dispatcher.on_load(load('w1', in_flight=2))
+    dispatcher.on_load(load('w2', in_flight=1))
+
+    assert dispatcher.choose() == '{0}.w2'.format(ROUNDROBIN_URI)
+
+
+def test_skip_draining_instance():
+
+    dispatcher = LeastLoadedDispatcher(session=None)
+    dispatcher.on_load(load('w1', in_flight=2))
+    dispatcher.on_load(load('w2', draining=True))
+
+    assert dispatcher.choose() == '{0}.w1'.format(ROUNDROBIN_URI)
+
+    dispatcher.on_load(load('w1', draining=True))
+    assert dispatcher.choose() == ROUNDROBIN_URI
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the scaling decisions of the roundrobin supervisor
+"""
+
+import time
+
+import pytest
+
+from roundrobin import supervisor
+from roundrobin.application import DELAY
+
+
+class FakeWorker(object):
+
+    def __init__(self, instance, in_flight=0, queued=0, latency=float(DELAY), idle_for=0.0):
+
+        now = time.time()
+        self.instance = instance
+        self.load = {'instance': instance, 'in_flight': in_flight, 'queued': queued, 'latency': latency,
+                     'last_completed': now - idle_for, 'time': now}
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+
+    monkeypatch.setattr(supervisor, 'MIN_WORKERS', 1)
+    monkeypatch.setattr(supervisor, 'MAX_WORKERS', 4)
+    monkeypatch.setattr(supervisor, 'TARGET_LATENCY', 10.0)
+    monkeypatch.setattr(supervisor, 'MAX_BACKLOG', 1)
+    monkeypatch.setattr(supervisor, 'IDLE_TIMEOUT', 30.0)
+
+
+def test_retire_idle_worker():
+
+    # The latency of the last calls stays at the job duration while idle
+    workers = [FakeWorker('w1', in_flight=1, idle_for=1.0), FakeWorker('w2', idle_for=60.0)]
+    change, worker = supervisor.scaling_decision(workers, time.time())
+
+    assert change == -1
+    assert worker.instance == 'w2'
+
+
+def test_retire_longest_idle_worker():
+
+    workers = [FakeWorker('w1', idle_for=40.0), FakeWorker('w2', idle_for=90.0), FakeWorker('w3', idle_for=60.0)]
+    change, worker = supervisor.scaling_decision(workers, time.time())
+
+    assert change == -1
+    assert worker.instance == 'w2'
+
+
+def test_keep_recently_used_workers():
+
+    workers = [FakeWorker('w1', idle_for=1.0), FakeWorker('w2', in_flight=1, idle_for=5.0)]
+    assert supervisor.scaling_decision(workers, time.time()) == (0, None)
+
+
+def test_keep_minimum_workers():
+
+    workers = [FakeWorker('w1', idle_for=600.0)]
+    assert supervisor.scaling_decision(workers, time.time()) == (0, None)
+
+
+def test_no_retire_with_backlog():
+
+    workers = [FakeWorker('w1', in_flight=2, queued=1), FakeWorker('w2', idle_for=60.0)]
+    assert supervisor.scaling_decision(workers, time.time()) == (0, None)
+
+
+def test_retire_on_low_latency():
+
+    workers = [FakeWorker('w1', latency=1.0, idle_for=1.0), FakeWorker('w2', in_flight=1, latency=1.0)]
+    change, worker = supervisor.scaling_decision(workers, time.time())
+
+    assert change == -1
+    assert worker.instance == 'w1'
+
+
+def test_add_worker_on_backlog():
+
+    workers = [FakeWorker('w1', in_flight=3, queued=2)]
+    assert supervisor.scaling_decision(workers, time.time()) == (1, None)
+
+
+def test_add_worker_on_latency_up_to_maximum(monkeypatch):
+
+    workers = [FakeWorker('w1', in_flight=1, latency=20.0)]
+    assert supervisor.scaling_decision(workers, time.time()) == (1, None)
+
+    monkeypatch.setattr(supervisor, 'MAX_WORKERS', 1)
+    assert supervisor.scaling_decision(workers, time.time()) == (0, None)
+
+
+def test_no_decision_without_workers():
+
+    assert supervisor.scaling_decision([], time.time()) == (0, None)
+
+
+def test_reject_minimum_below_one(monkeypatch):
+
+    supervisor.check_limits()
+
+    monkeypatch.setattr(supervisor, 'MIN_WORKERS', 0)
+    with pytest.raises(ValueError):
+        supervisor.check_limits()
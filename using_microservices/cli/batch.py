@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: batch.py
+
+Batch mode for calling MDStudio microservice endpoints.
+
+Where `mdstudio-cli` handles a single endpoint call per process, batch.py
+reads JSON-lines requests from a file or stdin and dispatches all of them
+using one authenticated MDStudio session with bounded concurrency. Results
+are written to stdout as JSON-lines in input or completion order.
+
+Every input line is a JSON object with the endpoint 'uri' and the 'request'
+dictionary. When the --uri option is used every line is the request itself.
+Lines that are not a JSON object or miss the 'uri' are reported with their
+line number and parse error like failed calls.
+Request string values starting with '@' are read from file as a 'path_file'
+object similar to file arguments of mdstudio-cli.
+
+Usage:
+
+    python batch.py --uri mdgroup.mdstudio_structures.endpoint.convert requests.jsonl
+    cat requests.jsonl | python batch.py --concurrency 32 --order completion
+"""
+
+import os
+import sys
+import json
+import argparse
+
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredSemaphore, DeferredList, maybeDeferred
+
+from mdstudio.deferred.chainable import chainable
+from mdstudio.component.session import ComponentSession
+from mdstudio.runner import main
+
+
+def parse_arguments(argv):
+    """
+    Parse batch specific command line arguments
+
+    Unknown arguments are returned to be handled by the MDStudio runner.
+    """
+
+    parser = argparse.ArgumentParser(description='Call MDStudio endpoints for JSON-lines batch requests')
+    parser.add_argument('input', nargs='?', default='-', help='JSON-lines request file, stdin by default')
+    parser.add_argument('-u', '--uri', default=None, help='endpoint uri used for all requests')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='maximum number of concurrent calls')
+    parser.add_argument('-o', '--order', choices=('input', 'completion'), default='input',
+                        help='order in which results are written')
+
+    return parser.parse_known_args(argv)
+
+
+def resolve_path_files(request):
+    """
+    Replace '@<file>' string values in a request by 'path_file' objects
+    """
+
+    for key, value in request.items():
+        if isinstance(value, dict):
+            resolve_path_files(value)
+        elif isinstance(value, str) and value.startswith('@'):
+            path = os.path.abspath(value[1:])
+            with open(path, 'r') as input_file:
+                request[key] = {'content': input_file.read(),
+                                'path': path,
+                                'extension': os.path.splitext(path)[1].lstrip('.')}
+
+    return request
+
+
+class BatchSession(ComponentSession):
+    """
+    MDStudio session dispatching JSON-lines requests to endpoints
+    """
+
+    options = None
+
+    def authorize_request(self, uri, claims):
+        return True
+
+    def parse_request(self, line):
+        """
+        Parse a batch input line into the endpoint uri and request
+
+        :raises ValueError: line is not a JSON object or misses the 'uri'
+        """
+
+        data = json.loads(line)
+        if not isinstance(data, dict):
+            raise ValueError('request is not a JSON object')
+
+        if self.options.uri:
+            return self.options.uri, data
+        if 'uri' not in data:
+            raise ValueError("request has no 'uri'")
+
+        return data['uri'], data.get('request', {})
+
+    def read_requests(self):
+        """
+        Lazily read (line number, uri, request, error) tuples from the batch
+        input, error is the parse error of a malformed line or None
+        """
+
+        handle = sys.stdin if self.options.input == '-' else open(self.options.input, 'r')
+        try:
+            for number, line in enumerate(handle, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+
+                try:
+                    uri, request = self.parse_request(line)
+                except ValueError as error:
+                    yield number, None, None, str(error)
+                else:
+                    yield number, uri, request, None
+        finally:
+            if handle is not sys.stdin:
+                handle.close()
+
+    def write_result(self, result):
+
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
+
+    def collect_result(self, result, position, outbox):
+        """
+        Write a call result, buffering out-of-order results in 'input' order
+        """
+
+        if self.options.order == 'completion':
+            self.write_result(result)
+            return
+
+        outbox['buffer'][position] = result
+        while outbox['next'] in outbox['buffer']:
+            self.write_result(outbox['buffer'].pop(outbox['next']))
+            outbox['next'] += 1
+
+    def dispatch(self, line, uri, request):
+        """
+        Call the endpoint for one request
+
+        :return: Deferred firing with the result or error for the request,
+                 never failing
+        """
+
+        def on_success(response):
+            return {'line': line, 'uri': uri, 'result': response}
+
+        def on_failure(failure):
+            return {'line': line, 'uri': uri, 'error': failure.getErrorMessage()}
+
+        response = maybeDeferred(lambda: self.call(uri, resolve_path_files(request)))
+        return response.addCallbacks(on_success, on_failure)
+
+    @chainable
+    def on_run(self):
+
+        semaphore = DeferredSemaphore(self.options.concurrency)
+        outbox = {'next': 0, 'buffer': {}}
+        active = set()
+
+        def done(result, call, position):
+            active.discard(call)
+            semaphore.release()
+            self.collect_result(result, position, outbox)
+
+        try:
+            for position, (line, uri, request, error) in enumerate(self.read_requests()):
+
+                # Malformed lines are reported like failed calls
+                if error is not None:
+                    self.collect_result({'line': line, 'error': error}, position, outbox)
+                    continue
+
+                # Bounded concurrency: wait for a free slot before reading on
+                yield semaphore.acquire()
+                call = self.dispatch(line, uri, request)
+                active.add(call)
+                call.addCallback(done, call, position)
+
+            yield DeferredList(list(active))
+        finally:
+            # Disconnect from broker and stop reactor event loop
+            self.disconnect()
+            reactor.stop()
+
+
+if __name__ == '__main__':
+
+    BatchSession.options, remaining = parse_arguments(sys.argv[1:])
+    sys.argv = sys.argv[:1] + remaining
+    main(BatchSession, daily_log=False)
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: docking_pool.py
+
+Batched rotate-and-dock using a local pool of PLANTS runs.
+
+The 'Create 3D rotations' task returns the ligand rotations as one
+multi-molecule mol2 file that the smartcyp docking endpoint docks in a
+single PLANTS run. `dock_rotations` instead splits the rotations and docks
+each in a separate PLANTS process, running in parallel, with its own
+scratch directory under `base_work_dir`. The poses of all runs are merged
+and clustered once using a vectorised pairwise RMSD matrix.
+
+The result has the same format as the docking endpoint output:
+
+    {'result': {pose id: {'PATH': pose mol2, 'TOTAL_SCORE': score,
+                          'CLUSTER': cluster number, 'MEAN': is median}}}
+
+or, by default, the paged format of workflow_tools.docking_index that keeps
+the result size independent of the number of poses.
+"""
+
+import os
+import csv
+import tempfile
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+from workflow_tools.docking_index import write_docking_index
+
+PLANTS_EXEC = os.environ.get('PLANTS_EXEC', 'plants')
+PLANTS_CONFIG = """scoring_function chemplp
+search_speed speed1
+protein_file {protein_file}
+ligand_file {ligand_file}
+output_dir {output_dir}
+write_multi_mol2 0
+bindingsite_center {center[0]} {center[1]} {center[2]}
+bindingsite_radius {radius}
+cluster_structures {cluster_structures}
+cluster_rmsd {threshold}
+"""
+
+
+def read_path_file(path_file):
+    """
+    Return the content of a path_file dictionary or file path
+    """
+
+    if isinstance(path_file, dict):
+        if path_file.get('content'):
+            return path_file['content']
+        path_file = path_file['path']
+
+    with open(path_file, 'r') as infile:
+        return infile.read()
+
+
+def split_mol2(content):
+    """
+    Split multi-molecule mol2 content into separate molecules
+
+    :param content: mol2 file content
+    :type content:  :py:str
+
+    :rtype:         :py:list
+    """
+
+    blocks = content.split('@<TRIPOS>MOLECULE')
+    return ['@<TRIPOS>MOLECULE' + block for block in blocks[1:] if block.strip()]
+
+
+def read_mol2_coordinates(path):
+    """
+    Read heavy atom coordinates of the first molecule in a mol2 file
+
+    :param path: mol2 file path
+    :type path:  :py:str
+
+    :return:     (atoms, 3) float64 array
+    """
+
+    coordinates = []
+    in_atoms = False
+    with open(path, 'r') as mol2:
+        for line in mol2:
+            if line.startswith('@<TRIPOS>'):
+                if in_atoms:
+                    break
+                in_atoms = line.startswith('@<TRIPOS>ATOM')
+                continue
+
+            fields = line.split()
+            if in_atoms and len(fields) >= 6 and not fields[5].startswith('H'):
+                coordinates.append(fields[2:5])
+
+    return numpy.array(coordinates, dtype=numpy.float64).reshape(-1, 3)
+
+
+def run_plants(ligand, protein_file, work_dir, center, radius, cluster_structures, threshold,
+               plants_exec=PLANTS_EXEC):
+    """
+    Dock one ligand rotation with PLANTS in its own work directory
+
+    :param ligand:       mol2 content of the ligand rotation
+    :type ligand:        :py:str
+    :param protein_file: protein mol2 file path
+    :type protein_file:  :py:str
+    :param work_dir:     scratch directory for this run
+    :type work_dir:      :py:str
+
+    :return:             (pose mol2 path, total score) tuples
+    :rtype:              :py:list
+    """
+
+    ligand_file = os.path.join(work_dir, 'ligand.mol2')
+    with open(ligand_file, 'w') as outfile:
+        outfile.write(ligand)
+
+    output_dir = os.path.join(work_dir, 'results')
+    config_file = os.path.join(work_dir, 'plants.config')
+    with open(config_file, 'w') as outfile:
+        outfile.write(PLANTS_CONFIG.format(protein_file=protein_file, ligand_file=ligand_file,
+                                           output_dir=output_dir, center=center, radius=radius,
+                                           cluster_structures=cluster_structures, threshold=threshold))
+
+    with open(os.path.join(work_dir, 'plants.log'), 'w') as log:
+        subprocess.check_call([plants_exec, '--mode', 'screen', config_file], cwd=work_dir,
+                              stdout=log, stderr=subprocess.STDOUT)
+
+    poses = []
+    with open(os.path.join(output_dir, 'ranking.csv'), 'r') as ranking:
+        for row in csv.DictReader(ranking):
+            poses.append((os.path.join(output_dir, '{0}.mol2'.format(row['LIGAND_ENTRY'])),
+                          float(row['TOTAL_SCORE'])))
+
+    return poses
+
+
+def rmsd_matrix(coordinates):
+    """
+    Pairwise RMSD between poses without superposition
+
+    Poses are docked in the same binding site frame so the RMSD is computed
+    on the coordinates as is, for all pairs at once using
+    |a - b|^2 = |a|^2 + |b|^2 - 2 a.b
+
+    :param coordinates: (poses, atoms, 3) array
+    :type coordinates:  :py:numpy.ndarray
+
+    :return:            (poses, poses) RMSD matrix
+    """
+
+    poses, atoms = coordinates.shape[:2]
+    flat = coordinates.reshape(poses, atoms * 3)
+    squared = numpy.einsum('ij,ij->i', flat, flat)
+    distances = squared[:, None] + squared[None, :] - 2.0 * flat.dot(flat.T)
+    numpy.maximum(distances, 0.0, out=distances)
+
+    return numpy.sqrt(distances / atoms)
+
+
+def cluster_poses(rmsd, scores, threshold):
+    """
+    Threshold clustering of poses
+
+    Taking the best scoring unclustered pose, all unclustered poses within
+    `threshold` RMSD of it form a new cluster. The cluster median is the
+    member with the lowest summed RMSD to the other members.
+
+    :param rmsd:      (poses, poses) RMSD matrix
+    :param scores:    pose scores, lower is better
+    :param threshold: cluster RMSD threshold
+    :type threshold:  :py:float
+
+    :return:          cluster number per pose and median pose indices
+    :rtype:           :py:tuple
+    """
+
+    clusters = numpy.full(len(scores), -1, dtype=numpy.int64)
+    medians = []
+    for pose in numpy.argsort(scores, kind='stable'):
+        if clusters[pose] >= 0:
+            continue
+
+        members = numpy.flatnonzero((clusters < 0) & (rmsd[pose] <= threshold))
+        clusters[members] = len(medians)
+        medians.append(members[numpy.argmin(rmsd[numpy.ix_(members, members)].sum(axis=1))])
+
+    return clusters, medians
+
+
+def dock_rotations(ligand_file=None, protein_file=None, bindingsite_center=None, bindingsite_radius=12,
+                   cluster_structures=100, threshold=3.0, base_work_dir='/tmp/mdstudio/mdstudio_smartcyp',
+                   max_workers=None, paged=True, **kwargs):
+    """
+    Dock all ligand rotations in parallel PLANTS runs and cluster the merged
+    poses.
+
+    Accepts the input of the smartcyp docking endpoint. `ligand_file` is the
+    multi-molecule mol2 output of the rotate endpoint. Like the ligand, the
+    `protein_file` may be a path_file dictionary or a file path, it is
+    written once to the work directory shared by all PLANTS runs.
+
+    :param max_workers: number of parallel PLANTS runs, defaults to the
+                        number of rotations capped at the number of CPUs
+    :type max_workers:  :py:int
+    :param paged:       return the result in paged format
+    :type paged:        :py:bool
+
+    :return:            docking result in docking endpoint or paged format
+    :rtype:             :py:dict
+    """
+
+    rotations = split_mol2(read_path_file(ligand_file))
+    if not rotations:
+        raise ValueError('No ligand structures to dock')
+
+    if not os.path.exists(base_work_dir):
+        os.makedirs(base_work_dir)
+    work_dir = tempfile.mkdtemp(prefix='docking-', dir=base_work_dir)
+
+    protein = os.path.join(work_dir, 'protein.mol2')
+    with open(protein, 'w') as outfile:
+        outfile.write(read_path_file(protein_file))
+
+    def dock(index):
+        run_dir = os.path.join(work_dir, 'rotation-{0}'.format(index))
+        os.mkdir(run_dir)
+        return run_plants(rotations[index], protein, run_dir, bindingsite_center, bindingsite_radius,
+                          cluster_structures, threshold)
+
+    workers = max_workers or min(len(rotations), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        runs = list(executor.map(dock, range(len(rotations))))
+
+    poses = [(index, path, score) for index, run in enumerate(runs) for path, score in run]
+    result = []
+    if poses:
+        scores = numpy.array([score for _, _, score in poses])
+        rmsd = rmsd_matrix(numpy.stack([read_mol2_coordinates(path) for _, path, _ in poses]))
+        clusters, medians = cluster_poses(rmsd, scores, threshold)
+        medians = set(medians)
+
+        for pose, (index, path, score) in enumerate(poses):
+            pose_id = 'rotation-{0}-{1}'.format(index, os.path.splitext(os.path.basename(path))[0])
+            result.append((pose_id, {'PATH': path, 'TOTAL_SCORE': score, 'CLUSTER': int(clusters[pose]),
+                                     'MEAN': pose in medians}))
+
+    if paged:
+        return {'result': write_docking_index(result, work_dir)}
+
+    return {'result': dict(result)}
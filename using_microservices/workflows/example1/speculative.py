@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: speculative.py
+
+Speculative parallel endpoint calls.
+
+Some endpoints, like the 3D coordinate generation of make3d, fail at random.
+Retrying them in sequence adds the full latency of every failed attempt.
+A speculative call instead launches k attempts at once, optionally each
+with a different random seed, which a round-robin registered service
+spreads over its instances. The first valid response is used and the
+remaining attempts are cancelled.
+
+How often each attempt (seed path) wins is recorded per endpoint uri in
+`speculation_stats` to tune k: if attempt 0 nearly always wins k can be
+lowered, if later attempts win often the endpoint fails a lot.
+"""
+
+import copy
+import random
+
+from twisted.internet.defer import Deferred
+
+
+def has_structure(response):
+    """
+    Default response validation: a non-empty 'mol' path_file
+    """
+
+    mol = response.get('mol') if isinstance(response, dict) else None
+    return bool(mol and (mol.get('content') or mol.get('path')))
+
+
+class SpeculativePolicy(object):
+    """
+    Speculative call policy for an endpoint
+
+    :param attempts: number of parallel attempts (k)
+    :type attempts:  :py:int
+    :param seed_arg: request parameter to set a different random seed in
+                     for every attempt, None to send identical requests
+    :type seed_arg:  :py:str
+    :param validate: function returning True for a valid response
+    :type validate:  :py:func
+    """
+
+    def __init__(self, attempts=3, seed_arg=None, validate=has_structure):
+
+        self.attempts = attempts
+        self.seed_arg = seed_arg
+        self.validate = validate
+
+    def requests(self, request):
+        """
+        Build the request for every attempt, each attempt gets its own copy
+        """
+
+        if not self.seed_arg:
+            return [dict(request) for _ in range(self.attempts)]
+
+        requests = []
+        for _ in range(self.attempts):
+            attempt = copy.deepcopy(request)
+            attempt[self.seed_arg] = random.randint(1, 2 ** 31 - 1)
+            requests.append(attempt)
+
+        return requests
+
+
+def speculate(call, requests, validate):
+    """
+    Make all calls at once, fire with the first valid response
+
+    :param call:     function making a call for a request, returns Deferred
+    :param requests: request for every attempt
+    :param validate: function returning True for a valid response
+
+    :return:         Deferred firing with a (response, winning attempt)
+                     tuple, fails when no attempt gave a valid response
+    """
+
+    result = Deferred()
+    calls = []
+    finished = set()
+
+    def on_done(outcome, index):
+        finished.add(index)
+        if result.called:
+            return
+
+        if not isinstance(outcome, Exception) and validate(outcome):
+            result.callback((outcome, index))
+            for other, deferred in enumerate(calls):
+                if other not in finished:
+                    deferred.cancel()
+        elif len(finished) == len(requests):
+            if isinstance(outcome, Exception):
+                result.errback(outcome)
+            else:
+                result.errback(ValueError('No valid response in {0} speculative attempts'.format(len(requests))))
+
+    for index, request in enumerate(requests):
+        deferred = call(request)
+        calls.append(deferred)
+        deferred.addCallbacks(on_done, lambda failure, i: on_done(failure.value, i),
+                              callbackArgs=(index,), errbackArgs=(index,))
+
+    return result
+
+
+class SpeculativeSessionMixin(object):
+    """
+    Session mixin making speculative calls for the endpoint uris listed in
+    `speculative_calls`, a mapping of uri to SpeculativePolicy
+    """
+
+    speculative_calls = {}
+    speculation_stats = None
+
+    def call(self, procedure, request, *args, **kwargs):
+
+        policy = self.speculative_calls.get(procedure)
+        parent = super(SpeculativeSessionMixin, self)
+        if policy is None:
+            return parent.call(procedure, request, *args, **kwargs)
+
+        if self.speculation_stats is None:
+            self.speculation_stats = {}
+        stats = self.speculation_stats.setdefault(procedure, {'calls': 0, 'failed': 0,
+                                                              'wins': [0] * policy.attempts})
+        stats['calls'] += 1
+
+        def on_win(outcome):
+            response, index = outcome
+            stats['wins'][index] += 1
+            return response
+
+        def on_failure(failure):
+            stats['failed'] += 1
+            return failure
+
+        deferred = speculate(lambda attempt: parent.call(procedure, attempt, *args, **kwargs),
+                             policy.requests(request), policy.validate)
+        return deferred.addCallbacks(on_win, on_failure)
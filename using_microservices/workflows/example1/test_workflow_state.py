@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: test_workflow_state.py
+
+Tests for the compact workflow state format
+"""
+
+import os
+import json
+
+from workflow_state import WorkflowState, save_state, save_workflow_state, convert_jgf
+
+GRAPH = {
+    'graph': {
+        'nodes': {
+            '1': {'task_name': 'Format_conversion',
+                  'input': {'mol': {'content': 'C', 'path': None, 'extension': 'smi'}}},
+            '2': {'task_name': 'Make_3D', 'output': {'mol': {'content': 'x' * 10000, 'path': None}},
+                  'retry_count': None, 'tags': [None, 'mol2', 12]}
+        },
+        'edges': [{'source': 1, 'target': 2, 'data': None}]
+    }
+}
+
+
+class FakeWorkflow(object):
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def save(self, path=None):
+        return json.dumps(self.graph)
+
+
+def test_resolve_null_values(tmp_path):
+
+    path = str(tmp_path / 'workflow.state')
+    save_state({'mol': {'content': 'C', 'path': None}}, path)
+
+    state = WorkflowState(path)
+    assert state.resolve() == {'mol': {'content': 'C', 'path': None}}
+    assert state.resolve(None) is None
+
+
+def test_roundtrip_out_of_line_values(tmp_path):
+
+    path = str(tmp_path / 'workflow.state')
+    save_state(GRAPH, path, threshold=100)
+
+    state = WorkflowState(path)
+    output = state.structure['graph']['nodes']['2']['output']['mol']['content']
+    assert WorkflowState.is_reference(output)
+    assert state.value(output) == 'x' * 10000
+    assert state.resolve() == GRAPH
+
+
+def test_save_workflow_state(tmp_path):
+
+    path = str(tmp_path / 'workflow.state')
+    save_workflow_state(FakeWorkflow(GRAPH), path)
+
+    assert os.listdir(str(tmp_path)) == ['workflow.state']
+    assert WorkflowState(path).resolve() == GRAPH
+
+
+def test_convert_jgf(tmp_path):
+
+    jgf_path = str(tmp_path / 'workflow.jgf')
+    with open(jgf_path, 'w') as jgf:
+        json.dump(GRAPH, jgf)
+
+    state_path = convert_jgf(jgf_path)
+    assert state_path == str(tmp_path / 'workflow.state')
+
+    jgf_copy = str(tmp_path / 'copy.jgf')
+    WorkflowState(state_path).to_jgf(jgf_copy)
+    with open(jgf_copy, 'r') as jgf:
+        assert json.load(jgf) == GRAPH
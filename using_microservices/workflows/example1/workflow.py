@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+
+# Shared workflow_tools package, used from the source tree when not installed
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow_tools'))
 
 from autobahn.twisted.util import sleep
 
@@ -8,10 +12,13 @@ from mdstudio.deferred.chainable import chainable
 from mdstudio.component.session import ComponentSession
 from mdstudio.runner import main
 
-from mdstudio_workflow import Workflow
+from speculative import SpeculativePolicy, SpeculativeSessionMixin
+from workflow_state import save_workflow_state
+from workflow_tools.dedup_helpers import deduplicate_smiles
+from workflow_tools.retry_policy import RetrySessionMixin, RetryPolicy
 
 
-class ExampleWorkflow(ComponentSession):
+class ExampleWorkflow(RetrySessionMixin, SpeculativeSessionMixin, ComponentSession):
     """
     Workflow manager example workflow
 
@@ -31,8 +38,19 @@ class ExampleWorkflow(ComponentSession):
     * Run the specifications for a few different ligands in sequence.
     * See how the workflow manager collects all task input and output locally
       in a structures project directory.
+    * Make speculative parallel calls for an endpoint that fails at random.
     """
 
+    # Launch 3 parallel make3d attempts and use the first valid structure
+    speculative_calls = {'mdgroup.mdstudio_structures.endpoint.make3d': SpeculativePolicy(attempts=3)}
+
+    # Retry transient errors, such as broker timeouts, with backoff. Random
+    # make3d failures are covered by the speculative attempts.
+    retry_policies = {
+        'mdgroup.mdstudio_structures.endpoint.make3d': RetryPolicy(max_attempts=3),
+        'mdgroup.mdstudio_smartcyp.endpoint.docking': RetryPolicy(max_attempts=3)
+    }
+
     def authorize_request(self, uri, claims):
         """
         Microservice specific authorization method.
@@ -50,6 +68,8 @@ class ExampleWorkflow(ComponentSession):
         We are using this method now to run our example workflow.
         """
 
+        from mdstudio_workflow import Workflow
+
         # Workflow constants, these will be saved as part of the workflow
         # specification
         ligand_format = 'smi'
@@ -57,6 +77,10 @@ class ExampleWorkflow(ComponentSession):
         protein_file = os.path.abspath('protein.mol2')
         protein_binding_center = [4.9264, 19.0796, 21.9892]
 
+        # Dock the ligand rotations in parallel local PLANTS runs instead of
+        # using the smartcyp docking microservice (requires PLANTS locally).
+        local_docking = False
+
         # Build Workflow
         wf = Workflow(description='MDStudio WAMP workflow')
 
@@ -76,13 +100,13 @@ class ExampleWorkflow(ComponentSession):
         t1.set_input(output_format='mol2')
 
         # Task 2: Covert mol2 to 3D mol2 irrespective if input is 1D/2D or 3D mol2
-        # This particular 3D conversion routine is known to fail sometimes but by
-        # setting retry_count to 3 the workflow manager will retry 3 times before
-        # failing.
+        # This particular 3D conversion routine is known to fail sometimes.
+        # Instead of retrying in sequence every call is made as 3 parallel
+        # attempts (see 'speculative_calls') and the first valid structure is
+        # used. Transient errors are retried using 'retry_policies'.
         t2 = wf.add_task('Make_3D',
                          task_type='WampTask',
-                         uri='mdgroup.mdstudio_structures.endpoint.make3d',
-                         retry_count=3)
+                         uri='mdgroup.mdstudio_structures.endpoint.make3d')
         t2.set_input(output_format='mol2')
 
         # Use 'connect_task' to connect t1 to t2 using their unique identifiers
@@ -123,9 +147,16 @@ class ExampleWorkflow(ComponentSession):
         # Task 6: Run PLANTS on ligand and protein
         # The 'workdir' argument points to a tmp directory that is shared between
         # the microservice docker image and the host system to store results.
-        t6 = wf.add_task('Plants docking',
-                         task_type='WampTask',
-                         uri='mdgroup.mdstudio_smartcyp.endpoint.docking')
+        # In local mode every rotation is docked in a separate PLANTS run with
+        # its own scratch directory and all poses are clustered together.
+        if local_docking:
+            t6 = wf.add_task('Plants docking',
+                             task_type='PythonTask',
+                             custom_func='docking_pool.dock_rotations')
+        else:
+            t6 = wf.add_task('Plants docking',
+                             task_type='WampTask',
+                             uri='mdgroup.mdstudio_smartcyp.endpoint.docking')
         t6.set_input(cluster_structures=100,
                      bindingsite_center=protein_binding_center,
                      bindingsite_radius=12,
@@ -163,18 +194,39 @@ class ExampleWorkflow(ComponentSession):
         # it will be used to make calls to other microservice endpoints when task_type equals WampTask.
         wf.task_runner = self
 
+        # Equivalent SMILES (another atom order or stereo notation) are run
+        # only once, duplicates refer to the project directory of the first.
+        ligands = ['O1[C@@H](CCC1=O)CCC',
+                   'C[C@]12CC[C@H]3[C@@H](CC=C4CCCC[C@]34CO)[C@@H]1CCC2=O',
+                   'CC12CCC3C(CC=C4C=CCCC34C)C1CCC2=O']
+        dedup = deduplicate_smiles(smiles=ligands)
+        self.log.info('{0} unique ligands in {1} SMILES using {2}, dedup ratio {3:.2f}'.format(
+            len(dedup['smiles']), len(ligands), dedup['canonicalizer'], dedup['dedup_ratio']))
+
         currdir = os.getcwd()
-        for i, ligand in enumerate(['O1[C@@H](CCC1=O)CCC',
-                                    'C[C@]12CC[C@H]3[C@@H](CC=C4CCCC[C@]34CO)[C@@H]1CCC2=O',
-                                    'CC12CCC3C(CC=C4C=CCCC34C)C1CCC2=O'], start=1):
-            wf.load('workflow_spec.jgf')
+        project_dirs = [os.path.join(currdir, 'ligand-{0}'.format(ligands.index(ligand) + 1))
+                        for ligand in dedup['smiles']]
+        for ligand, project_dir in zip(dedup['smiles'], project_dirs):
+            wf.load(os.path.join(currdir, 'workflow_spec.jgf'))
             wf.input(t1.nid, mol={'content': ligand, 'path': None, 'extension': ligand_format})
-            wf.run(project_dir='./ligand-{0}'.format(i))
+            wf.run(project_dir=project_dir)
             while wf.is_running:
                 yield sleep(1)
 
+            # Save the final workflow state including the in-memory output of
+            # tasks such as 'Get charge'. The compact state (*.state) holds
+            # large output out-of-line and loads the graph structure fast.
+            save_workflow_state(wf, os.path.join(project_dir, 'workflow.state'))
+
             os.chdir(currdir)
 
+        for i, unique in enumerate(dedup['index_map'], start=1):
+            self.log.info('ligand-{0}: results in {1}'.format(i, project_dirs[unique]))
+
+        # Wins per attempt, if attempt 0 nearly always wins fewer attempts do
+        self.log.info('Speculative call statistics: {stats}', stats=self.speculation_stats)
+        self.log.info('Retry statistics: {stats}', stats=self.retry_stats)
+
 
 if __name__ == "__main__":
     main(ExampleWorkflow, auto_reconnect=False, daily_log=False)
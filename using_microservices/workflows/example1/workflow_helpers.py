@@ -6,6 +6,8 @@ file: workflow_helpers.py
 Helper Python functions used in the example1 workflow.
 """
 
+from workflow_tools.docking_index import is_paged, iter_docking_index, fetch_pose
+
 
 def get_docking_medians(**kwargs):
     """
@@ -17,6 +19,11 @@ def get_docking_medians(**kwargs):
     :return:
     """
 
-    medians = [v.get('PATH') for v in kwargs.get('result', {}).values() if v.get('MEAN', True)]
+    result = kwargs.get('result', {})
+    if is_paged(result):
+        # Stream the index and extract the median structures only
+        medians = [fetch_pose(result, entry) for entry in iter_docking_index(result) if entry['mean']]
+    else:
+        medians = [v.get('PATH') for v in result.values() if v.get('MEAN', True)]
 
     return {'medians': medians}
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: workflow_state.py
+
+Compact binary workflow state serialization.
+
+The workflow manager saves a workflow specification or state as JSON graph
+(*.jgf). When tasks keep their output in memory (store_output=False) and for
+LoopTask workflows with many iterations these files grow large and have to
+be parsed completely even if only the graph structure is needed.
+
+The compact state format stores the graph with msgpack (JSON if msgpack is
+not installed) and holds large string values, such as inlined structure
+files, out-of-line in a separate section of the same file:
+
+    MDWFSTATE | version (1 byte) | codec (1 byte) | structure size (8 bytes)
+    structure | out-of-line values
+
+Out-of-line values are replaced in the structure by {'$out': [offset, size]}
+references. WorkflowState reads only the structure when opened and loads a
+value when it is requested.
+
+Save a running workflow with `save_workflow_state`, existing JSON graph
+files are converted with `convert_jgf`.
+
+Usage:
+
+    python workflow_state.py workflow_spec.jgf   # convert and benchmark
+"""
+
+import os
+import sys
+import json
+import time
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MAGIC = b'MDWFSTATE'
+VERSION = 1
+CODEC_JSON = 0
+CODEC_MSGPACK = 1
+HEADER = struct.Struct('<BBQ')
+DEFAULT_THRESHOLD = 4096
+
+# Default for `WorkflowState.resolve`, None is a valid value in the state
+_ROOT = object()
+
+
+def _encode(data, codec):
+
+    if codec == CODEC_MSGPACK:
+        return msgpack.packb(data, use_bin_type=True)
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def _decode(raw, codec):
+
+    if codec == CODEC_MSGPACK:
+        return msgpack.unpackb(raw, raw=False)
+    return json.loads(raw.decode('utf-8'))
+
+
+def save_state(graph, path, threshold=DEFAULT_THRESHOLD):
+    """
+    Save a workflow graph dictionary in compact state format
+
+    :param graph:     workflow graph as loaded from a JSON graph (*.jgf) file
+    :type graph:      :py:dict
+    :param path:      compact state file path
+    :type path:       :py:str
+    :param threshold: strings longer than this are stored out-of-line
+    :type threshold:  :py:int
+
+    :return:          compact state file size in bytes
+    :rtype:           :py:int
+    """
+
+    codec = CODEC_MSGPACK if msgpack is not None else CODEC_JSON
+    values = []
+    offset = [0]
+
+    def hold_out(data):
+        if isinstance(data, dict):
+            return dict((key, hold_out(value)) for key, value in data.items())
+        if isinstance(data, list):
+            return [hold_out(value) for value in data]
+        if isinstance(data, str) and len(data) > threshold:
+            raw = _encode(data, codec)
+            values.append(raw)
+            reference = {'$out': [offset[0], len(raw)]}
+            offset[0] += len(raw)
+            return reference
+        return data
+
+    structure = _encode(hold_out(graph), codec)
+    with open(path + '.tmp', 'wb') as state:
+        state.write(MAGIC)
+        state.write(HEADER.pack(VERSION, codec, len(structure)))
+        state.write(structure)
+        for raw in values:
+            state.write(raw)
+    os.rename(path + '.tmp', path)
+
+    return os.path.getsize(path)
+
+
+def save_workflow_state(workflow, path, threshold=DEFAULT_THRESHOLD):
+    """
+    Save the current state of a workflow in compact state format
+
+    Only the compact state file is written. The workflow manager exports
+    its graph as JSON graph string which is decoded in memory, no
+    intermediate JSON graph (*.jgf) file is written and read back.
+
+    :param workflow:  workflow to save
+    :type workflow:   :mdstudio_workflow:Workflow
+    :param path:      compact state file path
+    :type path:       :py:str
+    :param threshold: strings longer than this are stored out-of-line
+    :type threshold:  :py:int
+
+    :return:          compact state file size in bytes
+    :rtype:           :py:int
+    """
+
+    return save_state(json.loads(workflow.save()), path, threshold=threshold)
+
+
+def convert_jgf(jgf_path, state_path=None, threshold=DEFAULT_THRESHOLD):
+    """
+    Convert a JSON graph (*.jgf) file to compact state format
+
+    :param jgf_path:   JSON graph file
+    :type jgf_path:    :py:str
+    :param state_path: compact state file, defaults to <jgf_path>.state
+    :type state_path:  :py:str
+
+    :return:           compact state file path
+    :rtype:            :py:str
+    """
+
+    state_path = state_path or os.path.splitext(jgf_path)[0] + '.state'
+    with open(jgf_path, 'r') as jgf:
+        save_state(json.load(jgf), state_path, threshold=threshold)
+
+    return state_path
+
+
+class WorkflowState(object):
+    """
+    Lazy reader for compact workflow state files
+
+    Opening a state reads the graph structure only. Out-of-line values are
+    read when requested using `value` or `resolve`.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        with open(path, 'rb') as state:
+            if state.read(len(MAGIC)) != MAGIC:
+                raise IOError('Not a compact workflow state file: {0}'.format(path))
+
+            version, self.codec, size = HEADER.unpack(state.read(HEADER.size))
+            if version != VERSION:
+                raise IOError('Unsupported workflow state version {0}: {1}'.format(version, path))
+            if self.codec == CODEC_MSGPACK and msgpack is None:
+                raise ImportError('msgpack is required to read {0}'.format(path))
+
+            self.structure = _decode(state.read(size), self.codec)
+            self._values_offset = len(MAGIC) + HEADER.size + size
+
+    @staticmethod
+    def is_reference(data):
+
+        return isinstance(data, dict) and len(data) == 1 and '$out' in data
+
+    def value(self, reference):
+        """
+        Load an out-of-line value
+
+        :param reference: {'$out': [offset, size]} reference
+        :type reference:  :py:dict
+        """
+
+        offset, size = reference['$out']
+        with open(self.path, 'rb') as state:
+            state.seek(self._values_offset + offset)
+            return _decode(state.read(size), self.codec)
+
+    def resolve(self, data=_ROOT):
+        """
+        Return data, by default the whole graph, with all out-of-line values
+        loaded
+
+        :param data: part of the state structure
+        """
+
+        data = self.structure if data is _ROOT else data
+        if self.is_reference(data):
+            return self.value(data)
+        if isinstance(data, dict):
+            return dict((key, self.resolve(value)) for key, value in data.items())
+        if isinstance(data, list):
+            return [self.resolve(value) for value in data]
+        return data
+
+    def to_jgf(self, jgf_path):
+        """
+        Write the full state as JSON graph (*.jgf) file loadable by the
+        workflow manager
+        """
+
+        with open(jgf_path, 'w') as jgf:
+            json.dump(self.resolve(), jgf)
+
+
+def benchmark(jgf_path, repeat=5):
+    """
+    Compare save, load and size of the JSON graph and compact state format
+
+    :param jgf_path: JSON graph file to benchmark with
+    :type jgf_path:  :py:str
+    :param repeat:   number of repetitions, the best time is reported
+    :type repeat:    :py:int
+
+    :rtype:          :py:dict
+    """
+
+    def best(func):
+        times = []
+        for _ in range(repeat):
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+        return min(times)
+
+    with open(jgf_path, 'r') as jgf:
+        graph = json.load(jgf)
+
+    state_path = jgf_path + '.bench.state'
+    json_path = jgf_path + '.bench.jgf'
+
+    def save_json():
+        with open(json_path, 'w') as jgf:
+            json.dump(graph, jgf)
+
+    def load_json():
+        with open(json_path, 'r') as jgf:
+            json.load(jgf)
+
+    results = {
+        'json': {'save': best(save_json), 'load': best(load_json)},
+        'state': {'save': best(lambda: save_state(graph, state_path)),
+                  'load': best(lambda: WorkflowState(state_path)),
+                  'load_full': best(lambda: WorkflowState(state_path).resolve())}
+    }
+    results['json']['size'] = os.path.getsize(json_path)
+    results['state']['size'] = os.path.getsize(state_path)
+    results['state']['codec'] = 'msgpack' if msgpack is not None else 'json'
+
+    os.remove(state_path)
+    os.remove(json_path)
+
+    return results
+
+
+if __name__ == '__main__':
+
+    for jgf_file in sys.argv[1:]:
+        result = benchmark(jgf_file)
+        print('{0} (compact codec: {1})'.format(jgf_file, result['state']['codec']))
+        print('{0:>20} {1:>12} {2:>12} {3:>12}'.format('', 'size (B)', 'save (ms)', 'load (ms)'))
+        print('{0:>20} {1:>12} {2:>12.2f} {3:>12.2f}'.format('json', result['json']['size'],
+                                                             result['json']['save'] * 1000,
+                                                             result['json']['load'] * 1000))
+        print('{0:>20} {1:>12} {2:>12.2f} {3:>12.2f}'.format('compact (structure)', result['state']['size'],
+                                                             result['state']['save'] * 1000,
+                                                             result['state']['load'] * 1000))
+        print('{0:>20} {1:>12} {2:>12} {3:>12.2f}'.format('compact (full)', '', '',
+                                                          result['state']['load_full'] * 1000))
@@ -10,11 +10,118 @@ from mdstudio.deferred.chainable import chainable
 from mdstudio.component.session import ComponentSession
 from mdstudio.runner import main
 
-from lie_workflow import Workflow
-
 CURRDIR = os.getcwd()
 
 
+def build_workflow(wf, ligands, bound_trajectory, unbound_trajectory, decompose_files, modelpicklefile, modelfile,
+                   work_dir='/tmp/mdstudio/lie_pylie', do_plot=True):
+    """
+    Add the LIE prediction tasks to a workflow
+
+    Used by the LIEPredictionWorkflow and by benchmark_lie.py to run the
+    same workflow offline.
+
+    :param wf:                 workflow to add the tasks to
+    :type wf:                  :lie_workflow:Workflow
+    :param ligands:            SMILES of the ligands to predict for
+    :type ligands:             :py:list
+    :param bound_trajectory:   bound ligand energy trajectory files
+    :type bound_trajectory:    :py:list
+    :param unbound_trajectory: unbound ligand energy trajectory file(s)
+    :type unbound_trajectory:  :py:str or :py:list
+    :param decompose_files:    residue decomposition files
+    :type decompose_files:     :py:list
+    :param modelpicklefile:    pre-calibrated model pickle file
+    :type modelpicklefile:     :py:str
+    :param modelfile:          loaded pre-calibrated model
+    :type modelfile:           :py:dict
+    :param work_dir:           lie_pylie work directory
+    :type work_dir:            :py:str
+    :param do_plot:            plot the stable trajectory regions
+    :type do_plot:             :py:bool
+
+    :return:                   the workflow
+    """
+
+    # STAGE 5. PYLIE FILTERING, AD ANALYSIS AND BINDING-AFFINITY PREDICTION
+    # Workflow input, forwarded to the tasks using it
+    t16 = wf.add_task('Workflow input')
+    t16.set_input(ligands=ligands,
+                  unbound_trajectory=unbound_trajectory,
+                  bound_trajectory=bound_trajectory,
+                  decompose_files=decompose_files)
+
+    # Load all replica trajectories concurrently, validate them and order
+    # them by (pose, replica) before they are collected by the lie_pylie
+    # service.
+    t17 = wf.add_task('Collect replica trajectories',
+                      task_type='PythonTask',
+                      custom_func='trajectory_helpers.collect_replica_trajectories')
+    wf.connect_task(t16.nid, t17.nid, 'bound_trajectory', 'unbound_trajectory', 'decompose_files')
+
+    # Collect Gromacs bound and unbound MD energy trajectories in a dataframe
+    t18 = wf.add_task('Create mdframe',
+                      task_type='WampTask',
+                      uri='mdgroup.lie_pylie.endpoint.collect_energy_trajectories')
+    wf.connect_task(t17.nid, t18.nid, 'bound_trajectory', 'unbound_trajectory')
+
+    # Determine stable regions in MDFrame and filter
+    t19 = wf.add_task('Detect stable regions',
+                      task_type='WampTask',
+                      uri='mdgroup.lie_pylie.endpoint.filter_stable_trajectory')
+    t19.set_input(do_plot=do_plot,
+                  workdir=work_dir)
+    wf.connect_task(t18.nid, t19.nid, 'mdframe')
+
+    # Extract average LIE energy values from the trajectory
+    t20 = wf.add_task('LIE averages',
+                      task_type='WampTask',
+                      uri='mdgroup.lie_pylie.endpoint.calculate_lie_average')
+    wf.connect_task(t19.nid, t20.nid, 'filtered_mdframe', filtered_mdframe='mdframe')
+
+    # Calculate dG using pre-calibrated model parameters
+    t21 = wf.add_task('Calc dG',
+                      task_type='WampTask',
+                      uri='mdgroup.lie_pylie.endpoint.liedeltag')
+    t21.set_input(alpha_beta_gamma=modelfile['LIE']['params'])
+    wf.connect_task(t20.nid, t21.nid, 'averaged', averaged='dataframe')
+
+    # Applicability domain: 1. Tanimoto similarity with training set
+    t22 = wf.add_task('AD1 tanimoto simmilarity',
+                      task_type='WampTask',
+                      uri='mdgroup.lie_structures.endpoint.chemical_similarity')
+    t22.set_input(reference_set=modelfile['AD']['Tanimoto']['smi'],
+                  ci_cutoff=modelfile['AD']['Tanimoto']['Furthest'])
+    wf.connect_task(t16.nid, t22.nid, ligands='test_set')
+
+    # Applicability domain: 2. residue decomposition
+    t23 = wf.add_task('AD2 residue decomposition',
+                      task_type='WampTask',
+                      uri='mdgroup.lie_pylie.endpoint.adan_residue_decomp',
+                      inline_files=False)
+    t23.set_input(model_pkl=modelpicklefile)
+    wf.connect_task(t17.nid, t23.nid, 'decompose_files')
+
+    # Applicability domain: 3. deltaG energy range
+    t24 = wf.add_task('AD3 dene yrange',
+                      task_type='WampTask',
+                      uri='mdgroup.lie_pylie.endpoint.adan_dene_yrange')
+    t24.set_input(ymin=modelfile['AD']['Yrange']['min'],
+                  ymax=modelfile['AD']['Yrange']['max'])
+    wf.connect_task(t21.nid, t24.nid, 'liedeltag_file', liedeltag_file='dataframe')
+
+    # Applicability domain: 4. deltaG energy distribution
+    t25 = wf.add_task('AD4 dene distribution',
+                      task_type='WampTask',
+                      uri='mdgroup.lie_pylie.endpoint.adan_dene')
+    t25.set_input(model_pkl=modelpicklefile,
+                  center=list(modelfile['AD']['Dene']['Xmean']),
+                  ci_cutoff=modelfile['AD']['Dene']['Maxdist'])
+    wf.connect_task(t21.nid, t25.nid, 'liedeltag_file', liedeltag_file='dataframe')
+
+    return wf
+
+
 class LIEPredictionWorkflow(ComponentSession):
     """
     This workflow will perform a binding affinity prediction for CYP 1A2 with
@@ -38,7 +145,9 @@ class LIEPredictionWorkflow(ComponentSession):
 
     @chainable
     def on_run(self):
-        
+
+        from lie_workflow import Workflow
+
         # Workflow input data. Would normally be obtained from other LIE
         # workflow that runs docking and MD.
         ligand = 'O1[C@@H](CCC1=O)CCC'
@@ -55,70 +164,7 @@ class LIEPredictionWorkflow(ComponentSession):
         # Build Workflow
         wf = Workflow(project_dir='./lie_prediction')
         wf.task_runner = self
-
-        # STAGE 5. PYLIE FILTERING, AD ANALYSIS AND BINDING-AFFINITY PREDICTION
-        # Collect Gromacs bound and unbound MD energy trajectories in a dataframe
-        t18 = wf.add_task('Create mdframe',
-                          task_type='WampTask', 
-                          uri='mdgroup.lie_pylie.endpoint.collect_energy_trajectories')
-        t18.set_input(unbound_trajectory=unbound_trajectory,
-                      bound_trajectory=bound_trajectory)
-        
-        # Determine stable regions in MDFrame and filter
-        t19 = wf.add_task('Detect stable regions',
-                          task_type='WampTask',
-                          uri='mdgroup.lie_pylie.endpoint.filter_stable_trajectory')
-        t19.set_input(do_plot=True,
-                      workdir='/tmp/mdstudio/lie_pylie')
-        wf.connect_task(t18.nid, t19.nid, 'mdframe')
-     
-        # Extract average LIE energy values from the trajectory
-        t20 = wf.add_task('LIE averages',
-                          task_type='WampTask',
-                          uri='mdgroup.lie_pylie.endpoint.calculate_lie_average')
-        wf.connect_task(t19.nid, t20.nid, 'filtered_mdframe', filtered_mdframe='mdframe')
-
-        # Calculate dG using pre-calibrated model parameters
-        t21 = wf.add_task('Calc dG',
-                          task_type='WampTask',
-                          uri='mdgroup.lie_pylie.endpoint.liedeltag')
-        t21.set_input(alpha_beta_gamma=modelfile['LIE']['params'])
-        wf.connect_task(t20.nid, t21.nid, 'averaged', averaged='dataframe')
-
-        # Applicability domain: 1. Tanimoto similarity with training set
-        t22 = wf.add_task('AD1 tanimoto simmilarity',
-                          task_type='WampTask',
-                          uri='mdgroup.lie_structures.endpoint.chemical_similarity')
-        t22.set_input(test_set=[ligand],
-                      reference_set=modelfile['AD']['Tanimoto']['smi'],
-                      ci_cutoff=modelfile['AD']['Tanimoto']['Furthest'])
-        wf.connect_task(t18.nid, t22.nid)
-
-        # Applicability domain: 2. residue decomposition
-        t23 = wf.add_task('AD2 residue decomposition',
-                          task_type='WampTask',
-                          uri='mdgroup.lie_pylie.endpoint.adan_residue_decomp',
-                          inline_files=False)
-        t23.set_input(model_pkl=modelpicklefile,
-                      decompose_files=decompose_files)
-        wf.connect_task(t18.nid, t23.nid)
-
-        # Applicability domain: 3. deltaG energy range
-        t24 = wf.add_task('AD3 dene yrange',
-                          task_type='WampTask',
-                          uri='mdgroup.lie_pylie.endpoint.adan_dene_yrange')
-        t24.set_input(ymin=modelfile['AD']['Yrange']['min'],
-                      ymax=modelfile['AD']['Yrange']['max'])
-        wf.connect_task(t21.nid, t24.nid, 'liedeltag_file', liedeltag_file='dataframe')
-
-        # Applicability domain: 4. deltaG energy distribution
-        t25 = wf.add_task('AD4 dene distribution',
-                          task_type='WampTask',
-                          uri='mdgroup.lie_pylie.endpoint.adan_dene')
-        t25.set_input(model_pkl=modelpicklefile,
-                      center=list(modelfile['AD']['Dene']['Xmean']),
-                      ci_cutoff=modelfile['AD']['Dene']['Maxdist'])
-        wf.connect_task(t21.nid, t25.nid, 'liedeltag_file', liedeltag_file='dataframe')
+        build_workflow(wf, [ligand], bound_trajectory, unbound_trajectory, decompose_files, modelpicklefile, modelfile)
 
         wf.run()
         while wf.is_running:
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: array_encoding.py
+
+Packed binary encoding of energy dataframes for WAMP messages.
+
+MD energy frames are sent between the LIE endpoints as JSON, every float
+printed as text and parsed again at every hop. The packed encoding stores
+the columns of a frame as typed little-endian binary blocks, one block per
+data type, with the column names and the number of rows as header:
+
+    {'$frame': {'rows': 1001,
+                'blocks': [{'dtype': '<i4', 'columns': ['pose', 'replica'],
+                            'data': b'...'},
+                           {'dtype': '<f8', 'columns': ['frame', 'vdw', ...],
+                            'data': b'...'}]}}
+
+Within a block the data is stored column by column so every decoded column
+is a contiguous NumPy view on the message buffer, no copy is made. The
+encoded frame is meant to be sent with a binary serializer, msgpack or
+CBOR, that transports the data as raw bytes.
+
+Usage:
+
+    python array_encoding.py [trajectory files]   # benchmark
+"""
+
+import sys
+import glob
+import json
+import time
+
+from collections import OrderedDict
+
+import numpy
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+FRAME_KEY = '$frame'
+
+
+def is_packed_frame(data):
+
+    return isinstance(data, dict) and FRAME_KEY in data
+
+
+def encode_frame(frame, float_dtype='<f8'):
+    """
+    Encode a columnar frame into packed binary column blocks
+
+    :param frame:       column name to 1D array mapping, all of equal length
+    :type frame:        :py:dict
+    :param float_dtype: little-endian float type for the float columns,
+                        '<f8' or '<f4' to halve the size at reduced
+                        precision
+    :type float_dtype:  :py:str
+
+    :return:            packed frame
+    :rtype:             :py:dict
+    """
+
+    columns = OrderedDict((name, numpy.asarray(values)) for name, values in frame.items())
+    rows = len(next(iter(columns.values()))) if columns else 0
+
+    blocks = OrderedDict()
+    for name, values in columns.items():
+        if values.shape != (rows,):
+            raise ValueError('Column {0} is not a 1D array of {1} rows'.format(name, rows))
+
+        if values.dtype.kind == 'f':
+            dtype = numpy.dtype(float_dtype)
+        else:
+            dtype = values.dtype.newbyteorder('<')
+        blocks.setdefault(dtype.str, []).append(name)
+
+    encoded = []
+    for dtype, names in blocks.items():
+        block = numpy.empty((len(names), rows), dtype=dtype)
+        for i, name in enumerate(names):
+            block[i] = columns[name]
+        encoded.append({'dtype': dtype, 'columns': names, 'data': block.tobytes()})
+
+    return {FRAME_KEY: {'rows': rows, 'blocks': encoded}}
+
+
+def decode_frame(packed):
+    """
+    Decode a packed frame to NumPy columns without copying
+
+    The columns are read-only views on the packed data.
+
+    :param packed: packed frame
+    :type packed:  :py:dict
+
+    :rtype:        :py:collections.OrderedDict
+    """
+
+    packed = packed[FRAME_KEY]
+    rows = packed['rows']
+
+    frame = OrderedDict()
+    for block in packed['blocks']:
+        values = numpy.frombuffer(block['data'], dtype=numpy.dtype(block['dtype']))
+        values = values.reshape(len(block['columns']), rows)
+        for name, column in zip(block['columns'], values):
+            frame[name] = column
+
+    return frame
+
+
+def dumps(message, codec='msgpack'):
+    """
+    Serialize a message holding packed frames with msgpack or CBOR
+    """
+
+    if codec == 'msgpack':
+        return msgpack.packb(message, use_bin_type=True)
+    if codec == 'cbor':
+        return cbor2.dumps(message)
+
+    raise ValueError('Unsupported codec: {0}'.format(codec))
+
+
+def loads(raw, codec='msgpack'):
+    """
+    Deserialize a msgpack or CBOR message
+    """
+
+    if codec == 'msgpack':
+        return msgpack.unpackb(raw, raw=False)
+    if codec == 'cbor':
+        return cbor2.loads(raw)
+
+    raise ValueError('Unsupported codec: {0}'.format(codec))
+
+
+def benchmark(frame, repeat=5):
+    """
+    Compare size and encode plus decode time of one message hop for a frame
+    sent as JSON and as packed frame with the available codecs
+
+    :param frame:  column name to 1D array mapping
+    :type frame:   :py:dict
+    :param repeat: number of repetitions, the best time is reported
+    :type repeat:  :py:int
+
+    :return:       (encoding, size in bytes, seconds per hop) tuples
+    :rtype:        :py:list
+    """
+
+    def best(func):
+        times = []
+        for _ in range(repeat):
+            start = time.time()
+            size = func()
+            times.append(time.time() - start)
+        return size, min(times)
+
+    def json_hop():
+        raw = json.dumps(dict((name, values.tolist()) for name, values in frame.items()))
+        decoded = json.loads(raw)
+        dict((name, numpy.array(values)) for name, values in decoded.items())
+        return len(raw)
+
+    def packed_hop(codec, float_dtype):
+        def hop():
+            raw = dumps(encode_frame(frame, float_dtype=float_dtype), codec=codec)
+            decode_frame(loads(raw, codec=codec))
+            return len(raw)
+        return hop
+
+    results = [('json',) + best(json_hop)]
+    for codec, module in (('msgpack', msgpack), ('cbor', cbor2)):
+        if module is None:
+            continue
+        for float_dtype in ('<f8', '<f4'):
+            name = '{0} {1}'.format(codec, 'float64' if float_dtype == '<f8' else 'float32')
+            results.append((name,) + best(packed_hop(codec, float_dtype)))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    from trajectory_helpers import load_replica_trajectories
+
+    files = sys.argv[1:] or sorted(glob.glob('mddata-*.ene'))
+    frame = load_replica_trajectories(files, use_cache=False)
+
+    print('{0} files, {1} frames, {2} columns'.format(len(files), len(frame['frame']), len(frame)))
+    print('{0:>16} {1:>12} {2:>12}'.format('encoding', 'size (B)', 'hop (ms)'))
+    for name, size, seconds in benchmark(frame):
+        print('{0:>16} {1:>12} {2:>12.2f}'.format(name, size, seconds * 1000))
@@ -0,0 +1,624 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: benchmark_lie.py
+
+Offline performance regression benchmark of the LIE prediction workflow.
+
+Runs the LIEPredictionWorkflow in-process, without broker or network. The
+workflow is built by the same `build_workflow` function as
+allies_prediction_workflow.py and run by LocalWorkflow, a minimal
+sequential implementation of the workflow manager API used there
+(add_task, set_input, connect_task).
+
+Only the replica collection stage ('Collect replica trajectories', the
+trajectory_helpers PythonTask) is real workflow code. The lie_pylie and
+chemical_similarity endpoints are NumPy stand-ins written for this
+benchmark. They take and return the same request and response parameters
+as the endpoints: 'Create mdframe' takes the trajectory files and writes
+the mdframe CSV file that 'Detect stable regions' and 'LIE averages' read,
+one row per frame with a vdw and coul column pair for the unbound ligand
+and every bound pose. The timings of these stages therefore measure the
+stand-ins and the message serialization, not the services. Every endpoint
+request and response is serialized and deserialized, as JSON by default,
+as it would be crossing the broker.
+
+The endpoints run in other processes than the workflow, the stand-ins
+therefore never use the trajectory frame cache of the workflow process and
+the cache is cleared before every workflow run.
+
+The inputs are synthetic and scaled from the example2 data: bound and
+unbound replica trajectories are resampled from the mddata-*.ene and
+mddata-*.decomp files for a number of ligands and frames. Residue
+decomposition is written every 10th frame. The workflow is run once for
+every ligand, as in a screening campaign, and the stage times are summed
+over the ligands. Two series are run, ligands scaling at 1000 frames and
+frames scaling for a single ligand:
+
+    quick:  1-100 ligands, 1k-100k frames
+    full:   1-1000 ligands, 1k-1M frames
+
+For every scenario the wall time of each stage (best of --repeat runs)
+and the peak traced memory (tracemalloc) of a single run of the stage
+are reported. Results can be
+stored as baseline and later runs checked against it, a check fails with
+exit code 1 when a stage is slower or uses more memory than the baseline
+plus tolerance.
+
+Usage:
+
+    python benchmark_lie.py --save-baseline    # on the reference machine
+    python benchmark_lie.py --check            # fails on regressions
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import pickle
+import shutil
+import zlib
+import argparse
+import functools
+import importlib
+import tempfile
+import tracemalloc
+
+from collections import OrderedDict
+
+import numpy
+
+from allies_prediction_workflow import build_workflow
+from trajectory_helpers import load_replica_trajectories, clear_trajectory_cache, read_energy_file
+import array_encoding
+
+CURRDIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(CURRDIR, 'benchmark_baseline.json')
+SCALES = {
+    'quick': {'ligands': [1, 10, 100], 'frames': [1000, 10000, 100000]},
+    'full': {'ligands': [1, 10, 100, 1000], 'frames': [1000, 10000, 100000, 1000000]},
+}
+BOUND_REPLICAS = 4
+DECOMP_STRIDE = 10
+FINGERPRINT_BITS = 1024
+
+# Differences below these are considered noise in regression checks
+MIN_TIME_DIFFERENCE = 0.005
+MIN_MEMORY_DIFFERENCE = 1024 ** 2
+
+
+@functools.lru_cache(maxsize=None)
+def load_model(path):
+    """
+    Load the pre-calibrated LIE model pickle
+
+    The applicability domain part of the model holds scikit-learn objects.
+    When scikit-learn is not installed these are loaded as empty
+    placeholders, the stand-in endpoints do not use them.
+    """
+
+    class Placeholder(object):
+        def __setstate__(self, state):
+            self.state = state
+
+    class ModelUnpickler(pickle.Unpickler):
+        def find_class(self, module, name):
+            try:
+                return super(ModelUnpickler, self).find_class(module, name)
+            except ImportError:
+                return Placeholder
+
+    with open(path, 'rb') as model:
+        return ModelUnpickler(model, encoding='latin1').load()
+
+
+# Stand-in endpoint implementations
+
+def _mdframe_path_file(path):
+
+    return {'content': None, 'path': path, 'extension': 'csv'}
+
+
+def _write_mdframe(path, header, block):
+
+    numpy.savetxt(path, block, fmt='%.8g', delimiter=',', header=','.join(header), comments='')
+    return _mdframe_path_file(path)
+
+
+def _read_mdframe(mdframe):
+
+    with open(mdframe['path']) as csv:
+        header = csv.readline().strip().split(',')
+        values = numpy.loadtxt(csv, delimiter=',', ndmin=2)
+
+    return header, values
+
+
+def collect_energy_trajectories(bound_trajectory=None, unbound_trajectory=None, lie_vdw_header='vdwLIE',
+                                lie_ele_header='EleLIE', **kwargs):
+
+    if isinstance(unbound_trajectory, str):
+        unbound_trajectory = [unbound_trajectory]
+
+    series = [('unbound', path) for path in unbound_trajectory]
+    series += [('bound_{0}'.format(pose), path) for pose, path in enumerate(bound_trajectory, start=1)]
+    parsed = [read_energy_file(path) for _, path in series]
+
+    nrows = max(values.shape[0] for _, values in parsed)
+    header = ['frame', 'time']
+    block = numpy.full((nrows, 2 + 2 * len(series)), numpy.nan)
+    block[:, 0] = numpy.arange(nrows)
+    for i, ((name, _), (columns, values)) in enumerate(zip(series, parsed)):
+        if values.shape[0] == nrows:
+            block[:, 1] = values[:, columns.index('Time')]
+        block[:values.shape[0], 2 + 2 * i] = values[:, columns.index(lie_vdw_header)]
+        block[:values.shape[0], 3 + 2 * i] = values[:, columns.index(lie_ele_header)]
+        header.extend(['vdw_{0}'.format(name), 'coul_{0}'.format(name)])
+
+    work_dir = tempfile.mkdtemp(prefix='mdframe-', dir=os.path.dirname(bound_trajectory[0]))
+    return {'mdframe': _write_mdframe(os.path.join(work_dir, 'mdframe.csv'), header, block)}
+
+
+def filter_stable_trajectory(mdframe=None, workdir=None, FilterSplines=None, **kwargs):
+
+    header, values = _read_mdframe(mdframe)
+    energies = values[:, 2:]
+    mean = numpy.nanmean(energies, axis=0)
+    std = numpy.nanstd(energies, axis=0)
+    with numpy.errstate(invalid='ignore'):
+        energies[numpy.abs(energies - mean) > 2 * std] = numpy.nan
+
+    path = os.path.join(os.path.dirname(mdframe['path']), 'filtered_mdframe.csv')
+    return {'filtered_mdframe': _write_mdframe(path, header, values)}
+
+
+def calculate_lie_average(mdframe=None, **kwargs):
+
+    header, values = _read_mdframe(mdframe)
+    means = dict(zip(header, numpy.nanmean(values, axis=0)))
+    poses = sorted(int(name.rsplit('_', 1)[1]) for name in header if name.startswith('vdw_bound_'))
+
+    averaged = OrderedDict([('pose', numpy.array(poses))])
+    for column in ('vdw', 'coul'):
+        averaged[column] = numpy.array([means['{0}_bound_{1}'.format(column, pose)] for pose in poses]) - \
+            means['{0}_unbound'.format(column)]
+
+    return {'averaged': averaged}
+
+
+def liedeltag(dataframe=None, alpha_beta_gamma=None, **kwargs):
+
+    alpha, beta, gamma = alpha_beta_gamma
+    liedeltag_file = OrderedDict(dataframe)
+    liedeltag_file['dg'] = alpha * dataframe['vdw'] + beta * dataframe['coul'] + gamma
+
+    return {'liedeltag_file': liedeltag_file}
+
+
+def _fingerprints(smiles):
+
+    bits = numpy.zeros((len(smiles), FINGERPRINT_BITS), dtype=bool)
+    for i, smi in enumerate(smiles):
+        bits[i, [zlib.crc32(smi[j:j + 3].encode('utf-8')) % FINGERPRINT_BITS for j in range(max(len(smi) - 2, 1))]] = True
+
+    return bits
+
+
+def chemical_similarity(test_set=None, reference_set=None, ci_cutoff=None, **kwargs):
+
+    test = _fingerprints(test_set).astype(numpy.float32)
+    reference = _fingerprints(reference_set).astype(numpy.float32)
+    common = test.dot(reference.T)
+    union = test.sum(axis=1)[:, None] + reference.sum(axis=1)[None, :] - common
+    similarity = (common / numpy.maximum(union, 1)).max(axis=1)
+
+    return {'similarity': similarity.tolist(), 'in_domain': (similarity >= ci_cutoff).tolist()}
+
+
+def adan_residue_decomp(decompose_files=None, model_pkl=None, **kwargs):
+
+    # The model pickle holds scikit-learn objects, loaded once per process
+    model = load_model(model_pkl)
+    frame = load_replica_trajectories(decompose_files, use_cache=False)
+    result = OrderedDict()
+    for prefix in ('Ele', 'Vdw'):
+        columns = [name for name in frame if name.startswith(prefix + '-') and name[4:].isdigit()]
+        block = numpy.stack([frame[name] for name in columns], axis=1)
+        poses, inverse = numpy.unique(frame['pose'], return_inverse=True)
+        means = numpy.zeros((len(poses), len(columns)))
+        numpy.add.at(means, inverse, block)
+        means /= numpy.bincount(inverse)[:, None]
+
+        scaled = (means - block.mean(axis=0)) / numpy.maximum(block.std(axis=0), 1e-9)
+        distance = numpy.sqrt((scaled ** 2).mean(axis=1))
+        result['pose'] = poses
+        result['{0}_sd'.format(prefix.lower())] = distance
+        result['{0}_in_domain'.format(prefix.lower())] = distance <= model['AD']['dec' + prefix]['critSD']
+
+    return {'decomp': result}
+
+
+def adan_dene_yrange(dataframe=None, ymin=None, ymax=None, **kwargs):
+
+    dg = dataframe['dg']
+    return {'in_domain': ((dg >= ymin) & (dg <= ymax)).tolist()}
+
+
+def adan_dene(dataframe=None, center=None, ci_cutoff=None, **kwargs):
+
+    distance = numpy.hypot(dataframe['vdw'] - center[0], dataframe['coul'] - center[1])
+    return {'distance': distance.tolist(), 'in_domain': (distance <= ci_cutoff).tolist()}
+
+
+STAND_INS = {
+    'mdgroup.lie_pylie.endpoint.collect_energy_trajectories': collect_energy_trajectories,
+    'mdgroup.lie_pylie.endpoint.filter_stable_trajectory': filter_stable_trajectory,
+    'mdgroup.lie_pylie.endpoint.calculate_lie_average': calculate_lie_average,
+    'mdgroup.lie_pylie.endpoint.liedeltag': liedeltag,
+    'mdgroup.lie_structures.endpoint.chemical_similarity': chemical_similarity,
+    'mdgroup.lie_pylie.endpoint.adan_residue_decomp': adan_residue_decomp,
+    'mdgroup.lie_pylie.endpoint.adan_dene_yrange': adan_dene_yrange,
+    'mdgroup.lie_pylie.endpoint.adan_dene': adan_dene,
+}
+
+
+class StandInRunner(object):
+    """
+    Local task runner calling the stand-in endpoints
+
+    Requests and responses are passed through the serialization a message
+    crossing the broker would get: 'json' (dataframes as column lists),
+    'packed' (msgpack with array_encoding column blocks) or 'none'.
+    """
+
+    def __init__(self, encoding='json'):
+
+        self.encoding = encoding
+
+    def _to_wire(self, data):
+
+        if isinstance(data, OrderedDict) and data and all(isinstance(v, numpy.ndarray) for v in data.values()):
+            if self.encoding == 'packed':
+                return array_encoding.encode_frame(data)
+            return {'$columns': OrderedDict((name, values.tolist()) for name, values in data.items())}
+        if isinstance(data, dict):
+            return dict((key, self._to_wire(value)) for key, value in data.items())
+        if isinstance(data, (list, tuple)):
+            return [self._to_wire(value) for value in data]
+        if isinstance(data, numpy.generic):
+            return data.item()
+
+        return data
+
+    def _from_wire(self, data):
+
+        if isinstance(data, dict):
+            if array_encoding.is_packed_frame(data):
+                return array_encoding.decode_frame(data)
+            if '$columns' in data:
+                return OrderedDict((name, numpy.array(values)) for name, values in data['$columns'].items())
+            return dict((key, self._from_wire(value)) for key, value in data.items())
+        if isinstance(data, list):
+            return [self._from_wire(value) for value in data]
+
+        return data
+
+    def transfer(self, message):
+        """
+        Serialize and deserialize a message as it would cross the broker
+        """
+
+        if self.encoding == 'none':
+            return message
+        if self.encoding == 'packed':
+            return self._from_wire(array_encoding.loads(array_encoding.dumps(self._to_wire(message))))
+
+        return self._from_wire(json.loads(json.dumps(self._to_wire(message))))
+
+    def call(self, uri, request):
+
+        response = STAND_INS[uri](**self.transfer(request))
+        return self.transfer(response)
+
+
+# Synthetic input data
+
+def write_trajectory(path, header, rows, comment):
+
+    with open(path, 'w') as trajectory:
+        trajectory.write(('#' if comment else ' ') + header)
+        numpy.savetxt(trajectory, rows, fmt='%10.4f')
+
+
+def generate_inputs(work_dir, ligands, frames, seed=1):
+    """
+    Write synthetic replica trajectories resampled from the example2 data
+
+    :param ligands: number of ligands, each one pose
+    :type ligands:  :py:int
+    :param frames:  number of bound frames per ligand, divided over the
+                    bound replicas. The unbound trajectory has a quarter of
+                    this number of frames.
+    :type frames:   :py:int
+
+    :return:        bound, unbound and decomposition files for every ligand
+    :rtype:         :py:list
+    """
+
+    rng = numpy.random.RandomState(seed)
+    sources = {}
+    for extension, pattern in (('ene', 'mddata-1-*.ene'), ('decomp', 'mddata-1-*.decomp'),
+                               ('unbound', 'mddata-0-0.ene')):
+        with open(os.path.join(CURRDIR, pattern.replace('*', '1'))) as source:
+            header = source.readline()
+        values = numpy.concatenate([numpy.loadtxt(path, comments='#', ndmin=2, skiprows=1)
+                                    for path in sorted(glob.glob(os.path.join(CURRDIR, pattern)))])
+        sources[extension] = (header.lstrip('#').lstrip(' '), values)
+
+    def resample(extension, count):
+        header, values = sources[extension]
+        rows = values[rng.randint(0, len(values), count)]
+        rows = rows + rng.normal(0, 0.01, rows.shape) * numpy.abs(rows)
+        rows[:, 0] = numpy.arange(count)
+        rows[:, 1] = numpy.arange(count) * 2
+        return header, rows
+
+    inputs = []
+    per_replica = max(frames // BOUND_REPLICAS, 1)
+    for ligand in range(1, ligands + 1):
+        files = {'bound_trajectory': [], 'decompose_files': []}
+        for replica in range(1, BOUND_REPLICAS + 1):
+            path = os.path.join(work_dir, 'bound-{0}-{1}.ene'.format(ligand, replica))
+            write_trajectory(path, *resample('ene', per_replica), comment=True)
+            files['bound_trajectory'].append(path)
+
+            path = os.path.join(work_dir, 'bound-{0}-{1}.decomp'.format(ligand, replica))
+            write_trajectory(path, *resample('decomp', max(per_replica // DECOMP_STRIDE, 1)), comment=False)
+            files['decompose_files'].append(path)
+
+        path = os.path.join(work_dir, 'unbound-{0}-0.ene'.format(ligand))
+        write_trajectory(path, *resample('unbound', per_replica), comment=True)
+        files['unbound_trajectory'] = path
+        inputs.append(files)
+
+    return inputs
+
+
+def synthetic_ligands(reference_set, count):
+
+    return [reference_set[i % len(reference_set)] + 'C' * (i // len(reference_set)) for i in range(count)]
+
+
+# Benchmark
+
+class LocalTask(object):
+
+    def __init__(self, nid, name, task_type='BlankTask', custom_func=None, uri=None, **kwargs):
+
+        self.nid = nid
+        self.name = name
+        self.task_type = task_type
+        self.custom_func = custom_func
+        self.uri = uri
+        self.input = {}
+
+    def set_input(self, **kwargs):
+
+        self.input.update(kwargs)
+
+
+class LocalWorkflow(object):
+    """
+    Minimal in-process workflow runner
+
+    Implements the part of the workflow manager API used by
+    `build_workflow`. Tasks are run one at a time in the order they were
+    added, the input of a task is its own input updated with the connected
+    output of the tasks it depends on. A connection without parameters
+    passes all output. A BlankTask returns its input. Other task options
+    (store_output, inline_files) are ignored.
+
+    :param task_runner: runner for WampTasks, with a `call(uri, request)`
+                        method
+    """
+
+    def __init__(self, task_runner):
+
+        self.task_runner = task_runner
+        self.tasks = OrderedDict()
+        self.connections = []
+
+    def add_task(self, name, **kwargs):
+
+        task = LocalTask(len(self.tasks) + 1, name, **kwargs)
+        self.tasks[task.nid] = task
+        return task
+
+    def connect_task(self, source, target, *args, **kwargs):
+
+        self.connections.append((source, target, args, kwargs))
+
+    def call_task(self, task, request):
+
+        if task.task_type == 'BlankTask':
+            return request
+        if task.task_type == 'WampTask':
+            return self.task_runner.call(task.uri, request)
+
+        module, func = task.custom_func.rsplit('.', 1)
+        return getattr(importlib.import_module(module), func)(**request)
+
+    def run(self, stage_timer):
+        """
+        Run all tasks, every task call is made through `stage_timer`
+
+        :param stage_timer: function called with the task name, the task
+                            function and its arguments
+        """
+
+        output = {}
+        for nid, task in self.tasks.items():
+            request = dict(task.input)
+            for source, target, args, kwargs in self.connections:
+                if target != nid:
+                    continue
+                if source not in output:
+                    raise ValueError('Task {0} runs before task {1} it depends on'.format(task.name, source))
+
+                if not args and not kwargs:
+                    request.update(output[source])
+                for key in args:
+                    request[key] = output[source][key]
+                for key, name in kwargs.items():
+                    request[name] = output[source][key]
+
+            output[nid] = stage_timer(task.name, self.call_task, task, request)
+
+        return output
+
+
+def run_workflow(runner, inputs, ligand, modelpicklefile, work_dir, stage_timer):
+    """
+    Build the LIEPredictionWorkflow for a ligand and run it end to end
+    """
+
+    wf = LocalWorkflow(runner)
+    build_workflow(wf, [ligand], inputs['bound_trajectory'], inputs['unbound_trajectory'], inputs['decompose_files'],
+                   modelpicklefile, load_model(modelpicklefile), work_dir=work_dir, do_plot=False)
+
+    return wf.run(stage_timer)
+
+
+def benchmark_scenario(ligands, frames, encoding='json', repeat=3):
+    """
+    Time every stage and measure the peak memory for one input scale
+
+    :return: stage name to {'time': seconds, 'memory': peak bytes}
+    :rtype:  :py:collections.OrderedDict
+    """
+
+    modelpicklefile = os.path.join(CURRDIR, '1A2_model.pkl')
+    model = load_model(modelpicklefile)
+    runner = StandInRunner(encoding=encoding)
+    work_dir = tempfile.mkdtemp(prefix='lie-benchmark-')
+    try:
+        inputs = generate_inputs(work_dir, ligands, frames)
+        smiles = synthetic_ligands(model['AD']['Tanimoto']['smi'], ligands)
+        results = OrderedDict()
+
+        def run_ligands(stage_timer):
+            for files, ligand in zip(inputs, smiles):
+                clear_trajectory_cache()
+                run_workflow(runner, files, ligand, modelpicklefile, work_dir, stage_timer)
+            clear_trajectory_cache()
+
+        for _ in range(repeat):
+            times = OrderedDict()
+
+            def timed(name, func, *args, **kwargs):
+                start = time.perf_counter()
+                output = func(*args, **kwargs)
+                times[name] = times.get(name, 0) + time.perf_counter() - start
+                return output
+
+            run_ligands(timed)
+            for name, elapsed in times.items():
+                result = results.setdefault(name, {'time': elapsed, 'memory': 0})
+                result['time'] = min(result['time'], elapsed)
+
+        def traced(name, func, *args, **kwargs):
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+            output = func(*args, **kwargs)
+            results[name]['memory'] = max(results[name]['memory'], tracemalloc.get_traced_memory()[1] - start)
+            return output
+
+        tracemalloc.start()
+        try:
+            run_ligands(traced)
+        finally:
+            tracemalloc.stop()
+
+        return results
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def scenarios(scale):
+
+    series = SCALES[scale]
+    points = [(ligands, 1000) for ligands in series['ligands']]
+    points += [(1, frames) for frames in series['frames'] if (1, frames) not in points]
+
+    return points
+
+
+def check_regressions(results, baseline, tolerance):
+    """
+    Compare results to a baseline
+
+    :return: regression descriptions, empty when there are none
+    :rtype:  :py:list
+    """
+
+    regressions = []
+    for scenario, stages in results.items():
+        for stage, result in stages.items():
+            reference = baseline.get(scenario, {}).get(stage)
+            if reference is None:
+                continue
+
+            if result['time'] > reference['time'] * (1 + tolerance) and \
+                    result['time'] - reference['time'] > MIN_TIME_DIFFERENCE:
+                regressions.append('{0} {1}: time {2:.4f} s, baseline {3:.4f} s'.format(
+                    scenario, stage, result['time'], reference['time']))
+            if result['memory'] > reference['memory'] * (1 + tolerance) and \
+                    result['memory'] - reference['memory'] > MIN_MEMORY_DIFFERENCE:
+                regressions.append('{0} {1}: peak memory {2} B, baseline {3} B'.format(
+                    scenario, stage, result['memory'], reference['memory']))
+
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Offline LIE prediction workflow benchmark')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='quick', help='input scale series')
+    parser.add_argument('--encoding', choices=['json', 'packed', 'none'], default='json',
+                        help='serialization of endpoint messages')
+    parser.add_argument('--repeat', type=int, default=3, help='timing repetitions, best is used')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline results file')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as baseline')
+    parser.add_argument('--check', action='store_true', help='fail when results regress from the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression')
+    args = parser.parse_args()
+
+    results = OrderedDict()
+    for ligands, frames in scenarios(args.scale):
+        scenario = '{0} ligands, {1} frames, {2}'.format(ligands, frames, args.encoding)
+        results[scenario] = benchmark_scenario(ligands, frames, encoding=args.encoding, repeat=args.repeat)
+
+        print(scenario)
+        for stage, result in results[scenario].items():
+            print('{0:>30} {1:>10.2f} ms {2:>10.1f} MB'.format(stage, result['time'] * 1000,
+                                                              result['memory'] / 1024.0 ** 2))
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as baseline_file:
+                baseline = json.load(baseline_file)
+        baseline.update(results)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2)
+        print('Baseline written to {0}'.format(args.baseline))
+
+    if args.check:
+        if not os.path.exists(args.baseline):
+            sys.exit('No baseline results in {0}, run with --save-baseline first'.format(args.baseline))
+        with open(args.baseline) as baseline_file:
+            regressions = check_regressions(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {0}'.format(regression))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: trajectory_helpers.py
+
+Helper Python functions to collect multi-replica MD energy trajectories
+(*.ene, *.decomp) used in the LIE prediction workflow.
+
+Trajectory files follow the ALLIES naming convention
+<name>-<pose>-<replica>.<extension> (e.g. mddata-1-3.ene) where pose 0 and
+replica 0 refer to the unbound ligand simulation.
+All replica files of a run are parsed concurrently and aggregated into one
+columnar frame keyed by (pose, replica, frame).
+"""
+
+import os
+import re
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy
+
+TRAJECTORY_NAME_REGEX = re.compile(r'-(?P<pose>\d+)-(?P<replica>\d+)\.\w+$')
+
+# Parsed frames cached per file set, least recently used first. The key is
+# built from the absolute path, modification time and size of every file so
+# a changed file invalidates it.
+TRAJECTORY_CACHE_SIZE = 8
+_TRAJECTORY_CACHE = OrderedDict()
+_TRAJECTORY_CACHE_LOCK = threading.Lock()
+
+
+def parse_replica_id(path):
+    """
+    Get the (pose, replica) identifier from an ALLIES trajectory file name
+
+    :param path: trajectory file path
+    :type path:  :py:str
+
+    :return:     pose and replica number
+    :rtype:      :py:tuple
+    """
+
+    match = TRAJECTORY_NAME_REGEX.search(os.path.basename(path))
+    if not match:
+        raise ValueError('Not an ALLIES <name>-<pose>-<replica> trajectory file: {0}'.format(path))
+
+    return int(match.group('pose')), int(match.group('replica'))
+
+
+def read_energy_file(path):
+    """
+    Parse a single GROMACS energy (*.ene) or decomposition (*.decomp) file
+
+    The first line contains the column headers, optionally prefixed by a
+    comment '#' character. The remaining lines are whitespace separated
+    numeric values.
+
+    :param path: trajectory file path
+    :type path:  :py:str
+
+    :return:     column headers and 2D float64 array of values
+    :rtype:      :py:tuple
+    """
+
+    with open(path, 'r') as trajectory:
+        header = trajectory.readline().lstrip('#').split()
+        values = numpy.loadtxt(trajectory, dtype=numpy.float64, comments='#', ndmin=2)
+
+    if values.size and values.shape[1] != len(header):
+        raise ValueError('Number of columns in {0} does not match header'.format(path))
+
+    return header, values
+
+
+def _cache_key(files):
+
+    key = []
+    for path in files:
+        stat = os.stat(path)
+        key.append((os.path.abspath(path), stat.st_mtime, stat.st_size))
+
+    return tuple(key)
+
+
+def load_replica_trajectories(files, max_workers=None, use_processes=False, use_cache=True):
+    """
+    Load a set of replica trajectory files concurrently into one columnar frame
+
+    Files are parsed in a thread pool by default as parsing is dominated by
+    file I/O. Use `use_processes` for very large files on a multi-core
+    machine. The parsed replicas are written once into a single preallocated
+    column-major block, every column in the returned frame is a contiguous
+    read-only view on that block. No intermediate concatenation copies are
+    made.
+
+    The frame is cached per file set and returned as is when the same, and
+    unmodified, files are requested again. The cache holds the
+    TRAJECTORY_CACHE_SIZE most recently used frames.
+
+    :param files:         trajectory files to load, all with the same columns
+    :type files:          :py:list
+    :param max_workers:   maximum number of parallel parsers, defaults to the
+                          number of files capped by the executor default
+    :type max_workers:    :py:int
+    :param use_processes: parse in a process pool instead of a thread pool
+    :type use_processes:  :py:bool
+    :param use_cache:     use the per file set frame cache
+    :type use_cache:      :py:bool
+
+    :return:              'pose', 'replica' and 'frame' key columns followed
+                          by all trajectory columns
+    :rtype:               :py:collections.OrderedDict
+    """
+
+    files = sorted(files, key=parse_replica_id)
+    if not files:
+        raise ValueError('No trajectory files to load')
+
+    key = _cache_key(files)
+    if use_cache:
+        with _TRAJECTORY_CACHE_LOCK:
+            if key in _TRAJECTORY_CACHE:
+                _TRAJECTORY_CACHE.move_to_end(key)
+                return _TRAJECTORY_CACHE[key]
+
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=max_workers or min(len(files), 32)) as executor:
+        parsed = list(executor.map(read_energy_file, files))
+
+    header = parsed[0][0]
+    for path, (columns, _) in zip(files, parsed):
+        if columns != header:
+            raise ValueError('Columns in {0} differ from {1}'.format(path, files[0]))
+
+    nrows = sum(values.shape[0] for _, values in parsed)
+    block = numpy.empty((nrows, len(header)), dtype=numpy.float64, order='F')
+    pose = numpy.empty(nrows, dtype=numpy.int32)
+    replica = numpy.empty(nrows, dtype=numpy.int32)
+
+    start = 0
+    for path, (_, values) in zip(files, parsed):
+        stop = start + values.shape[0]
+        block[start:stop] = values
+        pose[start:stop], replica[start:stop] = parse_replica_id(path)
+        start = stop
+
+    for array in (block, pose, replica):
+        array.flags.writeable = False
+
+    frame = OrderedDict([('pose', pose), ('replica', replica)])
+    if 'FRAME' in header:
+        frame['frame'] = block[:, header.index('FRAME')].astype(numpy.int64)
+    else:
+        frame['frame'] = numpy.arange(nrows)
+    for i, column in enumerate(header):
+        if column != 'FRAME':
+            frame[column] = block[:, i]
+
+    if use_cache:
+        with _TRAJECTORY_CACHE_LOCK:
+            _TRAJECTORY_CACHE[key] = frame
+            while len(_TRAJECTORY_CACHE) > TRAJECTORY_CACHE_SIZE:
+                _TRAJECTORY_CACHE.popitem(last=False)
+
+    return frame
+
+
+def clear_trajectory_cache():
+    """
+    Remove all cached trajectory frames
+    """
+
+    with _TRAJECTORY_CACHE_LOCK:
+        _TRAJECTORY_CACHE.clear()
+
+
+def collect_replica_trajectories(bound_trajectory=None, unbound_trajectory=None, decompose_files=None,
+                                 lie_vdw_header='vdwLIE', lie_ele_header='EleLIE', **kwargs):
+    """
+    Collect bound, unbound and decomposition replica trajectories
+
+    Loads all replica files concurrently, validates them and returns the
+    files ordered by (pose, replica) in the form the lie_pylie
+    collect_energy_trajectories endpoint takes them. The parsed frames stay
+    in the trajectory frame cache for in-process consumers.
+
+    :param bound_trajectory:   bound ligand energy trajectory files
+    :type bound_trajectory:    :py:list
+    :param unbound_trajectory: unbound ligand energy trajectory file(s)
+    :type unbound_trajectory:  :py:str or :py:list
+    :param decompose_files:    residue decomposition files
+    :type decompose_files:     :py:list
+    :param lie_vdw_header:     trajectory column with the vdw LIE energy
+    :type lie_vdw_header:      :py:str
+    :param lie_ele_header:     trajectory column with the coulomb LIE energy
+    :type lie_ele_header:      :py:str
+    :param kwargs:             additional keyword arguments passed to
+                               `load_replica_trajectories`
+
+    :return:                   ordered trajectory files and replica counts
+    :rtype:                    :py:dict
+    """
+
+    options = dict((k, v) for k, v in kwargs.items() if k in ('max_workers', 'use_processes', 'use_cache'))
+    single_unbound = isinstance(unbound_trajectory, str)
+    if single_unbound:
+        unbound_trajectory = [unbound_trajectory]
+    if not bound_trajectory or not unbound_trajectory:
+        raise ValueError('Both bound and unbound trajectory files are required')
+
+    output = {}
+    frames = {}
+    for name, files in (('bound_trajectory', bound_trajectory), ('unbound_trajectory', unbound_trajectory),
+                        ('decompose_files', decompose_files)):
+        if not files:
+            continue
+
+        frame = frames[name] = load_replica_trajectories(files, **options)
+        output[name] = sorted(files, key=parse_replica_id)
+        replicas = numpy.unique(numpy.stack([frame['pose'], frame['replica']], axis=1), axis=0)
+        output['{0}_replicas'.format(name)] = len(replicas)
+        output['{0}_frames'.format(name)] = len(frame['frame'])
+
+    # Replica 0 is the unbound ligand simulation
+    if numpy.any(frames['unbound_trajectory']['replica'] != 0):
+        raise ValueError('Unbound trajectory files should be replica 0: {0}'.format(unbound_trajectory))
+    if numpy.any(frames['bound_trajectory']['replica'] == 0):
+        raise ValueError('Bound trajectory files should not be replica 0: {0}'.format(bound_trajectory))
+
+    for name in ('bound_trajectory', 'unbound_trajectory'):
+        missing = [column for column in (lie_vdw_header, lie_ele_header) if column not in frames[name]]
+        if missing:
+            raise ValueError('Columns {0} not in {1} files'.format(', '.join(missing), name))
+
+    if single_unbound:
+        output['unbound_trajectory'] = output['unbound_trajectory'][0]
+
+    return output
@@ -9,8 +9,6 @@ from mdstudio.deferred.chainable import chainable
 from mdstudio.component.session import ComponentSession
 from mdstudio.runner import main
 
-from mdstudio_workflow import Workflow
-
 
 class LIEPredictionWorkflow(ComponentSession):
     """
@@ -42,6 +40,8 @@ class LIEPredictionWorkflow(ComponentSession):
     @chainable
     def on_run(self):
 
+        from mdstudio_workflow import Workflow
+
         # Ligand to make prediction for
         ligand = 'O1[C@@H](CCC1=O)CCC'
         ligand_format = 'smi'
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import os
-import pickle
+import sys
 import json
+import time
+import pickle
+
+# Shared workflow_tools package, used from the source tree when not installed
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow_tools'))
 
 from autobahn.twisted.util import sleep
 
@@ -10,10 +15,18 @@ from mdstudio.deferred.chainable import chainable
 from mdstudio.component.session import ComponentSession
 from mdstudio.runner import main
 
-from mdstudio_workflow import Workflow
+from artifact_cache import ArtifactCache, CachingSessionMixin
+from file_transport import FileTransport, FileTransportSessionMixin
+from task_context import TaskContextSessionMixin, register_workflow, tag_tasks
+from workflow_tracing import TracingSessionMixin, EndpointTracingSessionMixin, WorkflowTracer
+from output_store import AsyncOutputStore, PersistingSessionMixin
+from task_scheduler import ScheduledSessionMixin
+from workflow_tools.retry_policy import RetrySessionMixin, RetryPolicy, is_transient_or_runtime_error
 
 
-class LIEWorkflow(ComponentSession):
+class LIEWorkflow(TracingSessionMixin, FileTransportSessionMixin, RetrySessionMixin, ScheduledSessionMixin,
+                  PersistingSessionMixin, CachingSessionMixin, EndpointTracingSessionMixin, TaskContextSessionMixin,
+                  ComponentSession):
     """
     This workflow will perform a binding affinity prediction for CYP 1A2 with
     applicability domain analysis using the Linear Interaction Energy (LIE)
@@ -26,8 +39,40 @@ class LIEWorkflow(ComponentSession):
 
     The workflow uses data from the pre-calibrated CYP1A2 model created using
     the eTOX ALLIES Linear Interaction Energy pipeline.
+
+    Task calls of all LIEWorkflow instances in a process are dispatched by a
+    shared scheduler. Ligand pre-processing is on the critical path of the
+    workflow and has priority over docking and MD tasks of other workflows.
     """
 
+    task_priorities = {
+        'mdgroup.mdstudio_structures.endpoint.convert': 0,
+        'mdgroup.mdstudio_structures.endpoint.make3d': 0,
+        'mdgroup.mdstudio_structures.endpoint.addh': 0,
+        'mdgroup.mdstudio_structures.endpoint.info': 0,
+        'mdgroup.mdstudio_amber.endpoint.acpype': 0
+    }
+
+    # Retry only transient errors with exponential backoff. 3D coordinate
+    # generation fails at random, also retry its runtime errors and make a
+    # duplicate call to another instance if it is slow to respond.
+    retry_policies = {
+        'mdgroup.mdstudio_structures.endpoint.make3d': RetryPolicy(max_attempts=3, hedge_after=30,
+                                                                   classify=is_transient_or_runtime_error),
+        'mdgroup.mdstudio_amber.endpoint.acpype': RetryPolicy(max_attempts=3)
+    }
+
+    # Docking and MD output is only used by PythonTask helpers, these get the
+    # output object from the in-process artifact cache.
+    cached_outputs = (
+        'mdgroup.mdstudio_smartcyp.endpoint.docking',
+        'mdgroup.mdstudio_gromacs.endpoint.gromacs_ligand',
+        'mdgroup.mdstudio_gromacs.endpoint.gromacs_protein'
+    )
+
+    # Seconds between workflow state checkpoints
+    checkpoint_interval = 60
+
     def authorize_request(self, uri, claims):
         """
         Microservice specific authorization method.
@@ -40,6 +85,8 @@ class LIEWorkflow(ComponentSession):
     @chainable
     def on_run(self):
 
+        from mdstudio_workflow import Workflow
+
         # Ligand to make prediction for
         ligand = 'O1[C@@H](CCC1=O)CCC'
         ligand_format = 'smi'
@@ -53,9 +100,30 @@ class LIEWorkflow(ComponentSession):
         modelpicklefile = os.path.join(liemodel, 'params.pkl')
         modelfile = pickle.load(open(modelpicklefile))
 
+        # Large static protein files are sent by reference to a shared blob
+        # store instead of being inlined in every task call. Other task input
+        # files are inlined as usual.
+        transport = self.file_transport = FileTransport()
+        protein_include = transport.path_files([os.path.join(liemodel, model['proteinTopPos']),
+                                                os.path.join(liemodel, 'attype.itp')])
+        protein_top = transport.path_file(os.path.join(liemodel, model['proteinTop']))
+
+        # Both MD tasks use the same Cerise config so the GROMACS service can
+        # run them on one pooled Cerise service (see cerise_pool.py)
+        cerise_file = os.path.join(os.getcwd(), 'cerise_config_gt.json')
+
         # Build Workflow
         wf = Workflow(project_dir='./allies_run')
         wf.task_runner = self
+        self.workflow_id = register_workflow(self)
+
+        # Docking and MD input and output is persisted by a background writer
+        # instead of blocking the reactor, the workflow state only holds
+        # references to the large output. Large output is compressed. A task
+        # completes once its output is on disk. Every workflow run has its
+        # own store and artifact cache.
+        self.output_store = AsyncOutputStore('./allies_run', compress='zstd').start()
+        self.artifacts = ArtifactCache(self.output_store)
 
         # STAGE 1: LIGAND PRE-PROCESSING
         # Convert ligand to mol2 irrespective of input format.
@@ -92,8 +160,7 @@ class LIEWorkflow(ComponentSession):
         # Run acpype on ligands
         t5 = wf.add_task('ACPYPE',
                          task_type='WampTask',
-                         uri='mdgroup.mdstudio_amber.endpoint.acpype',
-                         retry_count=3)
+                         uri='mdgroup.mdstudio_amber.endpoint.acpype')
         wf.connect_task(t3.nid, t5.nid, mol='structure')
         wf.connect_task(t4.nid, t5.nid, charge='net_charge')
 
@@ -110,11 +177,13 @@ class LIEWorkflow(ComponentSession):
         # Run PLANTS on ligand and protein
         t7 = wf.add_task('Plants docking',
                          task_type='WampTask',
-                         uri='mdgroup.mdstudio_smartcyp.endpoint.docking')
+                         uri='mdgroup.mdstudio_smartcyp.endpoint.docking',
+                         store_output=False)
         t7.set_input(cluster_structures=100,
                      bindingsite_center=model['proteinParams'][0]['pocket'],
                      bindingsite_radius=model['proteinParams'][0]['radius'],
-                     protein_file=os.path.join(liemodel, model['proteinParams'][0]['proteinDock']),
+                     protein_file=transport.path_file(
+                         os.path.join(liemodel, model['proteinParams'][0]['proteinDock'])),
                      threshold=3.0,
                      base_work_dir='/tmp/mdstudio/mdstudio_smartcyp')
         wf.connect_task(t6.nid, t7.nid, mol='ligand_file')
@@ -130,13 +199,13 @@ class LIEWorkflow(ComponentSession):
         t14 = wf.add_task('MD ligand in water',
                           task_type='WampTask',
                           uri='mdgroup.mdstudio_gromacs.endpoint.gromacs_ligand',
-                          store_output=True)
+                          store_output=False)
         t14.set_input(sim_time=0.001, #sim_time=model['timeSim'],
-                      include=[os.path.join(liemodel, model['proteinTopPos']), os.path.join(liemodel, 'attype.itp')],
+                      include=protein_include,
                       residues=model['resSite'],
                       protein_file=None,
-                      protein_top=os.path.join(liemodel, model['proteinTop']),
-                      cerise_file=os.path.join(os.getcwd(), 'cerise_config_gt.json'))
+                      protein_top=protein_top,
+                      cerise_file=cerise_file)
         wf.connect_task(t5.nid, t14.nid, new_pdb='ligand_file', gmx_itp='topology_file')
 
         # convert PLANTS mol2 to pdb
@@ -149,14 +218,16 @@ class LIEWorkflow(ComponentSession):
         # Run MD for protein + ligand
         t16 = wf.add_task('MD protein-ligand',
                           task_type='WampTask',
-                          uri='mdgroup.mdstudio_gromacs.endpoint.gromacs_protein')
+                          uri='mdgroup.mdstudio_gromacs.endpoint.gromacs_protein',
+                          store_output=False)
         t16.set_input(sim_time=0.001,
-                      include=[os.path.join(liemodel, model['proteinTopPos']), os.path.join(liemodel, 'attype.itp')],
+                      include=protein_include,
                       residues=model['resSite'],
                       charge=model['charge'],
-                      cerise_file=os.path.join(os.getcwd(), 'cerise_config_gt.json'),
-                      protein_file=os.path.join(liemodel, model['proteinParams'][0]['proteinCoor']),
-                      protein_top=os.path.join(liemodel, model['proteinTop']))
+                      cerise_file=cerise_file,
+                      protein_file=transport.path_file(
+                          os.path.join(liemodel, model['proteinParams'][0]['proteinCoor'])),
+                      protein_top=protein_top)
         wf.connect_task(t15.nid, t16.nid, mol='ligand_file')
         wf.connect_task(t5.nid, t16.nid, gmx_itp='topology_file')
 
@@ -232,9 +303,41 @@ class LIEWorkflow(ComponentSession):
         # Save the workflow specification
         wf.save('workflow_spec.jgf')
 
+        # Tag the tasks of this run so their calls can be traced and
+        # persisted per task. The tags are not part of the saved
+        # specification.
+        tag_tasks(self.workflow_id, t1, t2, t3, t4, t5, t6, t7, t8, t14, t15, t16, t17, t18, t19, t20, t21, t22,
+                  t23, t24, t25)
+
+        self.persisted_tasks = (t7.nid, t14.nid, t16.nid)
+
+        # With MDSTUDIO_WORKFLOW_TRACE set, task timings and payload sizes
+        # are written as Chrome trace to the project directory
+        if self.tracing:
+            self.tracer = WorkflowTracer()
+
+        # Checkpoint the workflow state regularly, persisted output is synced
+        # to disk once before every checkpoint
+        checkpoint_file = os.path.join('./allies_run', 'workflow_checkpoint.jgf')
+        last_checkpoint = time.time()
+
         wf.run()
         while wf.is_running:
             yield sleep(1)
+            if time.time() - last_checkpoint > self.checkpoint_interval:
+                yield self.checkpoint(wf, checkpoint_file)
+                last_checkpoint = time.time()
+
+        yield self.checkpoint(wf, checkpoint_file)
+
+        self.output_store.close()
+        self.artifacts.clear()
+        if self.tracer is not None:
+            trace_file = os.path.abspath(os.path.join('./allies_run', 'trace.json'))
+            self.tracer.save(trace_file)
+            self.log.info('Workflow task timings, trace written to {0}:\n{1}'.format(trace_file,
+                                                                                       self.tracer.summary()))
+        self.log.info('Retry statistics: {0}'.format(self.retry_stats))
 
 
 if __name__ == "__main__":
@@ -6,7 +6,15 @@ file: allies_workflow_helpers.py
 Helper Python functions used in the allies workflow.
 """
 
+from collections.abc import Mapping
 
+from artifact_cache import uses_artifacts
+from workflow_tools.docking_index import is_paged, iter_docking_index, fetch_pose
+from workflow_tracing import traced
+
+
+@traced
+@uses_artifacts
 def get_docking_medians(**kwargs):
     """
     Get median docking solutions after clustering of docking poses.
@@ -17,20 +25,27 @@ def get_docking_medians(**kwargs):
     :return:
     """
 
-    medians = [v.get('PATH') for v in kwargs.get('result', {}).values() if v.get('MEAN', True)]
+    result = kwargs.get('result', {})
+    if is_paged(result):
+        # Stream the index and extract the median structures only
+        medians = [fetch_pose(result, entry) for entry in iter_docking_index(result) if entry['mean']]
+    else:
+        medians = [v.get('PATH') for v in result.values() if v.get('MEAN', True)]
 
     return {'medians': medians}
 
 
+@traced
+@uses_artifacts
 def collect_md_enefiles(bound=None, unbound=None, **kwargs):
 
     # Get the output from the MD microservice
     output = {'unbound_trajectory': unbound['results']['energy_dataframe']}
 
-    if isinstance(bound, dict):
+    if isinstance(bound, Mapping):
         output['bound_trajectory'] = [bound['results']['energy_dataframe']]
         output['decomp_files'] = [bound['results']['decompose_dataframe']]
-    elif isinstance(bound, list):
+    elif isinstance(bound, (list, tuple)):
         output['bound_trajectory'] = [b['results']['energy_dataframe'] for b in bound]
         output['decomp_files'] = [b['results']['decompose_dataframe']for b in bound]
 
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: artifact_cache.py
+
+In-process cache passing task output to PythonTasks by reference.
+
+PythonTask helpers such as `get_docking_medians` and `collect_md_enefiles`
+run in the workflow process but receive their input as a copy of the
+stored output of the producing task. For large docking and MD output this
+means a full serialization round trip for every in-process step.
+
+* Tasks persisted by the PersistingSessionMixin hand the workflow manager
+  small {'$output': {'task': nid, 'parameter': name, 'project_dir': path}}
+  references instead of their output (see output_store.py).
+* CachingSessionMixin keeps the response of endpoints listed in
+  `cached_outputs` by task node id in the ArtifactCache of the workflow
+  session, every workflow run has its own cache.
+* Helpers decorated with `uses_artifacts` look up the cache of the
+  workflow running the task (see task_context.py) and receive the cached
+  objects for these references as read-only views: dictionaries are
+  MappingProxyType and lists tuples. The containers are copied once when
+  the object is cached, the values they hold (e.g. file content) are
+  shared with the response and not copied again for every consumer.
+  Output that is not cached is loaded from the output store. When the
+  workflow that made the references is not running in the process, for
+  instance when a workflow is resumed in a new process, the output is
+  loaded from the project directory in the reference.
+
+The references in the workflow state are durable: the output store is
+flushed before every workflow checkpoint.
+"""
+
+import os
+import functools
+import threading
+
+from collections.abc import Mapping
+from types import MappingProxyType
+
+from output_store import OUTPUT_KEY, is_output_reference, load_output
+from task_context import task_nid, task_workflow, untag
+
+
+def freeze(data):
+    """
+    Return a read-only view of nested dictionaries and lists
+
+    Containers are rebuilt once as MappingProxyType and tuples, the values
+    they hold are shared with the original.
+    """
+
+    if isinstance(data, Mapping):
+        return MappingProxyType(dict((key, freeze(value)) for key, value in data.items()))
+    if isinstance(data, (list, tuple)):
+        return tuple(freeze(value) for value in data)
+
+    return data
+
+
+def thaw(data):
+    """
+    Return a plain, serializable copy of a read-only view
+    """
+
+    if isinstance(data, Mapping):
+        return dict((key, thaw(value)) for key, value in data.items())
+    if isinstance(data, (list, tuple)):
+        return [thaw(value) for value in data]
+
+    return data
+
+
+class ArtifactCache(object):
+    """
+    Store of read-only task output objects of a workflow run
+
+    :param output_store: AsyncOutputStore to load output from that is not
+                         cached. Without it, or for references to another
+                         project directory, the output is loaded from the
+                         project directory in the reference.
+    """
+
+    def __init__(self, output_store=None):
+
+        self.output_store = output_store
+        self._artifacts = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._artifacts)
+
+    def put(self, task, data):
+        """
+        Cache the output object of a task
+
+        :param task: task node id
+        :type task:  :py:int
+        :param data: output object, should not be modified afterwards
+        """
+
+        with self._lock:
+            self._artifacts[task] = freeze(data)
+
+    def get(self, reference):
+        """
+        Return the read-only view of a referenced task output parameter
+
+        :param reference: reference made by `output_store.output_reference`
+        :type reference:  :py:dict
+        """
+
+        task, parameter = reference[OUTPUT_KEY]['task'], reference[OUTPUT_KEY]['parameter']
+        with self._lock:
+            output = self._artifacts.get(task)
+
+        if output is None:
+            project_dir = reference[OUTPUT_KEY]['project_dir']
+            store = self.output_store
+            if store is not None and os.path.abspath(project_dir) == store.project_dir:
+                output = freeze(store.load(task))
+            else:
+                output = freeze(load_output(project_dir, task))
+            with self._lock:
+                self._artifacts[task] = output
+
+        return output[parameter]
+
+    def resolve(self, data):
+        """
+        Return a copy of task input with output references replaced by the
+        cached objects
+        """
+
+        if is_output_reference(data):
+            return self.get(data)
+        if isinstance(data, Mapping):
+            return dict((key, self.resolve(value)) for key, value in data.items())
+        if isinstance(data, list):
+            return [self.resolve(value) for value in data]
+
+        return data
+
+    def clear(self):
+
+        with self._lock:
+            self._artifacts.clear()
+
+
+def uses_artifacts(func):
+    """
+    Decorator for PythonTask helpers receiving cached artifacts
+
+    Output references in the keyword arguments are replaced by read-only
+    views of the objects cached by the workflow running the task. When that
+    workflow is not running in this process the references are loaded from
+    their project directory. The result is returned as plain serializable
+    data.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+
+        cache = getattr(task_workflow(kwargs), 'artifacts', None)
+        if cache is None:
+            cache = ArtifactCache()
+        kwargs = cache.resolve(kwargs)
+
+        return thaw(func(*args, **untag(kwargs)))
+
+    return wrapper
+
+
+class CachingSessionMixin(object):
+    """
+    Session mixin caching the response of the endpoint uris listed in
+    `cached_outputs` by task node id
+
+    Set `artifacts` to an ArtifactCache per workflow run. Use after the
+    PersistingSessionMixin so the full response is cached and the workflow
+    manager gets output references.
+    """
+
+    cached_outputs = ()
+    artifacts = None
+
+    def call(self, procedure, request, *args, **kwargs):
+
+        deferred = super(CachingSessionMixin, self).call(procedure, request, *args, **kwargs)
+        nid = task_nid(request)
+        if self.artifacts is None or procedure not in self.cached_outputs or nid is None:
+            return deferred
+
+        def on_response(response):
+            if isinstance(response, Mapping):
+                self.artifacts.put(nid, response)
+            return response
+
+        return deferred.addCallback(on_response)
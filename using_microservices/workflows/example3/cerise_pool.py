@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: cerise_pool.py
+
+Pooled Cerise service connections and batched remote MD job submission.
+
+The GROMACS tasks in the ALLIES workflow run MD remotely on an HPC
+machine through a Cerise service managed in a docker container described
+by a cerise config file (cerise_config_*.json). Setting up a Cerise
+session and submitting a job dominates the run time of short test MD runs
+and is a large part of production throughput.
+
+* CerisePool keeps one managed Cerise service per config, keyed by the
+  config content, and shares it between all jobs using the same config.
+* CeriseJobBatcher collects job submissions for a short time window and
+  submits them as one Cerise job running a batch workflow that takes a
+  list of job inputs and returns a list of outputs in the same order.
+
+The default service factory uses the cerise_client package. FakeCeriseService
+implements the part of the cerise_client service and job API used here
+and runs jobs locally to test pooling and batching without HPC access.
+"""
+
+import json
+import time
+import hashlib
+import threading
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThread
+
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_BATCH_WINDOW = 5.0
+DEFAULT_POLL_INTERVAL = 5.0
+
+
+def load_cerise_config(cerise_file):
+    """
+    Load a Cerise config file
+
+    :param cerise_file: cerise config JSON file
+    :type cerise_file:  :py:str
+
+    :rtype:             :py:dict
+    """
+
+    with open(cerise_file, 'r') as cf:
+        return json.load(cf)
+
+
+def config_key(config):
+    """
+    Pool key for a Cerise config: SHA-256 of its canonical JSON
+    """
+
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def managed_service_factory(config):
+    """
+    Start or connect to a managed Cerise service using cerise_client
+    """
+
+    import cerise_client.service as cc
+    return cc.require_managed_service(config['docker_name'], config['port'], config['docker_image'],
+                                      config['username'], config['password'])
+
+
+class CerisePool(object):
+    """
+    Share managed Cerise services between jobs using the same config
+
+    :param service_factory: function returning a Cerise service for a
+                            config, cerise_client managed services by
+                            default
+    :type service_factory:  :py:func
+    """
+
+    def __init__(self, service_factory=managed_service_factory):
+
+        self.service_factory = service_factory
+        self._services = {}
+        self._lock = threading.Lock()
+        self.created = 0
+
+    def get(self, config):
+        """
+        Return the Cerise service for a config, creating it on first use
+
+        :param config: Cerise config
+        :type config:  :py:dict
+        """
+
+        key = config_key(config)
+        with self._lock:
+            if key not in self._services:
+                self._services[key] = self.service_factory(config)
+                self.created += 1
+
+            return self._services[key]
+
+    def clear(self):
+
+        with self._lock:
+            self._services.clear()
+
+
+class CeriseJobBatcher(object):
+    """
+    Pack job submissions for one Cerise config into batch jobs
+
+    A batch is submitted when `batch_size` jobs are collected or
+    `batch_window` seconds after the first job of the batch arrived.
+
+    :param pool:           CerisePool to get the service from
+    :type pool:            :py:CerisePool
+    :param config:         Cerise config
+    :type config:          :py:dict
+    :param batch_workflow: CWL workflow running a list of jobs, receives the
+                           job inputs as 'jobs' input and returns the job
+                           outputs as 'results' output
+    :type batch_workflow:  :py:str
+    :param clock:          scheduler for the batch window timer, the twisted
+                           reactor by default
+    :param run_in_thread:  function running a blocking function outside the
+                           reactor thread, returns a Deferred. `deferToThread`
+                           by default
+    :type run_in_thread:   :py:func
+    """
+
+    def __init__(self, pool, config, batch_workflow, batch_size=DEFAULT_BATCH_SIZE,
+                 batch_window=DEFAULT_BATCH_WINDOW, poll_interval=DEFAULT_POLL_INTERVAL, clock=reactor,
+                 run_in_thread=deferToThread):
+
+        self.pool = pool
+        self.config = config
+        self.batch_workflow = batch_workflow
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.run_in_thread = run_in_thread
+        self.batches = 0
+
+        self._pending = []
+        self._timer = None
+
+    def submit(self, job_input):
+        """
+        Add a job to the current batch
+
+        :param job_input: input of a single MD job
+        :type job_input:  :py:dict
+
+        :return:          Deferred firing with the job output
+        """
+
+        result = Deferred()
+        self._pending.append((job_input, result))
+
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self.clock.callLater(self.batch_window, self.flush)
+
+        return result
+
+    def flush(self):
+        """
+        Submit all pending jobs as one batch job now
+        """
+
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        self.batches += 1
+        inputs = [job_input for job_input, _ in batch]
+        deferred = self.run_in_thread(self._run_batch, inputs)
+
+        def distribute(outputs):
+            for (_, result), output in zip(batch, outputs):
+                result.callback(output)
+
+        def fail(failure):
+            for _, result in batch:
+                result.errback(failure)
+
+        deferred.addCallbacks(distribute, fail)
+
+    def _run_batch(self, inputs):
+        """
+        Run a batch job on the pooled service, blocking, in a worker thread
+        """
+
+        service = self.pool.get(self.config)
+        job = service.create_job('mdstudio_batch_{0}_{1}'.format(int(time.time()), self.batches))
+        job.set_workflow(self.batch_workflow)
+        job.set_input('jobs', inputs)
+        job.run()
+
+        while job.is_running():
+            time.sleep(self.poll_interval)
+
+        if job.state != 'Success':
+            raise RuntimeError('Cerise batch job {0} ended with state {1}'.format(job.name, job.state))
+
+        outputs = job.outputs['results']
+        if len(outputs) != len(inputs):
+            raise RuntimeError('Cerise batch job {0} returned {1} results for {2} jobs'.format(
+                job.name, len(outputs), len(inputs)))
+
+        return outputs
+
+
+class FakeCeriseJob(object):
+    """
+    Local stand-in for a cerise_client job
+    """
+
+    def __init__(self, name, runner):
+
+        self.name = name
+        self.state = 'Waiting'
+        self.inputs = {}
+        self.outputs = None
+        self.workflow = None
+        self._runner = runner
+
+    def set_workflow(self, workflow):
+        self.workflow = workflow
+
+    def set_input(self, name, value):
+        self.inputs[name] = value
+
+    def add_input_file(self, name, path):
+        self.inputs[name] = path
+
+    def run(self):
+
+        self.state = 'Running'
+        try:
+            self.outputs = {'results': [self._runner(job_input) for job_input in self.inputs.get('jobs', [])]}
+            self.state = 'Success'
+        except Exception:
+            self.state = 'PermanentFailure'
+
+    def is_running(self):
+        return self.state in ('Waiting', 'Running')
+
+
+class FakeCeriseService(object):
+    """
+    Local stand-in for a managed Cerise service
+
+    :param runner: function computing the output of a single job input,
+                   echoes the input by default
+    :type runner:  :py:func
+    """
+
+    def __init__(self, config, runner=None):
+
+        self.config = config
+        self.jobs = []
+        self._runner = runner or (lambda job_input: job_input)
+
+    def create_job(self, name):
+
+        job = FakeCeriseJob(name, self._runner)
+        self.jobs.append(job)
+        return job
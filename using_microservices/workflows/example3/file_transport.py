@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: file_transport.py
+
+Reference based file transport for workflow task input.
+
+Files are passed between tasks as 'path_file' objects
+({'content': ..., 'path': ..., 'extension': ...}). By default the file
+content is inlined in the WAMP message which becomes expensive for large
+static files such as protein topologies that are sent again for every
+ligand and every task.
+
+The FileTransport inlines small files as usual but stores files above a size
+threshold once in a content addressed blob store on a file system shared
+between the workflow and the microservices (by default the same /tmp/mdstudio
+directory used as docker volume by the example services). Only a path_file
+reference with 'content' set to None is sent. Blobs are named after the
+SHA-256 of their content making them deduplicated across tasks and workflow
+runs. Endpoints resolve a reference lazily and read it memory-mapped using
+`open_path_file`.
+
+The workflow manager inlines all path_file task input by default. Sessions
+using the FileTransportSessionMixin keep blob store references as
+references, other path_file input such as files produced by upstream tasks
+is inlined as usual.
+"""
+
+import os
+import io
+import json
+import mmap
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from contextlib import contextmanager
+
+DEFAULT_BLOB_STORE = '/tmp/mdstudio/blobs'
+DEFAULT_INLINE_THRESHOLD = 64 * 1024
+
+
+class BlobStore(object):
+    """
+    Content addressed file store
+
+    Blobs are stored as <root>/<first two digest characters>/<digest>.<ext>.
+    File digests are cached in an index (<root>/index.json) by absolute
+    path, modification time and size so unchanged source files are not
+    hashed again in subsequent runs.
+    """
+
+    def __init__(self, root=DEFAULT_BLOB_STORE):
+
+        self.root = os.path.abspath(root)
+        self._index_file = os.path.join(self.root, 'index.json')
+        self._index = None
+        self._index_changed = False
+        self._lock = threading.Lock()
+
+    def _load_index(self):
+
+        if self._index is None:
+            self._index = {}
+            if os.path.isfile(self._index_file):
+                with open(self._index_file, 'r') as index:
+                    self._index = json.load(index)
+
+        return self._index
+
+    def _save_index(self):
+
+        handle, tmp_file = tempfile.mkstemp(dir=self.root, suffix='.json')
+        with os.fdopen(handle, 'w') as index:
+            json.dump(self._index, index)
+        os.replace(tmp_file, self._index_file)
+
+    def digest(self, path):
+        """
+        Return the SHA-256 hex digest of a file using the digest index
+
+        :param path: file path
+        :type path:  :py:str
+
+        :rtype:      :py:str
+        """
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        signature = [stat.st_mtime, stat.st_size]
+
+        with self._lock:
+            cached = self._load_index().get(path)
+            if cached and cached['signature'] == signature:
+                return cached['sha256']
+
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as source:
+            for chunk in iter(lambda: source.read(io.DEFAULT_BUFFER_SIZE * 16), b''):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+
+        with self._lock:
+            self._load_index()[path] = {'signature': signature, 'sha256': digest}
+            self._index_changed = True
+
+        return digest
+
+    def blob_path(self, digest, extension=None):
+        """
+        Return the path to a blob in the store
+
+        :param digest:    blob SHA-256 hex digest
+        :type digest:     :py:str
+        :param extension: file extension
+        :type extension:  :py:str
+
+        :rtype:           :py:str
+        """
+
+        name = '{0}.{1}'.format(digest, extension) if extension else digest
+        return os.path.join(self.root, digest[:2], name)
+
+    def put(self, path, extension=None):
+        """
+        Add a file to the store if not already there
+
+        The file is copied into the store, never linked, so later changes to
+        the source file do not change the blob. A blob is written to a
+        temporary file first and moved in place to keep concurrent writers
+        from exposing partial blobs. Blobs are made read-only.
+
+        :param path:      file path
+        :type path:       :py:str
+        :param extension: file extension, defaults to the source extension
+        :type extension:  :py:str
+
+        :return:          path to the blob
+        :rtype:           :py:str
+        """
+
+        if extension is None:
+            extension = os.path.splitext(path)[1].lstrip('.') or None
+
+        blob = self.blob_path(self.digest(path), extension)
+        if not os.path.exists(blob):
+            blob_dir = os.path.dirname(blob)
+            if not os.path.isdir(blob_dir):
+                os.makedirs(blob_dir)
+
+            handle, tmp_blob = tempfile.mkstemp(dir=blob_dir, suffix='.tmp')
+            os.close(handle)
+            try:
+                shutil.copyfile(path, tmp_blob)
+                os.chmod(tmp_blob, 0o444)
+                os.replace(tmp_blob, blob)
+            except OSError:
+                if os.path.exists(tmp_blob):
+                    os.remove(tmp_blob)
+                raise
+
+        with self._lock:
+            if self._index_changed:
+                self._save_index()
+                self._index_changed = False
+
+        return blob
+
+
+class FileTransport(object):
+    """
+    Build 'path_file' task input inlining small files and referencing large
+    files in a shared BlobStore.
+
+    Use the FileTransportSessionMixin as workflow task runner to keep the
+    workflow manager from inlining the referenced blobs again.
+    """
+
+    def __init__(self, store=None, threshold=DEFAULT_INLINE_THRESHOLD):
+
+        self.store = store or BlobStore()
+        self.threshold = threshold
+
+    def path_file(self, path, extension=None):
+        """
+        Return a 'path_file' object for a file
+
+        :param path:      file path
+        :type path:       :py:str
+        :param extension: file extension, defaults to the file extension
+        :type extension:  :py:str
+
+        :rtype:           :py:dict
+        """
+
+        extension = extension or os.path.splitext(path)[1].lstrip('.')
+        if os.path.getsize(path) <= self.threshold:
+            with open(path, 'r') as source:
+                return {'content': source.read(), 'path': path, 'extension': extension}
+
+        return {'content': None, 'path': self.store.put(path, extension), 'extension': extension}
+
+    def path_files(self, paths):
+        """
+        Return a list of 'path_file' objects for multiple files
+
+        :param paths: file paths
+        :type paths:  :py:list
+
+        :rtype:       :py:list
+        """
+
+        return [self.path_file(path) for path in paths]
+
+    def is_reference(self, value):
+        """
+        Return True for a 'path_file' object of a blob in the store
+        """
+
+        return isinstance(value, dict) and 'content' in value and isinstance(value.get('path'), str) and \
+            os.path.abspath(value['path']).startswith(self.store.root + os.sep)
+
+    def dereference(self, request):
+        """
+        Drop inlined content of blob store 'path_file' objects in a request
+
+        :param request: task request
+        :type request:  :py:dict
+
+        :return:        request with blob store files passed by reference
+        :rtype:         :py:dict
+        """
+
+        if self.is_reference(request):
+            return dict(request, content=None)
+        if isinstance(request, dict):
+            return dict((key, self.dereference(value)) for key, value in request.items())
+        if isinstance(request, list):
+            return [self.dereference(value) for value in request]
+
+        return request
+
+
+class FileTransportSessionMixin(object):
+    """
+    Session mixin sending blob store files by reference
+
+    The workflow manager inlines 'path_file' task input before calling the
+    task runner. Blob store files in a request are set back to references
+    from the session `file_transport` before the call is made. Other files
+    are sent inlined.
+    """
+
+    file_transport = None
+
+    def call(self, procedure, request, *args, **kwargs):
+
+        if self.file_transport is not None:
+            request = self.file_transport.dereference(request)
+
+        return super(FileTransportSessionMixin, self).call(procedure, request, *args, **kwargs)
+
+
+@contextmanager
+def open_path_file(path_file):
+    """
+    Open 'path_file' content for reading
+
+    Inlined content is returned as bytes, referenced files are resolved only
+    when opened and memory-mapped read-only so large files are paged in on
+    demand rather than read at once.
+
+    :param path_file: path_file object
+    :type path_file:  :py:dict
+
+    :return:          bytes like, read only, file content
+    """
+
+    if path_file.get('content') is not None:
+        content = path_file['content']
+        yield content.encode('utf-8') if not isinstance(content, bytes) else content
+        return
+
+    with open(path_file['path'], 'rb') as source:
+        if os.fstat(source.fileno()).st_size == 0:
+            yield b''
+            return
+
+        mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mapped
+        finally:
+            mapped.close()
@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: output_store.py
+
+Asynchronous, batched persistence of task input and output.
+
+With `store_output=True` the workflow manager writes the input and output of
+every task synchronously to the project directory on the reactor thread.
+For concurrent workflow runs with large structure and trajectory output this
+blocking disk I/O delays all other tasks.
+
+The AsyncOutputStore moves these writes to a background writer thread for
+the tasks that opt in:
+
+* Records are keyed by task node id (see task_context.py). Small JSON
+  records are coalesced and appended in batches to one JSON-lines journal
+  (<project_dir>/task_records.jsonl).
+* Large string payloads (file content) are written out-of-line as separate
+  blob files, optionally compressed (zstd when the 'zstandard' package is
+  available, gzip otherwise). The record refers to the blob by file name.
+* Nothing is synced to disk per record. `flush()` blocks until all queued
+  writes are on disk and syncs the new blobs and the journal in one go.
+  The PersistingSessionMixin flushes when a persisted task completes, off
+  the reactor thread, so the workflow manager only sees the task complete
+  once its output is durable. Records of tasks completing at the same time
+  share one sync. Checkpoints are saved after a flush too, so they never
+  refer to output that is not persisted.
+
+Blob files are written to a temporary file and atomically renamed, the
+journal is only appended after the blobs it refers to are in place.
+"""
+
+import os
+import gzip
+import json
+import time
+import hashlib
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from collections.abc import Mapping
+
+from task_context import task_nid, untag
+
+DEFAULT_BLOB_THRESHOLD = 16 * 1024
+DEFAULT_BATCH_SIZE = 64
+JOURNAL_FILE = 'task_records.jsonl'
+BLOB_DIR = 'task_blobs'
+OUTPUT_KEY = '$output'
+
+_FLUSH = object()
+_STOP = object()
+
+
+class AsyncOutputStore(object):
+    """
+    Queue task records for persistence by a background writer thread
+
+    :param project_dir:     directory to write the journal and blobs to
+    :type project_dir:      :py:str
+    :param compress:        compression for large blobs: 'zstd', 'gzip' or
+                            None. 'zstd' falls back to 'gzip' when the
+                            zstandard package is not installed.
+    :type compress:         :py:str
+    :param blob_threshold:  string payloads larger than this number of
+                            characters are written out-of-line
+    :type blob_threshold:   :py:int
+    :param batch_size:      maximum number of records coalesced in one
+                            journal write
+    :type batch_size:       :py:int
+    """
+
+    def __init__(self, project_dir, compress='zstd', blob_threshold=DEFAULT_BLOB_THRESHOLD,
+                 batch_size=DEFAULT_BATCH_SIZE):
+
+        if compress == 'zstd' and zstandard is None:
+            compress = 'gzip'
+        if compress not in ('zstd', 'gzip', None):
+            raise ValueError('Unsupported compression: {0}'.format(compress))
+
+        self.project_dir = os.path.abspath(project_dir)
+        self.compress = compress
+        self.blob_threshold = blob_threshold
+        self.batch_size = batch_size
+
+        self._queue = queue.Queue()
+        self._unsynced = []
+        self._error = None
+        self._thread = None
+
+    def start(self):
+        """
+        Start the background writer thread
+        """
+
+        if self._thread is None:
+            for path in (self.project_dir, os.path.join(self.project_dir, BLOB_DIR)):
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+
+            self._thread = threading.Thread(target=self._writer, name='AsyncOutputStore')
+            self._thread.daemon = True
+            self._thread.start()
+
+        return self
+
+    def put(self, task, kind, data):
+        """
+        Queue a task record for writing, returns immediately
+
+        The data is serialized by the writer thread, it should not be
+        modified after it has been queued.
+
+        :param task: task node id
+        :type task:  :py:int
+        :param kind: record kind, e.g. 'input' or 'output'
+        :type kind:  :py:str
+        :param data: JSON serializable task data
+        """
+
+        if self._error:
+            raise IOError('Output store writer failed: {0}'.format(self._error))
+
+        self._queue.put({'task': task, 'kind': kind, 'time': time.time(), 'data': data})
+
+    def flush(self, timeout=None):
+        """
+        Block until all queued records are written, then sync the blobs
+        and journal written since the previous flush to disk
+
+        :param timeout: maximum time to wait in seconds
+        :type timeout:  :py:float
+
+        :return:        True when flushed, False on timeout
+        :rtype:         :py:bool
+        """
+
+        if self._thread is None:
+            return True
+
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        flushed = done.wait(timeout)
+
+        if self._error:
+            raise IOError('Output store writer failed: {0}'.format(self._error))
+
+        return flushed
+
+    def flush_async(self):
+        """
+        Flush without blocking the reactor thread
+
+        :return: Deferred firing once all queued records are on disk
+        """
+
+        from twisted.internet.threads import deferToThread
+        return deferToThread(self.flush)
+
+    def load(self, task):
+        """
+        Load the last persisted output of a task
+
+        Flushes queued records first, blob content is resolved.
+
+        :param task: task node id
+        :type task:  :py:int
+
+        :raises KeyError: no output persisted for the task
+        """
+
+        self.flush()
+        return load_output(self.project_dir, task)
+
+    def close(self):
+        """
+        Flush all records and stop the writer thread
+        """
+
+        if self._thread is not None:
+            self.flush()
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def _write_blob(self, content):
+
+        raw = content.encode('utf-8') if not isinstance(content, bytes) else content
+        name = hashlib.sha256(raw).hexdigest()
+        if self.compress == 'zstd':
+            raw, name = zstandard.ZstdCompressor().compress(raw), name + '.zst'
+        elif self.compress == 'gzip':
+            raw, name = gzip.compress(raw, compresslevel=3), name + '.gz'
+
+        path = os.path.join(self.project_dir, BLOB_DIR, name)
+        if not os.path.exists(path):
+            with open(path + '.tmp', 'wb') as blob:
+                blob.write(raw)
+            os.rename(path + '.tmp', path)
+            self._unsynced.append(path)
+
+        return os.path.join(BLOB_DIR, name)
+
+    def _externalize(self, data):
+        """
+        Replace large string values by references to blob files
+        """
+
+        if isinstance(data, dict):
+            return dict((key, self._externalize(value)) for key, value in data.items())
+        if isinstance(data, (list, tuple)):
+            return [self._externalize(value) for value in data]
+        if isinstance(data, (str, bytes)) and len(data) > self.blob_threshold:
+            return {'$blob': self._write_blob(data)}
+
+        return data
+
+    def _write_batch(self, journal, batch):
+
+        lines = [json.dumps(dict(record, data=self._externalize(record['data'])), default=str)
+                 for record in batch]
+        journal.write('\n'.join(lines) + '\n')
+
+    def _sync(self, journal):
+        """
+        Sync the blobs written since the last sync, then the journal
+        """
+
+        for path in self._unsynced:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._unsynced = []
+
+        journal.flush()
+        os.fsync(journal.fileno())
+
+    def _writer(self):
+
+        journal = open(os.path.join(self.project_dir, JOURNAL_FILE), 'a')
+        try:
+            while True:
+                item = self._queue.get()
+
+                # Coalesce everything already queued up to batch_size
+                # records, flush requests queued in between share one sync
+                batch = []
+                flushes = []
+                stop = False
+                while item is not None:
+                    if item is _STOP:
+                        stop = True
+                        break
+                    if isinstance(item, tuple):
+                        flushes.append(item[1])
+                    else:
+                        batch.append(item)
+                        if len(batch) >= self.batch_size:
+                            break
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        item = None
+
+                try:
+                    if batch:
+                        self._write_batch(journal, batch)
+                    if flushes or stop:
+                        self._sync(journal)
+                except Exception as error:
+                    self._error = error
+
+                for done in flushes:
+                    done.set()
+                if stop:
+                    return
+        finally:
+            journal.close()
+
+
+def _resolve_blobs(project_dir, data):
+    """
+    Replace blob references in a record by their content
+    """
+
+    if isinstance(data, dict):
+        if '$blob' in data and len(data) == 1:
+            path = os.path.join(project_dir, data['$blob'])
+            with open(path, 'rb') as blob:
+                raw = blob.read()
+            if path.endswith('.zst'):
+                raw = zstandard.ZstdDecompressor().decompress(raw)
+            elif path.endswith('.gz'):
+                raw = gzip.decompress(raw)
+            return raw.decode('utf-8')
+        return dict((key, _resolve_blobs(project_dir, value)) for key, value in data.items())
+    if isinstance(data, list):
+        return [_resolve_blobs(project_dir, value) for value in data]
+
+    return data
+
+
+def read_records(project_dir, resolve_blobs=True):
+    """
+    Read the persisted task records of a project directory
+
+    :param project_dir:   workflow project directory
+    :type project_dir:    :py:str
+    :param resolve_blobs: replace blob references by their content
+    :type resolve_blobs:  :py:bool
+
+    :rtype:               :py:list
+    """
+
+    records = []
+    with open(os.path.join(project_dir, JOURNAL_FILE), 'r') as journal:
+        for line in journal:
+            if line.strip():
+                record = json.loads(line)
+                records.append(_resolve_blobs(project_dir, record) if resolve_blobs else record)
+
+    return records
+
+
+def load_output(project_dir, task):
+    """
+    Load the last persisted output of a task from a project directory
+
+    :param project_dir: workflow project directory
+    :type project_dir:  :py:str
+    :param task:        task node id
+    :type task:         :py:int
+
+    :raises KeyError:   no output persisted for the task
+    """
+
+    output = [record['data'] for record in read_records(project_dir, resolve_blobs=False)
+              if record['task'] == task and record['kind'] == 'output']
+    if not output:
+        raise KeyError('No output persisted for task {0} in {1}'.format(task, project_dir))
+
+    return _resolve_blobs(project_dir, output[-1])
+
+
+def output_reference(task, parameter, project_dir):
+    """
+    Reference to an output parameter of a persisted task
+
+    The reference holds the project directory of the output store so it
+    can be resolved without the workflow session that made it, for
+    instance when a workflow is resumed in a new process.
+
+    :rtype: :py:dict
+    """
+
+    return {OUTPUT_KEY: {'task': task, 'parameter': parameter, 'project_dir': project_dir}}
+
+
+def is_output_reference(data):
+
+    return isinstance(data, Mapping) and len(data) == 1 and isinstance(data.get(OUTPUT_KEY), Mapping)
+
+
+def payload_exceeds(data, size):
+    """
+    Check if the strings in nested task data hold more than `size`
+    characters, stops counting once they do
+    """
+
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, (str, bytes)):
+            size -= len(value)
+            if size < 0:
+                return True
+        elif isinstance(value, Mapping):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+
+    return False
+
+
+class PersistingSessionMixin(object):
+    """
+    Session mixin persisting the request and response of endpoint calls
+    made by the workflow manager in an AsyncOutputStore
+
+    Only the tasks with their node id in `persisted_tasks` are persisted.
+    Add these tasks with `store_output=False`. The workflow manager gets an
+    `output_reference` instead of every top level output parameter larger
+    than `reference_threshold` characters so it stays out of the workflow
+    state. Small output, such as status fields, is returned as is. The
+    response is returned once the store is flushed. Save workflow
+    checkpoints with `checkpoint` so all output is on disk first.
+    """
+
+    output_store = None
+    persisted_tasks = ()
+    reference_threshold = DEFAULT_BLOB_THRESHOLD
+
+    def call(self, procedure, request, *args, **kwargs):
+
+        store = self.output_store
+        nid = task_nid(request)
+        if store is None or nid is None or nid not in self.persisted_tasks:
+            return super(PersistingSessionMixin, self).call(procedure, request, *args, **kwargs)
+
+        store.put(nid, 'input', untag(request))
+
+        def on_response(response):
+            store.put(nid, 'output', response)
+            if isinstance(response, Mapping):
+                response = dict((key, output_reference(nid, key, store.project_dir)
+                                 if payload_exceeds(value, self.reference_threshold) else value)
+                                for key, value in response.items())
+
+            # The task completes once its output is durable
+            return store.flush_async().addCallback(lambda _: response)
+
+        deferred = super(PersistingSessionMixin, self).call(procedure, request, *args, **kwargs)
+        return deferred.addCallback(on_response)
+
+    def checkpoint(self, workflow, path):
+        """
+        Save a workflow checkpoint once all persisted task output is on disk
+
+        The flush is done off the reactor thread.
+
+        :param workflow: workflow to save
+        :param path:     checkpoint file path
+        :type path:      :py:str
+
+        :return:         Deferred firing once the checkpoint is saved
+        """
+
+        from twisted.internet.defer import maybeDeferred
+
+        if self.output_store is None:
+            return maybeDeferred(workflow.save, path)
+
+        return self.output_store.flush_async().addCallback(lambda _: workflow.save(path))
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: task_context.py
+
+Identify the workflow task, and the workflow run, an endpoint call or
+PythonTask helper call belongs to.
+
+The workflow manager calls the task runner with the endpoint uri and the
+task input only. Several tasks may call the same endpoint (t1 and t15 both
+call 'convert'), so the uri does not identify the task, and workflows
+running concurrently in one process share the helper functions.
+
+`tag_tasks` adds the task node id (nid) and the id of the workflow session
+running the task to the input of every task under the TASK_KEY parameter.
+Session mixins and helper decorators read it using `task_nid` and
+`task_workflow`. The TaskContextSessionMixin removes it again from the
+request before the endpoint is called.
+"""
+
+import uuid
+import weakref
+
+from collections.abc import Mapping
+
+TASK_KEY = '__task__'
+
+# Workflow sessions by workflow id
+_WORKFLOWS = weakref.WeakValueDictionary()
+
+
+def register_workflow(session):
+    """
+    Register a workflow session for lookup by the tasks it runs
+
+    :param session: workflow session, only weakly referenced
+    :type session:  :mdstudio:component:session:ComponentSession
+
+    :return:        workflow id
+    :rtype:         :py:str
+    """
+
+    workflow_id = uuid.uuid4().hex
+    _WORKFLOWS[workflow_id] = session
+
+    return workflow_id
+
+
+def tag_tasks(workflow_id, *tasks):
+    """
+    Add the task context to the input of workflow tasks
+
+    :param workflow_id: id returned by `register_workflow`
+    :type workflow_id:  :py:str
+    :param tasks:       workflow task objects returned by `Workflow.add_task`
+    """
+
+    for task in tasks:
+        task.set_input(**{TASK_KEY: {'nid': task.nid, 'workflow': workflow_id}})
+
+
+def task_context(data):
+    """
+    Return the task context of a request or helper keyword arguments
+
+    :rtype: :py:dict, None if untagged
+    """
+
+    if isinstance(data, Mapping) and isinstance(data.get(TASK_KEY), Mapping):
+        return data[TASK_KEY]
+
+    return None
+
+
+def task_nid(data, default=None):
+    """
+    Return the node id of the task a request belongs to, `default` if
+    untagged
+    """
+
+    context = task_context(data)
+    return context['nid'] if context else default
+
+
+def task_workflow(data):
+    """
+    Return the workflow session a request belongs to, None if untagged or
+    the workflow is no longer running
+    """
+
+    context = task_context(data)
+    return _WORKFLOWS.get(context['workflow']) if context else None
+
+
+def untag(data):
+    """
+    Return a request or keyword arguments without the task context
+    """
+
+    if isinstance(data, Mapping) and TASK_KEY in data:
+        return dict((key, value) for key, value in data.items() if key != TASK_KEY)
+
+    return data
+
+
+class TaskContextSessionMixin(object):
+    """
+    Session mixin removing the task context from requests
+
+    Use as last base class before the ComponentSession so all other mixins
+    see the task context.
+    """
+
+    def call(self, procedure, request, *args, **kwargs):
+
+        return super(TaskContextSessionMixin, self).call(procedure, untag(request), *args, **kwargs)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: task_scheduler.py
+
+Priority and resource aware scheduling of task calls across workflows.
+
+When several workflows run in the same process their task calls are all
+dispatched as soon as they are ready. Cheap ligand preparation calls then
+queue up at the broker behind expensive docking and remote MD jobs.
+
+The TaskScheduler is shared by all workflows in a process (`get_scheduler`)
+and dispatches endpoint calls by:
+
+* resource class: every endpoint uri is mapped to a resource class with a
+  fixed number of slots (e.g. 'light' for structure conversions, 'cpu' for
+  local docking, 'hpc' for remote MD). A call waits for a free slot in its
+  own class only so cheap calls never wait for expensive ones.
+* priority: within a class, calls with a lower priority number go first.
+  Tasks on the critical path of a workflow are given priority 0.
+* fair sharing: calls of equal priority are taken round robin from the
+  workflows waiting for the class.
+"""
+
+import time
+
+from collections import deque, OrderedDict
+
+from twisted.internet.defer import Deferred, maybeDeferred
+
+DEFAULT_RESOURCE_CLASSES = {'light': 16, 'cpu': 4, 'hpc': 2}
+DEFAULT_URI_CLASSES = [
+    ('mdgroup.mdstudio_gromacs.', 'hpc'),
+    ('mdgroup.mdstudio_smartcyp.endpoint.docking', 'cpu'),
+    ('mdgroup.mdstudio_amber.', 'cpu'),
+    ('mdgroup.lie_pylie.', 'cpu'),
+]
+DEFAULT_RESOURCE_CLASS = 'light'
+DEFAULT_PRIORITY = 10
+
+
+class TaskScheduler(object):
+    """
+    Dispatch task calls over resource class slots by priority and fairly
+    between workflows
+
+    :param resource_classes: number of slots per resource class
+    :type resource_classes:  :py:dict
+    :param uri_classes:      (uri prefix, resource class) tuples, first match
+                             is used
+    :type uri_classes:       :py:list
+    """
+
+    def __init__(self, resource_classes=None, uri_classes=None):
+
+        self.slots = dict(resource_classes or DEFAULT_RESOURCE_CLASSES)
+        self.uri_classes = list(uri_classes or DEFAULT_URI_CLASSES)
+        self.running = dict((name, 0) for name in self.slots)
+        self.stats = dict((name, {'dispatched': 0, 'wait': 0.0, 'max_wait': 0.0}) for name in self.slots)
+
+        # resource class -> priority -> workflow -> queued calls
+        self._queues = dict((name, {}) for name in self.slots)
+
+    def resource_class(self, uri):
+        """
+        Return the resource class for an endpoint uri
+        """
+
+        for prefix, name in self.uri_classes:
+            if uri.startswith(prefix):
+                return name
+
+        return DEFAULT_RESOURCE_CLASS
+
+    def queued(self, resource_class=None):
+        """
+        Number of calls waiting, for one or all resource classes
+        """
+
+        names = [resource_class] if resource_class else self._queues.keys()
+        return sum(len(calls) for name in names for workflows in self._queues[name].values()
+                   for calls in workflows.values())
+
+    def submit(self, workflow, uri, func, priority=None):
+        """
+        Schedule a call
+
+        :param workflow: identifier of the workflow making the call
+        :param uri:      endpoint uri, determines the resource class
+        :type uri:       :py:str
+        :param func:     function making the call, returning a Deferred
+        :type func:      :py:func
+        :param priority: call priority, lower goes first
+        :type priority:  :py:int
+
+        :return:         Deferred firing with the call result
+        """
+
+        resource_class = self.resource_class(uri)
+        priority = DEFAULT_PRIORITY if priority is None else priority
+        result = Deferred()
+
+        workflows = self._queues[resource_class].setdefault(priority, OrderedDict())
+        workflows.setdefault(workflow, deque()).append((func, result, time.time()))
+        self._dispatch(resource_class)
+
+        return result
+
+    def _next(self, resource_class):
+
+        queues = self._queues[resource_class]
+        for priority in sorted(queues):
+            workflows = queues[priority]
+            if not workflows:
+                continue
+
+            # Round robin: take from the first workflow and move it to the back
+            workflow, calls = workflows.popitem(last=False)
+            call = calls.popleft()
+            if calls:
+                workflows[workflow] = calls
+            if not workflows:
+                del queues[priority]
+
+            return call
+
+        return None
+
+    def _dispatch(self, resource_class):
+
+        while self.running[resource_class] < self.slots[resource_class]:
+            call = self._next(resource_class)
+            if call is None:
+                return
+
+            func, result, queued_at = call
+            wait = time.time() - queued_at
+            stats = self.stats[resource_class]
+            stats['dispatched'] += 1
+            stats['wait'] += wait
+            stats['max_wait'] = max(stats['max_wait'], wait)
+
+            self.running[resource_class] += 1
+            deferred = maybeDeferred(func)
+            deferred.addBoth(self._release, resource_class)
+            deferred.chainDeferred(result)
+
+    def _release(self, outcome, resource_class):
+
+        self.running[resource_class] -= 1
+        self._dispatch(resource_class)
+        return outcome
+
+
+_scheduler = None
+
+
+def get_scheduler(**kwargs):
+    """
+    Return the process wide TaskScheduler, created on first use with the
+    given arguments
+    """
+
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = TaskScheduler(**kwargs)
+
+    return _scheduler
+
+
+class ScheduledSessionMixin(object):
+    """
+    Session mixin dispatching all endpoint calls made by the workflow
+    manager through the process wide TaskScheduler
+
+    `task_priorities` maps endpoint uris to a priority, use 0 for tasks on
+    the critical path. `workflow_id` identifies the workflow for fair
+    sharing and defaults to the session instance. `task_dispatched` is
+    called when the scheduler releases a call, just before it is made.
+    """
+
+    task_priorities = {}
+    workflow_id = None
+
+    def task_dispatched(self, procedure, request):
+        """
+        Called when the scheduler releases a call
+        """
+
+        pass
+
+    def call(self, procedure, request, *args, **kwargs):
+
+        parent = super(ScheduledSessionMixin, self)
+
+        def dispatch():
+            self.task_dispatched(procedure, request)
+            return parent.call(procedure, request, *args, **kwargs)
+
+        return get_scheduler().submit(self.workflow_id or id(self), procedure, dispatch,
+                                      priority=self.task_priorities.get(procedure))
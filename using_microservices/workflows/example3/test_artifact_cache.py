@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: test_artifact_cache.py
+
+Tests for resolving output references of persisted tasks
+"""
+
+import pytest
+
+from artifact_cache import ArtifactCache, uses_artifacts
+from output_store import AsyncOutputStore, output_reference
+from task_context import TASK_KEY, register_workflow
+
+DOCKING_OUTPUT = {'result': {'cluster_1': {'PATH': 'pose_1.mol2', 'MEAN': True, 'content': 'x' * 100000},
+                             'cluster_2': {'PATH': 'pose_2.mol2', 'MEAN': False}}}
+
+
+class FakeWorkflowSession(object):
+
+    def __init__(self, artifacts):
+
+        self.artifacts = artifacts
+
+
+@uses_artifacts
+def medians(result=None, **kwargs):
+
+    assert TASK_KEY not in kwargs
+    return {'medians': [value['PATH'] for value in result.values() if value['MEAN']],
+            'content': result['cluster_1']['content']}
+
+
+@pytest.fixture
+def persisted(tmpdir):
+    """
+    Project directory with the persisted output of docking task 7
+    """
+
+    store = AsyncOutputStore(str(tmpdir), compress='gzip', blob_threshold=1000).start()
+    store.put(7, 'output', DOCKING_OUTPUT)
+    store.close()
+
+    return store.project_dir
+
+
+def test_resolve_reference_without_session(persisted):
+
+    # Workflow resumed in a new process: the workflow id in the task
+    # context is not known and there is no artifact cache
+    kwargs = {'result': output_reference(7, 'result', persisted),
+              TASK_KEY: {'nid': 8, 'workflow': 'stale-workflow-id'}}
+
+    assert medians(**kwargs) == {'medians': ['pose_1.mol2'], 'content': 'x' * 100000}
+
+
+def test_resolve_reference_from_session_cache(persisted):
+
+    artifacts = ArtifactCache()
+    artifacts.put(7, {'result': {'cluster_1': {'PATH': 'cached.mol2', 'MEAN': True, 'content': ''}}})
+    session = FakeWorkflowSession(artifacts)
+    kwargs = {'result': output_reference(7, 'result', persisted),
+              TASK_KEY: {'nid': 8, 'workflow': register_workflow(session)}}
+
+    assert medians(**kwargs)['medians'] == ['cached.mol2']
+
+
+def test_cache_loads_uncached_output_once(persisted):
+
+    artifacts = ArtifactCache()
+    first = artifacts.get(output_reference(7, 'result', persisted))
+    assert first['cluster_2']['PATH'] == 'pose_2.mol2'
+    assert artifacts.get(output_reference(7, 'result', persisted)) is first
+    assert len(artifacts) == 1
+
+    with pytest.raises(TypeError):
+        first['cluster_2'] = None
+
+
+def test_missing_output(persisted):
+
+    with pytest.raises(KeyError):
+        ArtifactCache().get(output_reference(14, 'output', persisted))
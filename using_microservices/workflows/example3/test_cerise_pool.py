@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: test_cerise_pool.py
+
+Tests for the pooled Cerise services and batched job submission, using the
+local fake Cerise service
+"""
+
+import os
+
+import pytest
+
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.task import Clock
+
+from cerise_pool import CerisePool, CeriseJobBatcher, FakeCeriseService, load_cerise_config, config_key
+
+CURRDIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def md_job(job_input):
+    """
+    Fake MD run: the trajectory name of the ligand
+    """
+
+    if job_input.get('fail'):
+        raise ValueError('MD run failed')
+
+    return {'trajectory': '{0}.ene'.format(job_input['ligand'])}
+
+
+@pytest.fixture
+def config():
+
+    return load_cerise_config(os.path.join(CURRDIR, 'cerise_config_gt.json'))
+
+
+@pytest.fixture
+def pool():
+
+    return CerisePool(service_factory=lambda config: FakeCeriseService(config, runner=md_job))
+
+
+def batcher(pool, config, **kwargs):
+
+    return CeriseJobBatcher(pool, config, 'batch_md.cwl', poll_interval=0, clock=kwargs.pop('clock', Clock()),
+                            run_in_thread=maybeDeferred, **kwargs)
+
+
+def collect(deferreds):
+
+    results = []
+    for deferred in deferreds:
+        deferred.addBoth(results.append)
+
+    return results
+
+
+def test_config_key_ignores_key_order(config):
+
+    reordered = dict(reversed(list(config.items())))
+    assert config_key(reordered) == config_key(config)
+    assert config_key(dict(config, port=config['port'] + 1)) != config_key(config)
+
+
+def test_pool_shares_service_per_config(pool, config):
+
+    service = pool.get(config)
+    assert pool.get(dict(config)) is service
+    assert pool.get(dict(config, port=config['port'] + 1)) is not service
+    assert pool.created == 2
+
+
+def test_batch_submitted_when_full(pool, config):
+
+    jobs = batcher(pool, config, batch_size=3)
+    results = collect([jobs.submit({'ligand': name}) for name in ('l1', 'l2', 'l3')])
+
+    service = pool.get(config)
+    assert jobs.batches == 1
+    assert len(service.jobs) == 1
+    assert service.jobs[0].workflow == 'batch_md.cwl'
+    assert results == [{'trajectory': 'l1.ene'}, {'trajectory': 'l2.ene'}, {'trajectory': 'l3.ene'}]
+
+
+def test_batch_submitted_after_window(pool, config):
+
+    clock = Clock()
+    jobs = batcher(pool, config, batch_size=8, batch_window=5.0, clock=clock)
+    results = collect([jobs.submit({'ligand': name}) for name in ('l1', 'l2')])
+
+    clock.advance(4.9)
+    assert results == [] and jobs.batches == 0
+
+    clock.advance(0.1)
+    assert jobs.batches == 1
+    assert results == [{'trajectory': 'l1.ene'}, {'trajectory': 'l2.ene'}]
+    assert not clock.getDelayedCalls()
+
+
+def test_batchers_share_pooled_service(pool, config):
+
+    ligand_md = batcher(pool, config, batch_size=1)
+    complex_md = batcher(pool, config, batch_size=1)
+    collect([ligand_md.submit({'ligand': 'l1'}), complex_md.submit({'ligand': 'l1-protein'})])
+
+    assert pool.created == 1
+    assert len(pool.get(config).jobs) == 2
+
+
+def test_failed_batch_fails_every_job(pool, config):
+
+    jobs = batcher(pool, config, batch_size=2)
+    results = collect([jobs.submit({'ligand': 'l1'}), jobs.submit({'ligand': 'l2', 'fail': True})])
+
+    assert len(results) == 2
+    for result in results:
+        assert result.check(RuntimeError)
+        assert 'PermanentFailure' in str(result.value)
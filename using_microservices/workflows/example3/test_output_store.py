@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: test_output_store.py
+
+Tests for the asynchronous output store and the persisting session mixin
+"""
+
+import threading
+
+import pytest
+
+from twisted.internet.defer import maybeDeferred, succeed
+
+from output_store import (AsyncOutputStore, PersistingSessionMixin, is_output_reference, load_output,
+                          payload_exceeds, read_records)
+from task_context import TASK_KEY
+
+MD_RESPONSE = {'status': 'completed', 'results': {'energy_dataframe': {'content': 'e' * 50000, 'path': 'md.ene'}}}
+
+
+class EndpointSession(object):
+
+    def call(self, procedure, request, *args, **kwargs):
+        return succeed(MD_RESPONSE)
+
+
+class PersistingSession(PersistingSessionMixin, EndpointSession):
+
+    persisted_tasks = (14,)
+
+
+@pytest.fixture
+def store(tmpdir):
+
+    store = AsyncOutputStore(str(tmpdir), compress='gzip', blob_threshold=1000).start()
+
+    # Flush in the calling thread, there is no running reactor
+    store.flush_async = lambda: maybeDeferred(store.flush)
+
+    yield store
+    store.close()
+
+
+def test_payload_exceeds():
+
+    assert not payload_exceeds({'status': 'completed', 'frames': [1, 2, 3]}, 100)
+    assert payload_exceeds({'results': [{'content': 'x' * 60}, {'content': 'x' * 60}]}, 100)
+
+
+def test_concurrent_flushes(store):
+
+    def complete_task(task):
+        store.put(task, 'output', {'mol': 'x' * 2000})
+        assert store.flush(timeout=10)
+
+    threads = [threading.Thread(target=complete_task, args=(task,)) for task in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(record['task'] for record in read_records(store.project_dir)) == list(range(20))
+
+
+def test_persisted_task_output_durable_on_completion(store):
+
+    session = PersistingSession()
+    session.output_store = store
+    responses = []
+    session.call('mdgroup.mdstudio_gromacs.endpoint.gromacs_ligand',
+                 {'sim_time': 0.001, TASK_KEY: {'nid': 14, 'workflow': 'run'}}).addCallback(responses.append)
+
+    # Small output is returned as is, large output as reference
+    response = responses[0]
+    assert response['status'] == 'completed'
+    assert is_output_reference(response['results'])
+
+    # The output is on disk when the task completes
+    assert load_output(store.project_dir, 14) == MD_RESPONSE
+    inputs = [record['data'] for record in read_records(store.project_dir) if record['kind'] == 'input']
+    assert inputs == [{'sim_time': 0.001}]
+
+
+def test_other_tasks_not_persisted(store):
+
+    session = PersistingSession()
+    session.output_store = store
+    responses = []
+    session.call('mdgroup.mdstudio_structures.endpoint.convert',
+                 {TASK_KEY: {'nid': 1, 'workflow': 'run'}}).addCallback(responses.append)
+
+    assert responses == [MD_RESPONSE]
+    store.flush()
+    assert read_records(store.project_dir) == []
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: test_workflow_tracing.py
+
+Tests for the task call spans recorded by the tracing session mixins
+"""
+
+import pytest
+
+from twisted.internet.defer import Deferred
+
+import task_scheduler
+import workflow_tracing
+
+from task_context import TASK_KEY, TaskContextSessionMixin
+from task_scheduler import ScheduledSessionMixin, TaskScheduler
+from workflow_tracing import TracingSessionMixin, EndpointTracingSessionMixin, WorkflowTracer
+
+DOCKING = 'mdgroup.mdstudio_smartcyp.endpoint.docking'
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def time(self):
+        return self.now
+
+
+class EndpointSession(object):
+    """
+    Endpoint calls answered by the test through `pending`
+    """
+
+    def __init__(self):
+        self.pending = []
+
+    def call(self, procedure, request, *args, **kwargs):
+
+        assert TASK_KEY not in request
+        deferred = Deferred()
+        self.pending.append(deferred)
+        return deferred
+
+
+class RetryOnceSessionMixin(object):
+    """
+    Retry a failed call once
+    """
+
+    def call(self, procedure, request, *args, **kwargs):
+
+        parent = super(RetryOnceSessionMixin, self)
+        deferred = parent.call(procedure, request, *args, **kwargs)
+        return deferred.addErrback(lambda failure: parent.call(procedure, request, *args, **kwargs))
+
+
+class TracedSession(TracingSessionMixin, RetryOnceSessionMixin, ScheduledSessionMixin, EndpointTracingSessionMixin,
+                    TaskContextSessionMixin, EndpointSession):
+    pass
+
+
+@pytest.fixture
+def clock(monkeypatch):
+
+    clock = Clock()
+    monkeypatch.setattr(workflow_tracing, 'time', clock)
+    monkeypatch.setattr(task_scheduler, 'time', clock)
+    monkeypatch.setattr(task_scheduler, '_scheduler', TaskScheduler(resource_classes={'cpu': 1, 'light': 1}))
+    return clock
+
+
+@pytest.fixture
+def session(clock):
+
+    session = TracedSession()
+    session.tracer = WorkflowTracer()
+    return session
+
+
+def request(nid):
+
+    return {'ligand_file': 'x' * 100, TASK_KEY: {'nid': nid, 'workflow': 'run'}}
+
+
+def test_queue_wait_endpoint_and_local_time(session, clock):
+
+    finished = []
+    session.call(DOCKING, request(7)).addCallback(finished.append)
+    session.call(DOCKING, request(9)).addCallback(finished.append)
+
+    # Task 9 waits for the single cpu slot taken by task 7
+    assert len(session.pending) == 1
+    clock.now = 110.0
+    session.pending[0].callback({'output': 'a'})
+
+    clock.now = 130.0
+    session.pending[1].callback({'output': 'b' * 10})
+
+    assert len(finished) == 2
+    first, second = session.tracer.records
+    assert (first['start'], first['dispatch'], first['response'], first['finish']) == (100.0, 100.0, 110.0, 110.0)
+    assert (second['start'], second['dispatch'], second['response'], second['finish']) == (100.0, 110.0, 130.0,
+                                                                                             130.0)
+    assert second['name'] == 'task 9'
+    assert second['request_bytes'] == len('{"ligand_file": "' + 'x' * 100 + '"}')
+    assert second['response_bytes'] == len('{"output": "' + 'b' * 10 + '"}')
+
+    summary = session.tracer.summary()
+    assert 'queued (s)' in summary and 'task 9' in summary
+
+
+def test_retried_call_is_one_span(session, clock):
+
+    errors = []
+    session.call(DOCKING, request(7)).addErrback(errors.append)
+    clock.now = 105.0
+    session.pending[0].errback(RuntimeError('docking failed'))
+    clock.now = 108.0
+    session.pending[1].errback(RuntimeError('docking failed again'))
+
+    assert len(errors) == 1
+    record, = session.tracer.records
+    assert record['attempts'] == 2
+    assert (record['start'], record['dispatch'], record['response'], record['finish']) == (100.0, 100.0, 108.0,
+                                                                                         108.0)
+    assert record['error'] == 'docking failed again'
+    assert record['response_bytes'] == 0
+
+
+def test_trace_events_nest_phases(session, clock):
+
+    session.call(DOCKING, request(7))
+    session.call(DOCKING, request(9))
+    clock.now = 101.0
+    session.pending[0].callback({})
+    clock.now = 103.0
+    session.pending[1].callback({})
+
+    events = session.tracer.trace_events()
+    assert [event['name'] for event in events] == ['task 7', 'endpoint', 'task 9', 'queued', 'endpoint']
+    assert events[3]['dur'] == pytest.approx(1e6)
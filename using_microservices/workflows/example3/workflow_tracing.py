@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: workflow_tracing.py
+
+Per-task timing and payload size instrumentation for workflows.
+
+Tracing is off by default. Set the MDSTUDIO_WORKFLOW_TRACE environment
+variable to record every WampTask call made through a session using the
+TracingSessionMixin, and every PythonTask helper decorated with `traced`,
+with:
+
+* start:    the workflow manager requested the task call
+* dispatch: the task scheduler released the call (see task_scheduler.py),
+            the start when the session does not schedule calls
+* response: the endpoint response arrived, before it is persisted or
+            cached, the finish when the session does not mark it
+* finish:   the response was returned to the workflow manager
+
+start to dispatch is the time the call waited in the scheduler queue,
+dispatch to response the time spent at the broker and the endpoint,
+including retry backoff, and response to finish the local handling of the
+response such as persisting it. A task call is one span however many
+attempts the retry policy makes, the number of dispatched attempts is
+recorded with it. Gaps between the finish of a task and the start of the
+next one are spent by the workflow manager.
+
+Records are named by task node id (see task_context.py) so tasks calling
+the same endpoint are told apart. The request and response size in bytes
+(JSON encoded, an estimate of the WAMP payload) of the call as sent to the
+endpoint is measured outside of the timed intervals.
+
+Records are written as Chrome trace-event JSON (open with chrome://tracing
+or https://ui.perfetto.dev) and summarized per task in a table.
+"""
+
+import os
+import json
+import time
+import functools
+import threading
+
+from collections import OrderedDict
+
+from task_context import task_nid, task_workflow, untag
+
+TRACE_TASKS = bool(os.environ.get('MDSTUDIO_WORKFLOW_TRACE'))
+
+
+def payload_size(payload):
+    """
+    Size of a task payload in bytes when JSON encoded
+
+    :param payload: request or response
+    :return:        size in bytes, -1 if not JSON serializable
+    :rtype:         :py:int
+    """
+
+    try:
+        return len(json.dumps(payload, default=str).encode('utf-8'))
+    except (TypeError, ValueError):
+        return -1
+
+
+def task_name(nid, call):
+    """
+    Trace record name of a task, the call if the task is not known
+    """
+
+    return 'task {0}'.format(nid) if nid is not None else call
+
+
+class WorkflowTracer(object):
+    """
+    Collect task timing records of a workflow run and export them as trace
+    or summary
+    """
+
+    def __init__(self):
+
+        self.records = []
+        self._spans = {}
+        self._lanes = []
+        self._lock = threading.Lock()
+
+    def reset(self):
+
+        with self._lock:
+            self.records = []
+            self._spans = {}
+            self._lanes = []
+
+    def _lane(self, start, finish):
+        """
+        Assign the record to the first trace lane (thread id) that is free
+        at start so concurrent tasks are drawn below each other.
+        """
+
+        for lane, busy_until in enumerate(self._lanes):
+            if busy_until <= start:
+                self._lanes[lane] = finish
+                return lane
+
+        self._lanes.append(finish)
+        return len(self._lanes) - 1
+
+    def record(self, name, category, call, start, dispatch, response, finish, request_bytes, response_bytes,
+               attempts=1, error=None):
+        """
+        Add a task timing record, timestamps in seconds since the epoch
+
+        :param name:     task name, see `task_name`
+        :type name:      :py:str
+        :param category: 'WampTask' or 'PythonTask'
+        :type category:  :py:str
+        :param call:     endpoint uri or helper function
+        :type call:      :py:str
+        :param attempts: number of dispatched call attempts
+        :type attempts:  :py:int
+        """
+
+        record = OrderedDict([('name', name), ('category', category), ('call', call), ('start', start),
+                              ('dispatch', dispatch), ('response', response), ('finish', finish),
+                              ('attempts', attempts), ('request_bytes', request_bytes),
+                              ('response_bytes', response_bytes), ('error', error)])
+        with self._lock:
+            self.records.append(record)
+
+        return record
+
+    def open(self, name, call, request):
+        """
+        Start the span of a task call
+
+        :param name:    task name, identifies the span
+        :type name:     :py:str
+        :param call:    endpoint uri
+        :type call:     :py:str
+        :param request: task request, its size is measured unless the
+                        request as sent to the endpoint is marked
+        """
+
+        with self._lock:
+            self._spans[name] = {'call': call, 'start': time.time(), 'dispatch': None, 'response': None,
+                                 'attempts': 0, 'request': request, 'reply': None, 'success': False}
+
+    def dispatched(self, name):
+        """
+        Mark the release of a call attempt by the scheduler, the first
+        dispatch is kept
+        """
+
+        now = time.time()
+        with self._lock:
+            span = self._spans.get(name)
+            if span is not None:
+                span['attempts'] += 1
+                if span['dispatch'] is None:
+                    span['dispatch'] = now
+
+    def responded(self, name, request, response=None, success=True):
+        """
+        Mark the arrival of an endpoint response
+
+        The first successful response is kept, failed attempts are only
+        marked until then. The request as sent and the response are kept
+        to measure their size when the span is closed.
+        """
+
+        now = time.time()
+        with self._lock:
+            span = self._spans.get(name)
+            if span is None or span['success']:
+                return
+
+            span.update(response=now, request=request, reply=response, success=success)
+
+    def close(self, name, response=None, error=None):
+        """
+        Finish the span of a task call and record it
+
+        :param response: response returned to the workflow manager, its
+                         size is measured unless the endpoint response is
+                         marked
+        """
+
+        finish = time.time()
+        with self._lock:
+            span = self._spans.pop(name, None)
+        if span is None:
+            return None
+
+        if error is None and not span['success']:
+            span['reply'] = response
+
+        return self.record(name, 'WampTask', span['call'], span['start'], span['dispatch'] or span['start'],
+                           span['response'] or finish, finish, payload_size(span['request']),
+                           payload_size(span['reply']) if error is None else 0,
+                           attempts=max(span['attempts'], 1), error=error)
+
+    def trace_events(self):
+        """
+        Return the records in Chrome trace-event format, every task call as
+        complete ('X') event with the queued, endpoint and local phases as
+        nested events
+        """
+
+        events = []
+        pid = os.getpid()
+        with self._lock:
+            self._lanes = []
+            for record in sorted(self.records, key=lambda r: r['start']):
+                tid = self._lane(record['start'], record['finish'])
+                args = {'call': record['call'], 'attempts': record['attempts'],
+                        'request_bytes': record['request_bytes'], 'response_bytes': record['response_bytes']}
+                if record['error']:
+                    args['error'] = record['error']
+
+                events.append({'name': record['name'], 'cat': record['category'], 'ph': 'X', 'pid': pid,
+                               'tid': tid, 'ts': record['start'] * 1e6,
+                               'dur': (record['finish'] - record['start']) * 1e6, 'args': args})
+                for phase, begin, end in (('queued', 'start', 'dispatch'), ('endpoint', 'dispatch', 'response'),
+                                          ('local', 'response', 'finish')):
+                    if record[end] > record[begin]:
+                        events.append({'name': phase, 'cat': record['category'], 'ph': 'X', 'pid': pid,
+                                       'tid': tid, 'ts': record[begin] * 1e6,
+                                       'dur': (record[end] - record[begin]) * 1e6})
+
+        return events
+
+    def save(self, path):
+        """
+        Write the trace as Chrome trace-event JSON file
+
+        :param path: trace file path
+        :type path:  :py:str
+        """
+
+        with open(path, 'w') as trace:
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}, trace)
+
+    def summary(self):
+        """
+        Summary table of time and payload size per task
+
+        :rtype: :py:str
+        """
+
+        tasks = OrderedDict()
+        with self._lock:
+            for record in sorted(self.records, key=lambda r: r['start']):
+                task = tasks.setdefault(record['name'], {'call': record['call'], 'calls': 0, 'errors': 0,
+                                                         'attempts': 0, 'queued': 0.0, 'endpoint': 0.0,
+                                                         'local': 0.0, 'total': 0.0, 'max': 0.0, 'request': 0,
+                                                         'response': 0})
+                duration = record['finish'] - record['start']
+                task['calls'] += 1
+                task['errors'] += 1 if record['error'] else 0
+                task['attempts'] += record['attempts']
+                task['queued'] += record['dispatch'] - record['start']
+                task['endpoint'] += record['response'] - record['dispatch']
+                task['local'] += record['finish'] - record['response']
+                task['total'] += duration
+                task['max'] = max(task['max'], duration)
+                task['request'] += max(record['request_bytes'], 0)
+                task['response'] += max(record['response_bytes'], 0)
+
+        line = '{0:<10} {1:<60} {2:>5} {3:>6} {4:>8} {5:>10} {6:>12} {7:>9} {8:>10} {9:>10} {10:>12} {11:>12}'
+        lines = [line.format('task', 'call', 'calls', 'errors', 'attempts', 'queued (s)', 'endpoint (s)',
+                             'local (s)', 'total (s)', 'max (s)', 'request (B)', 'response (B)')]
+        for name, task in tasks.items():
+            lines.append(line.format(name[:10], task['call'][-60:], task['calls'], task['errors'], task['attempts'],
+                                     '{0:.3f}'.format(task['queued']), '{0:.3f}'.format(task['endpoint']),
+                                     '{0:.3f}'.format(task['local']), '{0:.3f}'.format(task['total']),
+                                     '{0:.3f}'.format(task['max']), task['request'], task['response']))
+
+        return '\n'.join(lines)
+
+
+class TracingSessionMixin(object):
+    """
+    Session mixin recording every endpoint call made by the workflow manager
+    in the `tracer` of the session
+
+    Use as first base class so the start and finish of a task call are
+    taken before and after all other mixins, and the EndpointTracingSessionMixin
+    as the last one before the TaskContextSessionMixin to mark the endpoint
+    response. The ScheduledSessionMixin marks the dispatch by calling
+    `task_dispatched`.
+
+    Sessions get a WorkflowTracer per workflow run when `tracing` is set,
+    which defaults to the MDSTUDIO_WORKFLOW_TRACE environment variable.
+    Without a tracer calls are passed on unchanged.
+    """
+
+    tracing = TRACE_TASKS
+    tracer = None
+
+    def task_dispatched(self, procedure, request):
+
+        if self.tracer is not None:
+            self.tracer.dispatched(task_name(task_nid(request), procedure))
+
+        super(TracingSessionMixin, self).task_dispatched(procedure, request)
+
+    def call(self, procedure, request, *args, **kwargs):
+
+        tracer = self.tracer
+        if tracer is None:
+            return super(TracingSessionMixin, self).call(procedure, request, *args, **kwargs)
+
+        name = task_name(task_nid(request), procedure)
+
+        def on_response(response):
+            tracer.close(name, response)
+            return response
+
+        def on_error(failure):
+            tracer.close(name, error=failure.getErrorMessage())
+            return failure
+
+        tracer.open(name, procedure, untag(request))
+        deferred = super(TracingSessionMixin, self).call(procedure, request, *args, **kwargs)
+        return deferred.addCallbacks(on_response, on_error)
+
+
+class EndpointTracingSessionMixin(object):
+    """
+    Session mixin marking the arrival of endpoint responses in the spans
+    opened by the TracingSessionMixin
+
+    Use after the scheduling, retry, persisting and caching mixins so only
+    the endpoint call itself is marked.
+    """
+
+    tracer = None
+
+    def call(self, procedure, request, *args, **kwargs):
+
+        tracer = self.tracer
+        deferred = super(EndpointTracingSessionMixin, self).call(procedure, request, *args, **kwargs)
+        if tracer is None:
+            return deferred
+
+        name = task_name(task_nid(request), procedure)
+
+        def on_response(response):
+            tracer.responded(name, untag(request), response)
+            return response
+
+        def on_error(failure):
+            tracer.responded(name, untag(request), success=False)
+            return failure
+
+        return deferred.addCallbacks(on_response, on_error)
+
+
+def traced(func):
+    """
+    Decorator recording PythonTask helper function calls in the tracer of
+    the workflow running the task
+
+    Calls are not recorded when the task is not tagged with its workflow or
+    the workflow is not traced.
+    """
+
+    call = '{0}.{1}'.format(func.__module__, func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+
+        tracer = getattr(task_workflow(kwargs), 'tracer', None)
+        if tracer is None:
+            return func(*args, **kwargs)
+
+        name = task_name(task_nid(kwargs), call)
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as error:
+            finish = time.time()
+            tracer.record(name, 'PythonTask', call, start, start, finish, finish, payload_size(untag(kwargs)), 0,
+                          error=str(error))
+            raise
+
+        finish = time.time()
+        tracer.record(name, 'PythonTask', call, start, start, finish, finish, payload_size(untag(kwargs)),
+                      payload_size(result))
+        return result
+
+    return wrapper
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+
+# Shared workflow_tools package, used from the source tree when not installed
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow_tools'))
 
 from autobahn.twisted.util import sleep
 
@@ -8,23 +12,32 @@ from mdstudio.deferred.chainable import chainable
 from mdstudio.component.session import ComponentSession
 from mdstudio.runner import main
 
-from mdstudio_workflow import Workflow
+from workflow_tools.retry_policy import RetrySessionMixin, RetryPolicy, is_transient_or_runtime_error
 
 CURRDIR = os.getcwd()
 
 
-class LoopDemonstrationWorkflow(ComponentSession):
+class LoopDemonstrationWorkflow(RetrySessionMixin, ComponentSession):
     """
     Workflow for demonstrating the use of looping constructs in a MDStudio
     workflow with the help of a 'LoopTask'
     """
 
+    # 3D coordinate generation fails at random, retry its runtime errors and
+    # transient errors up to 3 times with backoff
+    retry_policies = {
+        'mdgroup.mdstudio_structures.endpoint.make3d': RetryPolicy(max_attempts=3,
+                                                                   classify=is_transient_or_runtime_error)
+    }
+
     def authorize_request(self, uri, claims):
         return True
 
     @chainable
     def on_run(self):
 
+        from mdstudio_workflow import Workflow
+
         # Build Workflow
         wf = Workflow(project_dir='./loop_workflow')
         wf.task_runner = self
@@ -40,6 +53,15 @@ class LoopDemonstrationWorkflow(ComponentSession):
         t1.set_input(output_format='mol2',
                      steps=100)
 
+        # Task 1b: Deduplicate the SMILES array. Equivalent SMILES (another
+        #          atom order or stereo notation) are canonicalized and only
+        #          the unique molecules are iterated over by the LoopTask.
+        #          The fraction of duplicates is reported as 'dedup_ratio'.
+        t1b = wf.add_task('Deduplicate',
+                          task_type='PythonTask',
+                          custom_func='workflow_tools.dedup_helpers.deduplicate_smiles')
+        wf.connect_task(t1.nid, t1b.nid, 'smiles')
+
         # Task 2: Add loop task. The 'mapper_arg' defines the parameter name in
         #         the input that holds an iterable of input values to iterate
         #         over. The 'loop_end_task' is required and defines the task
@@ -48,7 +70,8 @@ class LoopDemonstrationWorkflow(ComponentSession):
                          task_type='LoopTask',
                          mapper_arg='smiles',
                          loop_end_task='Collector')
-        wf.connect_task(t1.nid, t2.nid)
+        wf.connect_task(t1.nid, t2.nid, 'output_format', 'steps')
+        wf.connect_task(t1b.nid, t2.nid, 'smiles')
 
         # Task 3: Convert SMILES to mol2
         # Convert ligand to mol2 format irrespective of input format.
@@ -60,11 +83,11 @@ class LoopDemonstrationWorkflow(ComponentSession):
         # Task 4: Convert mol2 to 3D mol2 irrespective if input is 1D/2D or 3D
         #         mol2 If 'output_format' is not specified it is deduced from
         #         the input wich is mol2 in this case. There are circumstances
-        #         where conversion to 3D fails, retry upto 3 times.
+        #         where conversion to 3D fails, these are retried according
+        #         to the 'retry_policies' of the workflow session.
         t4 = wf.add_task('Make_3D',
                          task_type='WampTask',
-                         uri='mdgroup.mdstudio_structures.endpoint.make3d',
-                         retry_count=3)
+                         uri='mdgroup.mdstudio_structures.endpoint.make3d')
         wf.connect_task(t3.nid, t4.nid, 'mol')
         wf.connect_task(t1.nid, t4.nid, 'steps')
 
@@ -73,6 +96,14 @@ class LoopDemonstrationWorkflow(ComponentSession):
         t5 = wf.add_task('Collector')
         wf.connect_task(t4.nid, t5.nid, 'mol')
 
+        # Task 6: Map the results of the unique molecules back to every
+        #         SMILES in the input array
+        t6 = wf.add_task('Expand results',
+                         task_type='PythonTask',
+                         custom_func='workflow_tools.dedup_helpers.expand_results')
+        wf.connect_task(t5.nid, t6.nid, 'mol')
+        wf.connect_task(t1b.nid, t6.nid, 'index_map')
+
         # Set the array of input SMILES string to task 1
         wf.input(t1.nid, smiles=['O1[C@@H](CCC1=O)CCC',
                                  'C[C@]12CC[C@H]3[C@@H](CC=C4CCCC[C@]34CO)[C@@H]1CCC2=O',
@@ -82,6 +113,8 @@ class LoopDemonstrationWorkflow(ComponentSession):
         while wf.is_running:
             yield sleep(1)
 
+        self.log.info('Retry statistics: {0}'.format(self.retry_stats))
+
 
 if __name__ == "__main__":
     main(LoopDemonstrationWorkflow, auto_reconnect=False, daily_log=False)
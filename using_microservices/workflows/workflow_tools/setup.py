@@ -0,0 +1,32 @@
+from setuptools import setup, find_packages
+
+distribution_name = 'workflow_tools'
+
+setup(
+    name=distribution_name,
+    version='1.0.0',
+    license='Apache Software License 2.0',
+    description='Retry policies, paged docking results and ligand deduplication shared by the MDStudio '
+                'example workflows',
+    author='Marc van Dijk - VU University - Amsterdam,' \
+           'Paul Visscher - Zefiros Software (www.zefiros.eu),' \
+           'Felipe Zapata - eScience Center (https://www.esciencecenter.nl/)',
+    author_email='m4.van.dijk@vu.nl, f.zapata@esciencecenter.nl, contact@zefiros.eu',
+    url='https://github.com/MD-Studio/MDStudio_examples',
+    keywords='MDStudio workflow',
+    platforms=['Any'],
+    packages=find_packages(),
+    py_modules=[distribution_name],
+    install_requires=['twisted', 'autobahn'],
+    extras_require={'rdkit': ['rdkit'], 'openbabel': ['openbabel']},
+    include_package_data=True,
+    zip_safe=True,
+    classifiers=[
+        'Development Status :: 3 - Alpha',
+        'License :: OSI Approved :: Apache Software License',
+        'Programming Language :: Python',
+        'Topic :: System',
+        'Operating System :: OS Independent',
+        'Intended Audience :: Science/Research',
+    ],
+)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: dedup_helpers.py
+
+Canonical SMILES deduplication of ligand batches.
+
+Compound libraries contain duplicate molecules, often written differently
+(another atom order, ring closure numbering or stereo notation). Every
+copy would otherwise go through the full structure preparation chain.
+
+`deduplicate_smiles` canonicalizes the input SMILES and returns the unique
+molecules together with an index map from every original input to its
+unique molecule. The workflow processes the unique molecules only and
+`expand_results` maps their results back to the original input order.
+
+Canonicalization uses RDKit when available, OpenBabel otherwise. Without
+either only exact duplicates, ignoring whitespace and SMILES names, are
+found.
+"""
+
+try:
+    from rdkit import Chem, RDLogger
+    RDLogger.DisableLog('rdApp.*')
+except ImportError:
+    Chem = None
+
+try:
+    from openbabel import pybel
+except ImportError:
+    try:
+        import pybel
+    except ImportError:
+        pybel = None
+
+
+def canonicalizer():
+    """
+    Name of the toolkit used for canonicalization
+    """
+
+    if Chem is not None:
+        return 'rdkit'
+    if pybel is not None:
+        return 'openbabel'
+    return 'string'
+
+
+def canonical_smiles(smiles):
+    """
+    Canonical isomeric SMILES for a SMILES string
+
+    Stereo information is kept, stereoisomers are different molecules.
+    SMILES the toolkit cannot parse are compared as stripped strings.
+
+    :param smiles: SMILES string, optionally followed by a name
+    :type smiles:  :py:str
+
+    :rtype:        :py:str
+    """
+
+    stripped = smiles.strip().split()[0] if smiles.strip() else ''
+
+    if Chem is not None:
+        mol = Chem.MolFromSmiles(stripped)
+        if mol is not None:
+            return Chem.MolToSmiles(mol, isomericSmiles=True)
+    elif pybel is not None:
+        try:
+            return pybel.readstring('smi', stripped).write('can').split()[0]
+        except (IOError, IndexError):
+            pass
+
+    return stripped
+
+
+def deduplicate_smiles(smiles=None, **kwargs):
+    """
+    Deduplicate an array of SMILES strings
+
+    :param smiles: SMILES strings
+    :type smiles:  :py:list
+
+    :return:       unique SMILES in order of first occurrence ('smiles'),
+                   the unique molecule index for every input ('index_map'),
+                   the fraction of duplicate inputs ('dedup_ratio') and the
+                   canonicalization toolkit used ('canonicalizer')
+    :rtype:        :py:dict
+    """
+
+    smiles = smiles or []
+    if isinstance(smiles, str):
+        smiles = [smiles]
+
+    unique = []
+    index_map = []
+    seen = {}
+    for smi in smiles:
+        key = canonical_smiles(smi)
+        if key not in seen:
+            seen[key] = len(unique)
+            unique.append(smi)
+        index_map.append(seen[key])
+
+    ratio = 1.0 - len(unique) / float(len(smiles)) if smiles else 0.0
+
+    return {'smiles': unique, 'index_map': index_map, 'dedup_ratio': ratio, 'canonicalizer': canonicalizer()}
+
+
+def expand_results(index_map=None, **kwargs):
+    """
+    Map results of the unique molecules back to the original inputs
+
+    Every list in the keyword arguments holds a result per unique molecule
+    and is expanded to a result per original input using the index map of
+    `deduplicate_smiles`. Other arguments are returned unchanged.
+
+    :param index_map: unique molecule index for every original input
+    :type index_map:  :py:list
+
+    :rtype:           :py:dict
+    """
+
+    output = {}
+    for key, value in kwargs.items():
+        if isinstance(value, list):
+            output[key] = [value[i] for i in index_map]
+        else:
+            output[key] = value
+
+    return output
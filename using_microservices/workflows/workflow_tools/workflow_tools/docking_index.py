@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: docking_index.py
+
+Paged docking results.
+
+The docking endpoint returns the clustered docking result as a dictionary
+with an entry per pose. It grows with `cluster_structures`, is sent in full
+in the WAMP message and is kept in memory by every task using it.
+
+The paged format stores all poses in a single multi-molecule mol2 file and
+writes a tab separated index with one line per pose:
+
+    pose id | cluster | total score | mean | offset | size
+
+where offset and size locate the pose in the poses file. The docking
+result then only refers to the two files:
+
+    {'result': {'format': 'paged', 'index': index path, 'poses': poses path,
+                'count': number of poses}}
+
+The index is read line by line and pose structures are extracted on
+request, so memory use and message size do not depend on the number of
+poses.
+"""
+
+import os
+
+from collections.abc import Mapping
+
+INDEX_HEADER = '#pose_id\tcluster\ttotal_score\tmean\toffset\tsize\n'
+
+
+def is_paged(result):
+    """
+    Return True for a docking result in paged format
+    """
+
+    return isinstance(result, Mapping) and result.get('format') == 'paged'
+
+
+def write_docking_index(poses, work_dir, index_name='docking_index.tsv', poses_name='docking_poses.mol2'):
+    """
+    Write docking poses in paged format
+
+    :param poses:    (pose id, pose info) tuples, pose info is a dictionary
+                     with 'PATH', 'CLUSTER', 'TOTAL_SCORE' and 'MEAN' as in
+                     the docking endpoint result
+    :type poses:     :py:list
+    :param work_dir: directory to write the index and poses file to
+    :type work_dir:  :py:str
+
+    :return:         paged docking result
+    :rtype:          :py:dict
+    """
+
+    index_path = os.path.join(work_dir, index_name)
+    poses_path = os.path.join(work_dir, poses_name)
+
+    count = 0
+    offset = 0
+    with open(index_path, 'w') as index, open(poses_path, 'wb') as poses_file:
+        index.write(INDEX_HEADER)
+        for pose_id, info in poses:
+            with open(info['PATH'], 'rb') as pose:
+                structure = pose.read()
+            if not structure.endswith(b'\n'):
+                structure += b'\n'
+            poses_file.write(structure)
+
+            index.write('{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n'.format(pose_id, info.get('CLUSTER', -1),
+                                                                 info['TOTAL_SCORE'], int(bool(info['MEAN'])),
+                                                                 offset, len(structure)))
+            offset += len(structure)
+            count += 1
+
+    return {'format': 'paged', 'index': index_path, 'poses': poses_path, 'count': count}
+
+
+def iter_docking_index(result):
+    """
+    Iterate over the index entries of a paged docking result
+
+    :param result: paged docking result
+    :type result:  :py:dict
+
+    :return:       generator of index entry dictionaries
+    """
+
+    with open(result['index'], 'r') as index:
+        for line in index:
+            if line.startswith('#'):
+                continue
+
+            pose_id, cluster, score, mean, offset, size = line.rstrip('\n').split('\t')
+            yield {'pose_id': pose_id, 'cluster': int(cluster), 'total_score': float(score),
+                   'mean': mean == '1', 'offset': int(offset), 'size': int(size)}
+
+
+def fetch_pose(result, entry, output_dir=None):
+    """
+    Extract the structure of one pose to a mol2 file
+
+    :param result:     paged docking result
+    :type result:      :py:dict
+    :param entry:      index entry of the pose
+    :type entry:       :py:dict
+    :param output_dir: directory to write the pose to, defaults to the
+                       directory of the poses file
+    :type output_dir:  :py:str
+
+    :return:           pose mol2 file path
+    :rtype:            :py:str
+    """
+
+    path = os.path.join(output_dir or os.path.dirname(result['poses']), '{0}.mol2'.format(entry['pose_id']))
+    if not os.path.exists(path):
+        with open(result['poses'], 'rb') as poses:
+            poses.seek(entry['offset'])
+            structure = poses.read(entry['size'])
+        with open(path, 'wb') as pose:
+            pose.write(structure)
+
+    return path
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: retry_policy.py
+
+Adaptive retries for endpoint calls.
+
+Tasks defined with `retry_count` are retried immediately and irrespective
+of the error by the workflow manager. Deterministic failures, such as a
+molecule ACPYPE cannot parametrize, then fail the same way several times
+while transient failures like broker timeouts are retried while the
+service is still overloaded.
+
+The RetrySessionMixin retries endpoint calls listed in `retry_policies`:
+
+* errors are classified as transient or permanent, permanent errors fail
+  the call at once
+* transient errors are retried with exponential backoff and full jitter
+* optionally a slow call is hedged: after a latency threshold a duplicate
+  call is made, which a round-robin registered service hands to another
+  instance, and the first response is used
+
+Retry statistics are recorded per endpoint uri.
+"""
+
+import random
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, CancelledError
+from twisted.python.failure import Failure
+
+from autobahn.twisted.util import sleep
+from autobahn.wamp.exception import ApplicationError
+
+from mdstudio.deferred.chainable import chainable
+
+# WAMP error uris that are worth retrying
+TRANSIENT_ERRORS = (
+    ApplicationError.CANCELED,
+    ApplicationError.TIMEOUT,
+    ApplicationError.NO_SUCH_PROCEDURE,
+    ApplicationError.NO_SUCH_REGISTRATION,
+)
+
+
+def is_transient(failure):
+    """
+    Classify a call failure as transient (True) or permanent (False)
+
+    Connection and timeout errors and the WAMP errors in TRANSIENT_ERRORS
+    are transient. All other application errors, such as invalid input,
+    schema validation errors or exceptions raised by the endpoint, are
+    permanent.
+    """
+
+    error = failure.value
+    if isinstance(error, ApplicationError):
+        return error.error in TRANSIENT_ERRORS
+    if isinstance(error, (CancelledError, TimeoutError, ConnectionError)):
+        return True
+
+    return False
+
+
+def is_transient_or_runtime_error(failure):
+    """
+    Classify endpoint runtime errors as transient as well
+
+    For endpoints that fail at random, like the 3D coordinate generation of
+    make3d, an exception raised by the endpoint is worth retrying.
+    """
+
+    error = failure.value
+    if isinstance(error, ApplicationError) and error.error == 'wamp.error.runtime_error':
+        return True
+
+    return is_transient(failure)
+
+
+class RetryPolicy(object):
+    """
+    Retry policy for an endpoint
+
+    :param max_attempts:   maximum number of attempts including the first
+    :type max_attempts:    :py:int
+    :param base_delay:     backoff delay in seconds before the first retry
+    :type base_delay:      :py:float
+    :param max_delay:      maximum backoff delay in seconds
+    :type max_delay:       :py:float
+    :param hedge_after:    seconds after which a duplicate call is made if
+                           no response was received yet, None disables
+    :type hedge_after:     :py:float
+    :param classify:       function returning True for transient failures
+    :type classify:        :py:func
+    """
+
+    def __init__(self, max_attempts=3, base_delay=1.0, max_delay=30.0, hedge_after=None, classify=is_transient):
+
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_after = hedge_after
+        self.classify = classify
+
+    def backoff(self, attempt):
+        """
+        Exponential backoff with full jitter for a retry attempt (1 based)
+        """
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+def hedged(call, hedge_after):
+    """
+    Make a call and a duplicate call if it did not respond in time
+
+    The first response wins and the other call is cancelled. The result
+    fails only when all calls made have failed.
+
+    :param call:        function making the call, returning a Deferred
+    :param hedge_after: seconds to wait before making the duplicate call
+
+    :return:            Deferred firing with a (response, hedged, hedge_won)
+                        tuple
+    """
+
+    result = Deferred()
+    calls = []
+    failed = set()
+
+    def on_response(response, index):
+        if result.called:
+            return
+        if timer.active():
+            timer.cancel()
+        for other, deferred in enumerate(calls):
+            if other != index:
+                deferred.cancel()
+        result.callback((response, len(calls) > 1, index == 1))
+
+    def on_failure(failure, index):
+        failed.add(index)
+        if result.called or len(failed) < len(calls):
+            return
+
+        # All calls made so far failed, do not wait for the hedge
+        if timer.active():
+            timer.cancel()
+        result.errback(failure)
+
+    def start():
+        index = len(calls)
+        deferred = call()
+        calls.append(deferred)
+        deferred.addCallbacks(on_response, on_failure, callbackArgs=(index,), errbackArgs=(index,))
+
+    def hedge():
+        if not result.called:
+            start()
+
+    timer = reactor.callLater(hedge_after, hedge)
+    start()
+
+    return result
+
+
+class RetrySessionMixin(object):
+    """
+    Session mixin retrying endpoint calls according to a RetryPolicy
+
+    `retry_policies` maps endpoint uris to a RetryPolicy. Calls to other
+    uris are made once. Per uri statistics are collected in `retry_stats`.
+    Tasks using a policy should not set the workflow `retry_count`.
+    """
+
+    retry_policies = {}
+    retry_stats = None
+
+    def _retry_stats(self, uri):
+
+        if self.retry_stats is None:
+            self.retry_stats = {}
+        if uri not in self.retry_stats:
+            self.retry_stats[uri] = {'calls': 0, 'attempts': 0, 'retries': 0, 'transient': 0, 'permanent': 0,
+                                     'hedged': 0, 'hedge_wins': 0, 'failed': 0}
+
+        return self.retry_stats[uri]
+
+    def call(self, procedure, request, *args, **kwargs):
+
+        policy = self.retry_policies.get(procedure)
+        parent = super(RetrySessionMixin, self)
+        if policy is None:
+            return parent.call(procedure, request, *args, **kwargs)
+
+        return self._call_with_retry(policy, procedure, lambda: parent.call(procedure, request, *args, **kwargs))
+
+    @chainable
+    def _call_with_retry(self, policy, procedure, call):
+
+        stats = self._retry_stats(procedure)
+        stats['calls'] += 1
+
+        attempt = 0
+        while True:
+            attempt += 1
+            stats['attempts'] += 1
+            try:
+                if policy.hedge_after:
+                    response, hedge_made, hedge_won = yield hedged(call, policy.hedge_after)
+                    stats['hedged'] += int(hedge_made)
+                    stats['hedge_wins'] += int(hedge_won)
+                else:
+                    response = yield call()
+                return response
+            except Exception as error:
+                failure = Failure(error)
+                transient = policy.classify(failure)
+                stats['transient' if transient else 'permanent'] += 1
+
+                if not transient or attempt >= policy.max_attempts:
+                    stats['failed'] += 1
+                    self.log.error('Call to {uri} failed after {attempt} attempt(s): {error}',
+                                   uri=procedure, attempt=attempt, error=str(error))
+                    raise
+
+                delay = policy.backoff(attempt)
+                stats['retries'] += 1
+                self.log.warn('Transient error calling {uri}, retry in {delay:.1f} s: {error}',
+                              uri=procedure, delay=delay, error=str(error))
+                yield sleep(delay)